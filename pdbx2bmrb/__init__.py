@@ -15,12 +15,21 @@ sys.path.append( STAROBJ_PATH )
 
 import starobj
 
-from .tagmap import readcsv
-from .mmcif import CifReader
+from .compress import open_file, create_file
+from .tags import parse_tag, quote_ident
+from .profiles import PROFILES
+from .tagmap import readcsv, mapped_tables, load_tagmap, compile_tagmap
+from .mmcif import CifReader, CifIds, ParseResult
+from .cifcache import CifCache
+from .coords import AtomSiteStore
 from .nmrstar import BMRBEntry
 from .datastruct import CifCol, StarCol, StarTable
-from .convert import OneDepToBmrb
+from .asym import asym_number, asym_numbers, asym_sort_key
+from .transforms import TRANSFORMS, SKIP, TransformRegistry
+from .convert import OneDepToBmrb, SourceRows, SourceMapCache, SOURCE_MAPS
+from .plan import ConversionPlan, load_plan
 from .chemshifts import ChemShiftHandler, ChemShifts
+from .starwriter import StarStreamWriter
 
 # simple timings
 #
@@ -56,11 +65,13 @@ def sanitize( value ) :
 
 
 __all__ = [ "sas", "starobj", 
-    "TEMP_TABLE_NAME", "TEMP_KEY_COL_NAME", "STD_CHEM_COMPS",
-    "sanitize", "timer", 
-    "readcsv",
-    "CifReader", "BMRBEntry", 
+    "TEMP_TABLE_NAME", "TEMP_KEY_COL_NAME", "STD_CHEM_COMPS", "PROFILES",
+    "sanitize", "timer", "open_file", "create_file", "parse_tag", "quote_ident",
+    "readcsv", "mapped_tables", "load_tagmap", "compile_tagmap",
+    "CifReader", "CifIds", "ParseResult", "CifCache", "AtomSiteStore", "BMRBEntry", 
     "CifCol", "StarCol", "StarTable", 
-    "ChemShiftHandler", "ChemShifts", 
-    "OneDepToBmrb",
+    "ChemShiftHandler", "ChemShifts", "StarStreamWriter", 
+    "asym_number", "asym_numbers", "asym_sort_key",
+    "TRANSFORMS", "SKIP", "TransformRegistry",
+    "OneDepToBmrb", "SourceRows", "SourceMapCache", "SOURCE_MAPS", "ConversionPlan", "load_plan",
     ]
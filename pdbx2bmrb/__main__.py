@@ -19,274 +19,135 @@ import pdbx2bmrb
 
 # read mmcif and return its db wrapper
 #
-def read_mmcif( config, infile, verbose = False ) :
+# batchsize in [pdbx] is insert batch size (default CifReader.BATCH_SIZE, 0: one row at a time),
+#  stats prints rows/sec per category
+# mapped_only: skip tables that aren't in the tag map
+# lazyschema in [pdbx] creates only the tables that are in the file (and the mapped ones)
+# cachedir in [pdbx] keeps loaded databases for re-runs on the same file, use_cache = False to skip
+# columnar: keep atom_site in numpy arrays instead of sqlite
+# profile in [pdbx] is sqlite connection profile (pragmas), stats prints effective settings
+#
+def read_mmcif( config, infile, mapped_only = False, use_cache = True, columnar = False, stats = False,
+        verbose = False ) :
     assert isinstance( config, ConfigParser.ConfigParser )
     ddlfile = os.path.realpath( config.get( "pdbx", "sqlscript" ) )
     ciffile = os.path.realpath( infile )
-    cif = pdbx2bmrb.CifReader.parse( infile = ciffile, ddlscript = ddlfile, verbose = verbose )
+    batchsize = pdbx2bmrb.CifReader.BATCH_SIZE
+    if config.has_option( "pdbx", "batchsize" ) :
+        batchsize = config.getint( "pdbx", "batchsize" )
+    lazy = False
+    if config.has_option( "pdbx", "lazyschema" ) :
+        lazy = config.getboolean( "pdbx", "lazyschema" )
+    tables = None
+    if mapped_only or lazy :
+        tables = pdbx2bmrb.mapped_tables( os.path.realpath( config.get( "convert", "tagmap" ) ) )
+    profile = None
+    if config.has_option( "pdbx", "profile" ) :
+        profile = config.get( "pdbx", "profile" )
+    cache = None
+    if use_cache and config.has_option( "pdbx", "cachedir" ) :
+        maxsize = None
+        if config.has_option( "pdbx", "cachesize" ) :
+            maxsize = config.getint( "pdbx", "cachesize" )
+        cache = pdbx2bmrb.CifCache( directory = config.get( "pdbx", "cachedir" ), maxsize = maxsize,
+                verbose = verbose )
+    cif = pdbx2bmrb.CifReader.parse( infile = ciffile, ddlscript = ddlfile, batchsize = batchsize,
+            tables = (mapped_only and tables or None), lazy = lazy, cache = cache, columnar = columnar,
+            profile = profile, verbose = verbose )
+
+# the converter queries every mapped table, make sure they exist
+#
+    if lazy :
+        cif.create_tables( tables )
+    if stats :
+        sys.stdout.write( "mmCIF sqlite profile %s\n" % (pdbx2bmrb.profiles.format_settings( profile, cif.settings ),) )
+        cif.print_stats()
+        if cif.coords is not None :
+            cif.coords.print_memory_report()
     return cif
 
 # convert to nmr-star and retrun db wrapper
+# stats prints how many dictionary tables were mapped/skipped
 #
-def convert( config, cif, verbose = False ) :
+def convert( config, cif, coordinates = True, stats = False, verbose = False ) :
     assert isinstance( config, ConfigParser.ConfigParser )
     assert isinstance( cif, pdbx2bmrb.CifReader )
 
     star = pdbx2bmrb.BMRBEntry.from_scratch( config = cp, verbose = verbose )
     star.entryid = cif.entryid
     star.pdbid = cif.pdbid
+    star.coordinates = coordinates
 
     dic = star._dic
 
+# compiled tag map is rebuilt if tagmap or dictionary file changed
+#
     mapfile = config.get( "convert", "tagmap" )
-    pdbx2bmrb.readcsv( mapdb = cif.connection, 
+    compiled = None
+    if config.has_option( "convert", "compiled_tagmap" ) :
+        compiled = os.path.realpath( config.get( "convert", "compiled_tagmap" ) )
+    dictfile = None
+    if config.get( "dictionary", "engine" ) == "sqlite3" :
+        dictfile = os.path.realpath( config.get( "dictionary", "database" ) )
+    pdbx2bmrb.load_tagmap( mapdb = cif.connection, 
         filename = os.path.realpath( mapfile ), 
-        stardict = dic, verbose = verbose )
-
-    tables = pdbx2bmrb.OneDepToBmrb.map_tables( cifdb = cif, mapdb = cif.connection, 
-        stardb = star, 
-        verbose = verbose )
-
-# a dict with keys 0, 1, ... instead of 2.7 OrderedDict
-# value is { saveframe category : [list of tables] }
+        stardict = dic, compiled = compiled, dictfile = dictfile, verbose = verbose )
+
+    pdbx2bmrb.TRANSFORMS.reset_stats()
+    counts = {}
+    with pdbx2bmrb.timer( "map_tables", verbose = stats ) :
+        tables = pdbx2bmrb.OneDepToBmrb.map_tables( cifdb = cif, mapdb = cif.connection, 
+            stardb = star, counts = counts,
+            verbose = verbose )
+    if stats :
+        sys.stdout.write( "map_tables: %d dictionary tables, %d mapped, %d skipped: no tag map rows, %d skipped: no data\n" \
+            % (counts["tables"],counts["mapped"],counts["no_mapping"],counts["no_data"]) )
+
+# saveframe grouping and builders come from the conversion plan (see plan.py),
+# it is saved next to the compiled tag map
 #
-    saveframes = {}
-    for t in tables :
-        sfcat = dic.get_saveframe_category( table = t.table )
-
-        if len( saveframes ) < 1 :
-            saveframes[1] = { sfcat : [t] }
-        else :
-            found = False
-            for (k, v) in saveframes.items() :
-                if sfcat in v.keys() :
-                    saveframes[k][sfcat].append( t )
-                    found = True
-                    break
-            if not found :
-                saveframes[max( saveframes.keys() ) + 1] = { sfcat : [t] }
+    sources = [os.path.realpath( mapfile )]
+    if dictfile is not None : sources.append( dictfile )
+    plan = pdbx2bmrb.load_plan( mapdb = cif.connection, stardict = dic, compiled = compiled,
+        sources = sources, verbose = verbose )
 
 # sanity check
 #
-        if dic.is_free_table( table = t.table ) :
-            if dic.is_unique_category( sfcat ) :
-                if t.numvals > 1 :
-
-# transform code 50: may collapse multiple mmcif rows into one nmr-star row so this could be OK
-#
-                    if not t.is_fifty :
+    for (category, sftables) in plan.groups( tables ) :
+        t = plan.check( category, sftables )
+        if t is not None :
 
 #TODO: this can happen if there's 2 experimental method rows in mmcif.
 # it should map to nmr-stare 3.2 experimental_methods loop then
 #
-                        sys.stderr.write( "%d saveframes in unique category %s (hybrid entry?)\n" % (t.numvals, sfcat) )
-                        sys.stderr.write( "Offending table:\n" )
-                        pprint.pprint( t )
-                        sys.stderr.write( "Conversion failed\n" )
-                        sys.exit( 1 )
+            sys.stderr.write( "%d saveframes in unique category %s (hybrid entry?)\n" % (t.numvals, category["category"]) )
+            sys.stderr.write( "Offending table:\n" )
+            pprint.pprint( t )
+            sys.stderr.write( "Conversion failed\n" )
+            sys.exit( 1 )
 
 # create saveframes
 # OneDep doesn't capture many, and most of those need special-casing
 #
-#            pprint.pprint( saveframes )
-#
-#    star.verbose = True
-#    star._db.verbose = True
+    plan.execute( star = star, cifdb = cif, tables = tables, verbose = verbose )
 
-    for i in sorted( saveframes.keys() ) :
-        s = saveframes[i].keys()[0]
-
-# (this is the order of saveframes in nmr-star file)
+# without coordinates Atom_site only has residues for fix_comp_index(): they don't go in the model file
 #
+    if not coordinates :
+        star.delete_coordinates()
 
-        if s == "entry_interview" :
-            star.make_unique_saveframe( cifdb = cif, tables = saveframes[i][s], category = s,
-                    freetable = "Entry_interview", idtag = "ID" )
-            star.fix_entry_interview()
-
-        elif s == "deposited_data_files" :
-            star.make_unique_saveframe( cifdb = cif, tables = saveframes[i][s], category = s,
-                freetable = "Deposited_data_files", idtag = "Deposited_data_files_ID" )
-            star.fix_upload_files()
-
-        elif s == "entry_information" :
-            star.make_entry_information( cifdb = cif, tables = saveframes[i][s] )
-            star.fix_entry()
-
-        elif s == "citations" :
-            star.make_citations( cifdb = cif, tables = saveframes[i][s] )
-            star.fix_citations()
-
-
-# 2015-11-17 we now have 1-1 mappings from pdbx v.5 tables. need post-cooking though.
-#            pprint.pprint( saveframes[s] )
-#            star.make_assembly( cifdb = cif, tables = saveframes[s] )
-
-        elif s == "assembly" :
-#            star.verbose = True
-            star.make_unique_saveframe( cifdb = cif, tables = saveframes[i][s], category = s,
-                freetable = "Assembly", idtag = "Assembly_ID" )
-#            star.verbose = False
-
-        elif s == "entity" :
-#            star.verbose = True
-            star.make_entities( cifdb = cif, tables = saveframes[i][s] )
-            star.fix_entity_assembly()
-            star.fix_entity()
-#            star.verbose = False
-
-# 2015-11-19
-# natural and experimental sources
-    #
-    #  Expn by Monica Sekharan (RCSB)
-    # For source information, you can review the following tags to see whether an entity is nat, man, or syn.
-    # _entity.id
-    # _entity.src_method
-    # If _entity.src_method is nat, then only the information for entity_src_nat will be populated.
-    # If _entity.src_method is man, then only the information for entity_src_gen will be populated.
-    # If _entity.src_method is syn, then only the information for entity_src_syn will be populated.
-    #
-    # When a protein is naturally obtained without an expression system, entity_src_nat is filled in,
-    # not the entity_src_gen and vice versa for a genetically manipulated system.
-    #
-    # [When] there is only a natural source for entity (no experimental source) which can be found here:
-    # _entity_src_nat.pdbx_organism_scientific
-    #
-    # the natural source for the synthetically created entity can be found here:
-    # _pdbx_entity_src_syn.organism_scientific
-    #
-    # [When] he source for the protein is man only the _entity_src_gen is populated.  Within
-    # _entity_src_gen you can find the natural source here:
-    # _entity_src_gen.pdbx_gene_src_scientific_name
-    # and the experimental source here:
-    # _entity_src_gen.pdbx_host_org_scientific_name
-    #
-    # When the entity was both extracted from a natural source and was generated from an expression
-    # system both the natural source and expression system go under _entity_src_gen
-    #
-    # In this loop, anything that starts with _entity_src_gen.pdbx_gene_src gives you information
-    # about the natural source. For example, the natural source scientific name is here:
-    # _entity_src_gen.pdbx_gene_src_scientific_name
-    #
-    # Anything that starts with _entity_src_gen.pdbx_host_org gives you information about the expression
-    # system. For example, the expression system scientific name is here:
-    # _entity_src_gen.pdbx_host_org_scientific_name
-    #
-    # for both natural and experimental source, we just need to select rows for given entity ID.
-
-        elif s == "natural_source" :
-
-            crystal = {}
-            for (eid,meth) in star._db.iter_values( table = "Entity", columns = ("ID","Src_method") ) :
-                if meth is None : meth = "man"
-                if not meth in crystal.keys() :
-                    crystal[meth] = pdbx2bmrb.OneDepToBmrb.map_natural_source( cifdb = cif, 
-                            mapdb = cif.connection, method = meth, 
-                            verbose = ((options.debug & 2) != 0 and True or False) )
-
-            for meth in crystal.keys() :
-                if crystal[meth] is not None :
-                    star.make_unique_saveframe( cifdb = cif, tables = crystal[meth], category = "natural_source",
-                    freetable = "Entity_natural_src_list", idtag = "Entity_natural_src_list_ID" )
-            crystal.clear()
-            star.fix_natural_source()
-
-        elif s == "experimental_source" :
-            crystal = {}
-            for (eid,meth) in star._db.iter_values( table = "Entity", columns = ("ID","Src_method") ) :
-                if meth is None : meth = "man"
-                if not meth in crystal.keys() :
-                    crystal[meth] = pdbx2bmrb.OneDepToBmrb.map_experimental_source( cifdb = cif, 
-                            mapdb = cif.connection, method = meth,
-                            verbose = ((options.debug & 2) != 0 and True or False) )
-
-            for meth in crystal.keys() :
-                if crystal[meth] is not None :
-                    star.make_unique_saveframe( cifdb = cif, tables = crystal[meth], category = "experimental_source",
-                    freetable = "Entity_experimental_src_list", idtag = "Entity_experimental_src_list_ID" )
-            crystal.clear()
-            star.fix_experimental_source()
-
-        elif s == "chem_comp" :
-            star.make_chem_comps( cifdb = cif, tables = saveframes[i][s] )
-
-        elif s == "sample" :
-            star.make_replicable_saveframe( cifdb = cif, tables = saveframes[i][s], category = s,
-                ciftable = "pdbx_nmr_sample_details", cifidtag = "solution_id",
-                freetable = "Sample", idtag = "Sample_ID" )
-            star.fix_sample()
-
-        elif s == "sample_conditions" :
-            star.make_sample_conditions( cifdb = cif, tables = saveframes[i][s] )
-
-        elif s == "software" :
-            star.make_warez( cifdb = cif, tables = saveframes[i][s] )
-
-        elif s == "NMR_spectrometer" :
-            star.make_replicable_saveframe( cifdb = cif, tables = saveframes[i][s], category = s,
-                ciftable = "pdbx_nmr_spectrometer", cifidtag = "spectrometer_id",
-                freetable = "NMR_spectrometer", idtag = "NMR_spectrometer_ID" )
-
-        elif s == "NMR_spectrometer_list" :
-            star.make_unique_saveframe( cifdb = cif, tables = saveframes[i][s], category = s,
-                freetable = "NMR_spectrometer_list", idtag = "NMR_spectrometer_list_ID" )
-            star.fix_spectrometer_list()
-
-        elif s == "experiment_list" :
-            star.make_unique_saveframe( cifdb = cif, tables = saveframes[i][s], category = s,
-                freetable = "Experiment_list", idtag = "Experiment_list_ID" )
-            star.fix_experiment()
-
-        elif s == "chem_shift_reference" :
-            star.make_replicable_saveframe( cifdb = cif, tables = saveframes[i][s], category = s,
-                ciftable = "pdbx_nmr_chem_shift_reference", cifidtag = "id",
-                freetable = "Chem_shift_reference", idtag = "Chem_shift_reference_ID" )
-
-        elif s == "assigned_chemical_shifts" :
-            star.make_replicable_saveframe( cifdb = cif, tables = saveframes[i][s], category = s,
-                ciftable = "pdbx_nmr_assigned_chem_shift_list", cifidtag = "id",
-                freetable = "Assigned_chem_shift_list", idtag = "Assigned_chem_shift_list_ID" )
-
-        elif s == "conformer_statistics" :
-            star.make_unique_saveframe( cifdb = cif, tables = saveframes[i][s], category = s,
-                freetable = "Conformer_stat_list", idtag = "Conformer_stat_list_ID" )
-            star.fix_conformer_stats()
-
-        elif s == "conformer_family_coord_set" :
-            star.make_unique_saveframe( cifdb = cif, tables = saveframes[i][s], category = s,
-                freetable = "Conformer_family_coord_set", idtag = "Conformer_family_coord_set_ID" )
-            star.fix_coordinates()
-            star.fix_comp_index()
-
-        elif s == "representative_conformer" :
-            star.make_unique_saveframe( cifdb = cif, tables = saveframes[i][s], category = s,
-                freetable = "Representative_conformer", idtag = "Representative_conformer_ID" )
-            star.fix_rep_conf()
-
-        elif s == "constraint_statistics" :
-            star.make_unique_saveframe( cifdb = cif, tables = saveframes[i][s], category = s,
-                freetable = "Constraint_stat_list", idtag = "Constraint_stat_list_ID" )
-            star.fix_constraint_stats()
-
-        elif s == "spectral_peak_list" :
-            star.make_replicable_saveframe( cifdb = cif, tables = saveframes[i][s], category = s,
-                ciftable = "pdbx_nmr_spectral_peak_list", cifidtag = "id",
-                freetable = "Spectral_peak_list", idtag = "Spectral_peak_list_ID" )
-            star.add_software_framecodes( table = "Spectral_peak_software" )
-            star.fix_peaklist()
-
-        else :
-            raise Exception( "Don't know how to map saveframe category %s" % (s,) )
+    if stats :
+        pdbx2bmrb.TRANSFORMS.print_stats()
 
     return star
 
-#
+# outfile ending in .gz or .bz2 is compressed, "-" is stdout
 #
 def pretty_print( star, outfile = None, verbose = False ) :
     assert isinstance( star, pdbx2bmrb.BMRBEntry )
     if outfile is None :
         outfile = "bmr%s.out.str" % (star.entryid,)
-    with open( outfile, "w" ) as out :
+    with pdbx2bmrb.create_file( outfile ) as out :
         v = star.verbose
         star.verbose = verbose
         star.write( out )
@@ -321,17 +182,25 @@ if __name__ == "__main__" :
     op.add_option( "-i", "--infile", action = "store", type="string", dest = "infile",
                    default = None, help = "input PDBX model file" )
     op.add_option( "-m", "--modelfile", action = "store", type="string", dest = "mdlfile",
-                   default = None, help = "input NMAR-STAR model file" )
+                   default = None, help = "input NMAR-STAR model file or snapshot" )
     op.add_option( "-s", "--csfile", action = "store", type="string", dest = "csfile",
                    default = None, help = "input chemical shifts file" )
     op.add_option( "-o", "--outfile", action = "store", type="string", dest = "outfile",
-                   default = None, help = "output NMR-STAR file" )
+                   default = None, help = "output NMR-STAR file (.gz or .bz2: compressed, -: stdout)" )
     op.add_option( "--with-coordinates", action = "store_true", dest = "merged",
                    default = False, help = "include atomic coordinates" )
     op.add_option( "--with-pdbx-seq", action = "store_true", dest = "keep_assembly",
                    default = False, help = "include pdbx_[poly_seq/nonpoly]_scheme tables" )
+    op.add_option( "--mapped-tables-only", action = "store_true", dest = "mapped_only",
+                   default = False, help = "do not load mmCIF tables that aren't in the tag map" )
+    op.add_option( "--columnar-coordinates", action = "store_true", dest = "columnar",
+                   default = False, help = "keep atom_site in numpy arrays instead of sqlite (needs numpy)" )
+    op.add_option( "--no-cache", action = "store_false", dest = "use_cache",
+                   default = True, help = "do not use (or update) mmCIF database cache" )
     op.add_option( "--keep-model-file", action = "store_true", dest = "keep_model",
                    default = False, help = "do not delete NMR-STAR model file when done" )
+    op.add_option( "--snapshot", action = "store_true", dest = "snapshot",
+                   default = False, help = "save NMR-STAR model as binary snapshot (.model.sqlt3) for -m" )
     op.add_option( "--no-ets", action = "store_false", dest = "update_ets",
                    default = True, help = "do not update contact info in ETS" )
 
@@ -360,25 +229,45 @@ if __name__ == "__main__" :
 #
         if options.infile is not None :
             with pdbx2bmrb.timer( "reading mmCIF model file", verbose = options.verbose ) :
-                cif = read_mmcif( config = cp, infile = options.infile, 
+                cif = read_mmcif( config = cp, infile = options.infile, mapped_only = options.mapped_only,
+                        use_cache = options.use_cache, columnar = options.columnar, stats = options.verbose,
                         verbose = ((options.debug & 1) != 0 and True or False) )
 
             with pdbx2bmrb.timer( "mapping to NMR-STAR", verbose = options.verbose ) :
-                star = convert( config = cp, cif = cif, 
+                star = convert( config = cp, cif = cif, coordinates = options.merged, stats = options.verbose,
                         verbose = ((options.debug & 2) != 0 and True or False) )
+            if options.verbose and (star.settings is not None) :
+                sys.stdout.write( "NMR-STAR sqlite profile %s\n" % (pdbx2bmrb.profiles.format_settings( star.profile,
+                        star.settings ),) )
 
-#     pretty-print NMR-STAR model file
+#     pretty-print NMR-STAR model file: only if we're keeping it, it gets deleted at the end otherwise
 #
-            with pdbx2bmrb.timer( "pretty-print header", verbose = options.verbose ) :
-                if options.outfile is None :
-                    mdlfile = "bmr%s.model.str" % (star.entryid,)
-                else :
-                    mdlfile = "%s.model.str" % (os.path.splitext( options.outfile )[0],)
-                pretty_print( star, mdlfile, verbose = ((options.debug & 4) != 0 and True or False) )
-
-# or read in already converted NMR-STAR model file
+            if options.keep_model :
+                with pdbx2bmrb.timer( "pretty-print header", verbose = options.verbose ) :
+                    if (options.outfile is None) or (options.outfile == "-") :
+                        mdlfile = "bmr%s.model.str" % (star.entryid,)
+                    else :
+                        mdlfile = "%s.model.str" % (os.path.splitext( options.outfile )[0],)
+                    pretty_print( star, mdlfile, verbose = ((options.debug & 4) != 0 and True or False) )
+
+# binary snapshot: -m loads it without parsing
+#
+            if options.snapshot :
+                with pdbx2bmrb.timer( "saving snapshot", verbose = options.verbose ) :
+                    if (options.outfile is None) or (options.outfile == "-") :
+                        snapfile = "bmr%s.model.sqlt3" % (star.entryid,)
+                    else :
+                        snapfile = "%s.model.sqlt3" % (os.path.splitext( options.outfile )[0],)
+                    star.save_snapshot( snapfile )
+
+# or read in already converted NMR-STAR model file or snapshot
 #
 
+        elif pdbx2bmrb.BMRBEntry.is_snapshot( options.mdlfile ) :
+            with pdbx2bmrb.timer( "loading NMR-STAR snapshot", verbose = options.verbose ) :
+                star = pdbx2bmrb.BMRBEntry.from_snapshot( config = cp, filename = options.mdlfile,
+                verbose = ((options.debug & 8) != 0 and True or False) )
+
         else :
             with pdbx2bmrb.timer( "reading NMR-STAR model file", verbose = options.verbose ) :
                 star = pdbx2bmrb.BMRBEntry.from_file( config = cp, starfile = options.mdlfile, 
@@ -429,7 +318,7 @@ if __name__ == "__main__" :
                     traceback.print_exc()
 
             if not options.keep_model :
-                if options.outfile is None :
+                if (options.outfile is None) or (options.outfile == "-") :
                     mdlfile = os.path.realpath( "bmr%s.model.str" % (star.entryid,) )
                 else :
                     mdlfile = os.path.realpath( "%s.model.str" % (os.path.splitext( options.outfile )[0],) )
@@ -441,7 +330,8 @@ if __name__ == "__main__" :
 #
 
         with pdbx2bmrb.timer( "pretty-print NMR-STAR", verbose = options.verbose ) :
-            if options.outfile is None :
+            outfile = options.outfile
+            if outfile is None :
                 if options.merged :
                     outfile = "merged_%s_%s.str" % (str( cif.entryid ), str( cif.pdbid ))
                 else :
@@ -0,0 +1,72 @@
+#!/usr/bin/python -u
+#
+# asym ID to number (transform code 45).
+#
+# PDB uses A-Z then a-z for asym IDs, then they go to 2-letter IDs. Auth chain IDs can have digits too.
+# IDs are read as bijective base-62 numbers with digits A-Z, a-z, 0-9:
+#  "A" -> 1, "Z" -> 26, "a" -> 27, "z" -> 52, "0" -> 53, "9" -> 62, "AA" -> 63, "AB" -> 64, ...
+# so single-letter IDs are same as they always were, longer IDs don't collide with anything,
+# and shorter IDs come first.
+#
+# Results are cached: there's only a few distinct IDs even in big assemblies.
+#
+
+from __future__ import absolute_import
+
+import sys
+
+ALPHABET = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789"
+
+_DIGITS = dict( (ALPHABET[i], i + 1) for i in range( len( ALPHABET ) ) )
+_CACHE = {}
+
+# number for one asym ID. None for no value.
+#
+def asym_number( asym ) :
+    if asym is None : return None
+    try :
+        return _CACHE[asym]
+    except KeyError :
+        pass
+
+    chars = str( asym ).strip()
+    if len( chars ) < 1 :
+        raise Exception( "don't know how to convert asym id %s" % (str( asym ),) )
+    value = 0
+    for char in chars :
+        if not char in _DIGITS :
+            raise Exception( "can't map %s to number in asym id %s" % (char,chars,) )
+        value = value * len( ALPHABET ) + _DIGITS[char]
+
+    _CACHE[asym] = value
+    return value
+
+# numbers for a list of asym IDs, in the same order. Each distinct ID is converted once.
+#
+def asym_numbers( values ) :
+    numbers = {}
+    for val in set( values ) :
+        numbers[val] = asym_number( val )
+    return [numbers[val] for val in values]
+
+# for sorting asym IDs by number: no value first, then IDs, then anything that isn't an asym ID
+#
+def asym_sort_key( asym ) :
+    if asym is None : return (0, 0, "")
+    try :
+        return (1, asym_number( asym ), "")
+    except Exception :
+        return (2, 0, str( asym ))
+
+def clear_cache() :
+    _CACHE.clear()
+
+#
+#
+if __name__ == "__main__" :
+    for asym in sys.argv[1:] :
+        sys.stdout.write( "%s: %s\n" % (asym,asym_number( asym )) )
+
+#
+# eof
+#
@@ -0,0 +1,352 @@
+#!/usr/bin/python -u
+#
+# time OneDepToBmrb.make_source_table() against make_source_table_rowwise(), the original
+# update-per-value version below, on a synthetic atom_site table and check they make the same temp table.
+#
+#  python -m pdbx2bmrb.benchmark [-n rows]
+#
+# with --indexes: time NMR-STAR post-processing (fix_coordinates, fix_comp_index, sort_atoms)
+# on a synthetic multi-chain entry with and without the indexes declared by @uses_indexes.
+# Needs the [entry] and [dictionary] sections of the config file.
+#
+#  python -m pdbx2bmrb.benchmark --indexes -c pdbx2bmrb.conf [--chains N] [--residues N]
+#
+
+from __future__ import absolute_import
+
+import sys
+import os
+import pprint
+import sqlite3
+import time
+import optparse
+import ConfigParser
+
+_UP = os.path.realpath( "%s/../" % (os.path.split( __file__ )[0],) )
+sys.path.append( _UP )
+import pdbx2bmrb
+
+# atom_site tag : (Atom_site tag, transform code)
+#
+COLUMNS = (
+    ("id", "ID", 0),
+    ("label_asym_id", "Label_asym_ID", 0),
+    ("label_asym_id", "Entity_assembly_ID", 45),
+    ("label_seq_id", "Label_seq_ID", 0),
+    ("label_comp_id", "Label_comp_ID", 0),
+    ("label_atom_id", "Label_atom_ID", 0),
+    ("type_symbol", "Type_symbol", 0),
+    ("Cartn_x", "Cartn_x", 0),
+    ("Cartn_y", "Cartn_y", 0),
+    ("Cartn_z", "Cartn_z", 0),
+    ("pdbx_PDB_model_num", "Model_ID", 2),
+)
+
+# in-memory database with numrows rows in atom_site
+#
+def make_database( numrows ) :
+    conn = sqlite3.connect( ":memory:" )
+    cols = []
+    for (col, starcol, code) in COLUMNS :
+        if not col in cols : cols.append( col )
+    conn.execute( "create table atom_site (%s)" % (",".join( '"%s" text' % (c,) for c in cols ),) )
+    rows = []
+    for i in range( numrows ) :
+        rows.append( (str( i + 1 ), "ABCDEFGH"[i % 8], str( i // 10 + 1 ), "ALA", "CA", "C",
+            "%.3f" % (i * 0.1,), "%.3f" % (i * 0.2,), "%.3f" % (i * 0.3,), "1") )
+    conn.executemany( "insert into atom_site values (%s)" % (",".join( "?" for c in cols ),), rows )
+    conn.commit()
+    return conn
+
+# mapping for Atom_site, same as OneDepToBmrb.map_rows() makes from the tag map
+#
+def make_table( conn ) :
+    rows = []
+    for (col, starcol, code) in COLUMNS :
+        rows.append( (starcol, "atom_site", col, code, None) )
+    return pdbx2bmrb.OneDepToBmrb.map_rows( conn.cursor(), "Atom_site", rows )
+
+# original OneDepToBmrb.make_source_table(): update per value. Reference for run().
+# Transform codes come from the registry, so both versions always use the same ones.
+#
+def make_source_table_rowwise( conn, startable, cifdb = None, verbose = False ) :
+
+    if verbose :
+        sys.stdout.write( "make_source_table_rowwise()\n" )
+
+    assert isinstance( conn, sqlite3.Connection )
+    assert isinstance( startable, pdbx2bmrb.StarTable )
+
+    curs = conn.cursor()
+    sql = "drop table if exists " + pdbx2bmrb.TEMP_TABLE_NAME
+    curs.execute( sql )
+
+    colstr = pdbx2bmrb.TEMP_KEY_COL_NAME + " integer primary key,"
+    for col in startable.cols.keys() :
+        colstr += '"%s" text,' % (col,)
+    colstr = colstr[:-1]
+
+    sql = "create table %s (%s)" % (pdbx2bmrb.TEMP_TABLE_NAME, colstr)
+    if verbose :
+        sys.stdout.write( sql + "\n" )
+    curs.execute( sql )
+
+    startable.sanitize()
+
+# ideally I want the same number of values in all rows. Not gonna happen IRL.
+# the flip side is "fallback" mappings where 100 chem comp names can map to 1 entity name
+#  (but only when there's no suitable name entity). Hopefully they're all code 1001...
+#
+# relly need to fix this: take the ID col or the 1st col
+# then take the 1st pdbcol and ignore the rest. hope startable.sanitize() sorted them right.
+#
+    col = None
+    for c in startable.cols.keys() :
+        if verbose :
+            sys.stdout.write( ">> col:\n" )
+            pprint.pprint( c )
+        if col is None : col = startable.cols[c]
+        if c == "ID" :
+            col = startable.cols[c]
+            break
+    if col is None :
+        raise Exception( "No columns for table %s" % (startable.table,) )
+
+    pdbcols = col.pdbcols
+    for pdbcol in pdbcols.keys() :
+        pc = pdbcols[pdbcol]
+
+        if verbose : pprint.pprint( pc )
+
+        if pc.numvals < 1 :
+            raise Exception( "No values in the source tag _%s.%s: %d, was %d" % (pc.table,pc.col,pc.numvals,pc.numrows) )
+
+# now use row number as the key :
+#  in sqlite "integer primary key" is an autoincrement by default
+#
+
+        for i in range( pc.numvals ) :
+            sql = "insert into " + pdbx2bmrb.TEMP_TABLE_NAME + " (rownum) values (:num)"
+            if verbose : sys.stdout.write( "%s: %s\n" % (sql, str( i )) )
+            curs.execute( sql, { "num" : i } )
+        break
+
+# values go through the same transforms as make_source_table() (see transforms.py),
+# then one update per value
+#
+    params = {}
+    curs2 = conn.cursor()
+    for c in startable.cols.keys() :
+        pdbcols = startable.cols[c].pdbcols
+        for pdbcol in pdbcols.keys() :
+            pc = pdbcols[pdbcol]
+            qry = "select " + pc.dbcol + " from " + pc.dbtable
+
+            if verbose : sys.stdout.write( qry + "\n" )
+
+# atom_site may be in columnar store
+#
+            if (cifdb is not None) and cifdb.has_columns( pc.table ) :
+                values = list( cifdb.coords.values( pc.col ) )
+            else :
+                curs.execute( qry )
+                values = [row[0] for row in iter( curs.fetchone, None )]
+
+            values = pdbx2bmrb.TRANSFORMS.apply( pc.code, values, startable, c, pc )
+
+            sql = 'update %s set "%s"=:val where rownum=:row' % (pdbx2bmrb.TEMP_TABLE_NAME,c)
+            if not pdbx2bmrb.TRANSFORMS.overwrites( pc.code ) :
+                sql += ' and "%s" is null' % (c,)
+
+            for rownum in range( len( values ) ) :
+                if values[rownum] is pdbx2bmrb.SKIP : continue
+                params.clear()
+                params["val"] = values[rownum]
+                params["row"] = rownum
+                if verbose :
+                    pprint.pprint( sql )
+                    pprint.pprint( params )
+                try :
+                    curs2.execute( sql, params )
+                except sqlite3.OperationalError :
+                    pprint.pprint( startable )
+                    pprint.pprint( sql )
+                    pprint.pprint( params )
+                    raise
+
+    conn.commit()
+    curs2.close()
+    curs.close()
+
+#
+#
+def run( numrows, out = sys.stdout ) :
+    conn = make_database( numrows )
+    rc = {}
+    for func in (make_source_table_rowwise, pdbx2bmrb.OneDepToBmrb.make_source_table) :
+        startable = make_table( conn )
+        start = time.time()
+        func( conn, startable )
+        secs = time.time() - start
+        rows = conn.execute( "select * from %s order by %s" % (pdbx2bmrb.TEMP_TABLE_NAME,pdbx2bmrb.TEMP_KEY_COL_NAME) ).fetchall()
+        out.write( "%s: %d rows in %.3f sec\n" % (func.__name__,len( rows ),secs) )
+        rc[func.__name__] = (secs, rows)
+
+    if rc["make_source_table"][1] != rc["make_source_table_rowwise"][1] :
+        raise Exception( "make_source_table() and make_source_table_rowwise() tables differ" )
+    if rc["make_source_table"][0] > 0 :
+        out.write( "speedup: %.1fx\n" % (rc["make_source_table_rowwise"][0] / rc["make_source_table"][0],) )
+    conn.close()
+    return rc
+
+###############################################################################################
+# post-processing on a big entry
+#
+ENTRY_ID = "bench"
+RESIDUES = ("ALA", "GLY", "LYS", "SER", "VAL")
+ATOMS = (("N", "N"), ("H", "H"), ("CA", "C"), ("HA", "H"), ("C", "C"))
+WATERS = ("3", "1", "2")
+
+# (table, columns) filled by fill_entry() and compared after the run
+#
+ENTRY_TABLES = (
+    ("Entity", ("ID","Sf_ID","Entry_ID")),
+    ("Entity_assembly", ("ID","Entity_ID","Asym_ID","Entry_ID")),
+    ("PDBX_poly_seq_scheme", ("Entity_assembly_ID","Entity_ID","Comp_index_ID","Comp_ID","Asym_ID","Auth_seq_ID",
+        "Auth_seq_num","Entry_ID")),
+    ("PDBX_nonpoly_scheme", ("Entity_assembly_ID","Entity_ID","Comp_index_ID","Comp_ID","Asym_ID","Auth_seq_ID",
+        "Auth_seq_num","Entry_ID")),
+    ("Entity_comp_index", ("ID","Comp_ID","Entity_ID","Auth_seq_ID","Entry_ID")),
+    ("Atom_site", ("ID","Label_entity_assembly_ID","Label_entity_ID","Label_comp_index_ID","Label_comp_ID",
+        "Label_atom_ID","PDBX_label_asym_ID","Auth_seq_ID","Entry_ID")),
+    ("Atom_chem_shift", ("ID","Assigned_chem_shift_list_ID","Entity_assembly_ID","Entity_ID","Comp_index_ID","Comp_ID",
+        "Atom_ID","Atom_type","Entry_ID")),
+)
+
+# rows for ENTRY_TABLES: chains of a 2-entity complex (odd chains are entity 1, even are entity 2),
+# residues per chain, one zinc ion per chain in entity 3, two chains of waters in entity 4
+#
+def entry_rows( chains, residues ) :
+    rc = dict( (t, []) for (t, cols) in ENTRY_TABLES )
+    for eid in ("1", "2", "3", "4") :
+        rc["Entity"].append( (eid, eid, ENTRY_ID) )
+    atomid = 0
+    for ch in range( chains ) :
+        aid = str( ch + 1 )
+        eid = str( ch % 2 + 1 )
+        asym = pdbx2bmrb.asym.ALPHABET[ch % len( pdbx2bmrb.asym.ALPHABET )] * (ch // len( pdbx2bmrb.asym.ALPHABET ) + 1)
+        rc["Entity_assembly"].append( (aid, eid, asym, ENTRY_ID) )
+        for i in range( residues ) :
+            seq = str( i + 1 )
+            res = RESIDUES[(i * (int( eid ) + 1)) % len( RESIDUES )]
+            rc["PDBX_poly_seq_scheme"].append( (aid, eid, seq, res, asym, str( i + 10 ), None, ENTRY_ID) )
+            if ch < 2 :
+                rc["Entity_comp_index"].append( (seq, res, eid, None, ENTRY_ID) )
+            for (atom, typ) in ATOMS :
+                atomid += 1
+                rc["Atom_site"].append( (str( atomid ), None, eid, seq, res, atom, asym, str( i + 10 ), ENTRY_ID) )
+                rc["Atom_chem_shift"].append( (str( atomid ), "1", aid, eid, seq, res, atom, typ, ENTRY_ID) )
+
+        naid = str( chains + ch + 1 )
+        nasym = "Z%d" % (ch,)
+        rc["Entity_assembly"].append( (naid, "3", nasym, ENTRY_ID) )
+        rc["PDBX_nonpoly_scheme"].append( (naid, "3", "1", "ZN", nasym, str( 1000 + ch ), None, ENTRY_ID) )
+        atomid += 1
+        rc["Atom_site"].append( (str( atomid ), None, "3", None, "ZN", "ZN", nasym, str( 1000 + ch ), ENTRY_ID) )
+
+# waters: scheme keys aren't unique and the first row (in table order) wins, so residue numbers
+# and Auth_seq_IDs are out of order on purpose. Same comp index in each water chain, lower
+# Auth_seq_IDs in later chains.
+#
+    for i in range( len( WATERS ) ) :
+        rc["Entity_comp_index"].append( (str( i + 1 ), "HOH", "4", None, ENTRY_ID) )
+    for w in range( 2 ) :
+        waid = str( 2 * chains + w + 1 )
+        wasym = "W%d" % (w,)
+        rc["Entity_assembly"].append( (waid, "4", wasym, ENTRY_ID) )
+        for seq in WATERS :
+            aseq = str( 2000 - 100 * w + int( seq ) )
+            rc["PDBX_nonpoly_scheme"].append( (waid, "4", seq, "HOH", wasym, aseq, None, ENTRY_ID) )
+            atomid += 1
+            rc["Atom_site"].append( (str( atomid ), None, "4", None, "HOH", "O", wasym, aseq, ENTRY_ID) )
+
+# shifts come in file order, not sorted
+#
+    rc["Atom_chem_shift"].reverse()
+    return rc
+
+def fill_entry( star, rows ) :
+    for (table, cols) in ENTRY_TABLES :
+        star._db.execute( 'delete from "%s"' % (table,) )
+        sql = 'insert into "%s" (%s) values (%s)' % (table,",".join( '"%s"' % (c,) for c in cols ),
+            ",".join( ":c%d" % (i,) for i in range( len( cols ) ) ))
+        for row in rows[table] :
+            star._db.execute( sql, dict( ("c%d" % (i,), row[i]) for i in range( len( cols ) ) ) )
+
+def dump_entry( star ) :
+    rc = {}
+    for (table, cols) in ENTRY_TABLES :
+        sql = 'select %s from "%s"' % (",".join( '"%s"' % (c,) for c in cols ),table)
+        rc[table] = sorted( tuple( r ) for r in star._db.query( sql ) )
+    return rc
+
+#
+#
+def run_indexes( config, chains, residues, out = sys.stdout ) :
+    star = pdbx2bmrb.BMRBEntry.from_scratch( config = config )
+    star.entryid = ENTRY_ID
+    rows = entry_rows( chains, residues )
+    out.write( "%d chains, %d residues each: %d atoms, %d shifts\n" % (chains,residues,len( rows["Atom_site"] ),
+        len( rows["Atom_chem_shift"] )) )
+
+    rc = {}
+    for flag in (False, True) :
+        fill_entry( star, rows )
+        star.auto_indexes = flag
+        secs = []
+        for (name, func) in (("fix_coordinates", star.fix_coordinates), ("fix_comp_index", star.fix_comp_index),
+                ("sort_atoms", pdbx2bmrb.ChemShifts( star ).sort_atoms)) :
+            start = time.time()
+            func()
+            secs.append( (name, time.time() - start) )
+        out.write( "indexes %s: %s, total %.3f sec\n" % (flag and "on" or "off",
+            ", ".join( "%s %.3f" % s for s in secs ),sum( s[1] for s in secs )) )
+        out.write( "  %d indexes\n" % (len( star.indexes ),) )
+        star.drop_indexes()
+        rc[flag] = (sum( s[1] for s in secs ), dump_entry( star ))
+
+    if rc[True][1] != rc[False][1] :
+        raise Exception( "post-processing results differ with and without indexes" )
+    if rc[True][0] > 0 :
+        out.write( "speedup: %.1fx\n" % (rc[False][0] / rc[True][0],) )
+    return rc
+
+#
+#
+if __name__ == "__main__" :
+
+    op = optparse.OptionParser( usage = "usage: %prog [options]" )
+    op.add_option( "-n", "--rows", action = "store", type = "int", dest = "rows", default = 100000,
+        help = "number of atom_site rows (default: 100000)" )
+    op.add_option( "--indexes", action = "store_true", dest = "indexes", default = False,
+        help = "benchmark post-processing with and without indexes instead" )
+    op.add_option( "-c", "--conffile", action = "store", type = "string", dest = "conffile", default = None,
+        help = "config file (required with --indexes)" )
+    op.add_option( "--chains", action = "store", type = "int", dest = "chains", default = 8,
+        help = "number of chains (default: 8)" )
+    op.add_option( "--residues", action = "store", type = "int", dest = "residues", default = 300,
+        help = "residues per chain (default: 300)" )
+    (options, args) = op.parse_args()
+
+    if options.indexes :
+        if options.conffile is None :
+            op.error( "config file not specified" )
+        cp = ConfigParser.SafeConfigParser()
+        cp.read( options.conffile )
+        run_indexes( cp, options.chains, options.residues )
+    else :
+        run( options.rows )
+
+#
+# eof
+#
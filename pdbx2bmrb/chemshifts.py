@@ -13,6 +13,7 @@ import pprint
 _UP = os.path.realpath( os.path.join( os.path.split( __file__ )[0], ".." ) )
 sys.path.append( _UP )
 import pdbx2bmrb
+from pdbx2bmrb.nmrstar import uses_indexes
 
 #
 #
@@ -91,6 +92,7 @@ class ChemShiftHandler( pdbx2bmrb.sas.ContentHandler, pdbx2bmrb.sas.ErrorHandler
 #    TEMPLISTSTR = "TEMP_CSL_ID_CHANGEME"
 
     # reuse SAS DDL parser for this as it supports multiple data blocks etc.
+    # infile may be gzip'ed or bzip2'ed
     #
     #
     @classmethod
@@ -105,7 +107,7 @@ class ChemShiftHandler( pdbx2bmrb.sas.ContentHandler, pdbx2bmrb.sas.ErrorHandler
 
         h = cls( star = entry, verbose = verbose )
 
-        with open( fname, "rb" ) as f :
+        with pdbx2bmrb.open_file( fname ) as f :
             l = pdbx2bmrb.sas.StarLexer( f, bufsize = 0, verbose = False ) #verbose )
             p = pdbx2bmrb.sas.DdlParser.parse( lexer = l, content_handler = h, error_handler = h, verbose = False ) # verbose )
 
@@ -649,6 +651,7 @@ class ChemShifts( object ) :
     ###############################################################################################
     # there's always an entity for entity_assembly.
     #
+    @uses_indexes( ("Entity_assembly", ("Entry_ID","ID","Entity_ID")) )
     def _add_shift_entity_id( self ) : 
         if self.verbose :
             sys.stdout.write( "%s._add_shift_entity_id()\n" % (self.__class__.__name__,) )
@@ -816,6 +819,10 @@ class ChemShifts( object ) :
     ###############################################################################################
     #
     #
+    @uses_indexes( ("Sample_condition_list", ("Entry_ID","ID","Sf_framecode")),
+        ("Chem_shift_reference", ("Entry_ID","ID","Sf_framecode")),
+        ("Experiment", ("ID","Name")),
+        ("Atom_chem_shift", ("Atom_type",)) )
     def _add_labels_and_counts( self ) :
         if self.verbose :
             sys.stdout.write( "%s._add_labels_and_counts()\n" % (self.__class__.__name__,) )
@@ -1340,6 +1347,10 @@ class ChemShifts( object ) :
     # sorting: sort by entity assembly, entity, residue sequence, and atom order.
     # atom order is per-residue, rules below
     #
+    @uses_indexes( ("Atom_chem_shift", ("Comp_ID","Atom_ID")),
+        ("Atom_chem_shift", ("Assigned_chem_shift_list_ID","Entity_assembly_ID","Entity_ID","Comp_index_ID","Comp_ID",
+            "Atom_ID")),
+        ("Atom_chem_shift", ("ID",)) )
     def sort_atoms( self ) :
         if self.verbose :
             sys.stdout.write( "%s.sort_atoms()\n" % (self.__class__.__name__,) )
@@ -0,0 +1,183 @@
+#!/usr/bin/python -u
+#
+# on-disk cache of loaded mmCIF databases.
+#
+# Cache files are sqlite3 databases named after the sha1 of the input file, the DDL script,
+# and the loader options that change what's in the database (allow-list, lazy schema).
+# Least recently used files are deleted when the cache grows over maxsize.
+#
+
+from __future__ import absolute_import
+
+import sys
+import os
+import hashlib
+import sqlite3
+import tempfile
+
+class CifCache( object ) :
+
+    SUFFIX = ".sqlt3"
+
+# default max. cache size, MB
+#
+    MAX_SIZE = 1024
+
+    _dir = None
+    _maxsize = None
+    _verbose = False
+
+    #
+    #
+    def __init__( self, directory, maxsize = None, verbose = False ) :
+        assert directory is not None
+        self._dir = os.path.realpath( directory )
+        if not os.path.isdir( self._dir ) :
+            os.makedirs( self._dir )
+        if maxsize is None : maxsize = self.MAX_SIZE
+        self._maxsize = int( maxsize ) * 1024 * 1024
+        self._verbose = bool( verbose )
+
+    @property
+    def verbose( self ) :
+        """debugging flag"""
+        return bool( self._verbose )
+    @verbose.setter
+    def verbose( self, flag ) :
+        self._verbose = bool( flag )
+
+    @property
+    def directory( self ) :
+        return self._dir
+
+    # sha1 of file contents
+    #
+    @staticmethod
+    def _hash_file( filename, digest ) :
+        with open( filename, "rb" ) as f :
+            while True :
+                buf = f.read( 1048576 )
+                if not buf : break
+                digest.update( buf )
+
+    # cache key for input file, DDL script, and loader options
+    #
+    def key( self, infile, ddlscript = None, tables = None, lazy = False ) :
+        h = hashlib.sha1()
+        self._hash_file( os.path.realpath( infile ), h )
+        h.update( "\0" )
+        if ddlscript is not None :
+            self._hash_file( os.path.realpath( ddlscript ), h )
+        h.update( "\0" )
+        if tables is not None :
+            h.update( ",".join( sorted( tables ) ) )
+        h.update( "\0" )
+        h.update( lazy and "lazy" or "full" )
+        return h.hexdigest()
+
+    def _filename( self, key ) :
+        return os.path.join( self._dir, key + self.SUFFIX )
+
+    # copy cached database into a new in-memory connection.
+    # returns None on cache miss.
+    #
+    def load( self, key ) :
+        fname = self._filename( key )
+        if not os.path.exists( fname ) :
+            if self._verbose :
+                sys.stdout.write( "%s.load(): cache miss %s\n" % (self.__class__.__name__,key,) )
+            return None
+
+        if self._verbose :
+            sys.stdout.write( "%s.load(): %s\n" % (self.__class__.__name__,fname,) )
+
+        conn = sqlite3.connect( ":memory:" )
+        try :
+            conn.execute( "attach database ? as cache", (fname,) )
+            tables = []
+            for row in conn.execute( "select name,sql from cache.sqlite_master where type='table'" ) :
+                tables.append( row )
+            for (name, sql) in tables :
+                conn.execute( sql )
+                conn.execute( 'insert into main."%s" select * from cache."%s"' % (name,name) )
+            conn.commit()
+            conn.execute( "detach database cache" )
+        except sqlite3.DatabaseError :
+            sys.stderr.write( "Bad cache file %s, removing\n" % (fname,) )
+            conn.close()
+            os.unlink( fname )
+            return None
+
+# LRU: mtime is "last used"
+#
+        os.utime( fname, None )
+        return conn
+
+    # copy database into cache file
+    #
+    def store( self, key, connection ) :
+        assert isinstance( connection, sqlite3.Connection )
+        fname = self._filename( key )
+        if os.path.exists( fname ) : return
+
+        (fd, tmpname) = tempfile.mkstemp( suffix = self.SUFFIX, dir = self._dir )
+        os.close( fd )
+
+        if self._verbose :
+            sys.stdout.write( "%s.store(): %s\n" % (self.__class__.__name__,fname,) )
+
+        tables = []
+        for row in connection.execute( "select name from main.sqlite_master where type='table'" ) :
+            tables.append( row[0] )
+
+# temp file has cache suffix: don't leave it there if copying fails, evict() would count it
+#
+        try :
+            connection.commit()
+            connection.execute( "attach database ? as cache", (tmpname,) )
+            try :
+                for name in tables :
+                    cols = []
+                    for row in connection.execute( 'pragma main.table_info("%s")' % (name,) ) :
+                        cols.append( '"%s" %s' % (row[1],row[2]) )
+                    connection.execute( 'create table cache."%s" (%s)' % (name,",".join( cols )) )
+                    connection.execute( 'insert into cache."%s" select * from main."%s"' % (name,name) )
+                connection.commit()
+            finally :
+                connection.execute( "detach database cache" )
+            os.rename( tmpname, fname )
+        except :
+            if os.path.exists( tmpname ) :
+                os.unlink( tmpname )
+            raise
+
+        self.evict()
+
+    # delete least recently used files until cache size is under the limit
+    #
+    def evict( self ) :
+        files = []
+        total = 0
+        for f in os.listdir( self._dir ) :
+            if not f.endswith( self.SUFFIX ) : continue
+            fname = os.path.join( self._dir, f )
+            st = os.stat( fname )
+            files.append( (st.st_mtime, st.st_size, fname) )
+            total += st.st_size
+
+        files.sort()
+        while (total > self._maxsize) and (len( files ) > 1) :
+            (mtime, size, fname) = files.pop( 0 )
+            if self._verbose :
+                sys.stdout.write( "%s.evict(): %s\n" % (self.__class__.__name__,fname,) )
+            os.unlink( fname )
+            total -= size
+
+#
+#
+if __name__ == "__main__" :
+    sys.stdout.write( "Move along\n" )
+
+#
+# eof
+#
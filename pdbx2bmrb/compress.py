@@ -0,0 +1,72 @@
+#!/usr/bin/python -u
+#
+# open plain, gzip'ed, or bzip2'ed input file.
+# OneDep exchange files come gzip'ed, this reads them without unpacking to disk first.
+#
+# create_file() is the other way around: output file, compressed by file extension,
+# "-" for stdout.
+#
+
+from __future__ import absolute_import
+
+import sys
+import os
+import gzip
+import bz2
+
+GZIP_MAGIC = "\x1f\x8b"
+BZIP2_MAGIC = "BZh"
+
+# compression is detected by magic number, not file extension
+# returns file-like object: it has read() and readline() and can be iterated over
+# and used in with statement.
+#
+def open_file( filename ) :
+    fname = os.path.realpath( filename )
+    with open( fname, "rb" ) as f :
+        magic = f.read( 3 )
+    if magic[:2] == GZIP_MAGIC :
+        return gzip.GzipFile( fname, "rb" )
+    if magic == BZIP2_MAGIC :
+        return bz2.BZ2File( fname, "rb" )
+    return open( fname, "rb" )
+
+# stdout that doesn't get closed at the end of with statement
+#
+class _StdOut( object ) :
+    def write( self, data ) :
+        sys.stdout.write( data )
+    def flush( self ) :
+        sys.stdout.flush()
+    def close( self ) :
+        sys.stdout.flush()
+    def __enter__( self ) :
+        return self
+    def __exit__( self, *args ) :
+        self.close()
+        return False
+
+# output can't be sniffed so compression is by file extension: .gz or .bz2
+# returns file-like object with write() that can be used in with statement.
+#
+def create_file( filename ) :
+    if filename == "-" :
+        return _StdOut()
+    fname = os.path.realpath( filename )
+    ext = os.path.splitext( fname )[1].lower()
+    if ext == ".gz" :
+        return gzip.GzipFile( fname, "wb" )
+    if ext == ".bz2" :
+        return bz2.BZ2File( fname, "wb" )
+    return open( fname, "wb" )
+
+#
+#
+if __name__ == "__main__" :
+    with open_file( sys.argv[1] ) as f :
+        for line in f :
+            sys.stdout.write( line )
+
+#
+# eof
+#
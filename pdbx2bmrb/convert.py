@@ -5,16 +5,180 @@
 from __future__ import absolute_import
 import sys
 import os
-import re
 import sqlite3
 import ConfigParser
 import pprint
+import collections
 import psycopg2
 
 _UP = os.path.realpath( "%s/../" % (os.path.split( __file__ )[0],) )
 sys.path.append( _UP )
 import pdbx2bmrb
 
+###############################################################################################
+# rows of the temp source table without the temp table: same as "select * from temp_source_table".
+#  iterate over it for row tuples, description is like cursor.description,
+#  index is { column : position } and dicts() yields rows as { column : value } without rownum.
+# Values are text, as they'd come out of the temp table.
+# Rows come from an iterator (source cursors, see OneDepToBmrb.source_rows()): they can be read only once.
+#
+class SourceRows( object ) :
+
+    _cols = None
+    _rows = None
+    description = None
+    index = None
+
+    # column names are str like in cursor.description
+    #
+    def __init__( self, columns, rows ) :
+        self._cols = tuple( str( c ) for c in columns )
+        self._rows = iter( rows )
+        self.description = tuple( (c, None, None, None, None, None, None) for c in self._cols )
+        self.index = dict( (self._cols[i], i) for i in range( len( self._cols ) ) )
+
+    # rows of "select * from temp_source_table"
+    #
+    @classmethod
+    def from_temp_table( cls, conn ) :
+        assert isinstance( conn, sqlite3.Connection )
+        curs = conn.execute( "select * from " + pdbx2bmrb.TEMP_TABLE_NAME )
+        cols = [d[0] for d in curs.description]
+        return cls( cols, cls._fetch( curs ) )
+
+    @staticmethod
+    def _fetch( curs ) :
+        try :
+            for row in curs :
+                yield row
+        finally :
+            curs.close()
+
+    @property
+    def columns( self ) :
+        return self._cols
+
+    @staticmethod
+    def _text( value ) :
+        if (value is None) or isinstance( value, unicode ) : return value
+        if isinstance( value, str ) : return value.decode( "utf-8" )
+        return unicode( value )
+
+    def __iter__( self ) :
+        key = self.index.get( pdbx2bmrb.TEMP_KEY_COL_NAME )
+        for row in self._rows :
+            vals = [self._text( v ) for v in row]
+            if key is not None : vals[key] = row[key]
+            yield tuple( vals )
+
+    def dicts( self ) :
+        for row in self :
+            rc = {}
+            for i in range( len( self._cols ) ) :
+                if self._cols[i] == pdbx2bmrb.TEMP_KEY_COL_NAME : continue
+                rc[self._cols[i]] = row[i]
+            yield rc
+
+###############################################################################################
+# map_table() results for natural/experimental source: OneDepToBmrb.map_natural_source() and
+# map_experimental_source() are called for every distinct _entity.src_method, in both branches.
+#
+# Tag map rows are kept per (bmrb_table, pdbx_table) for as long as the tag map connection is the same.
+# Column counts are kept per (bmrb_table, pdbx_table, method) with CifReader.generation, so they are
+# good until the CIF database changes; readers loaded through CifCache from the same file share them.
+# Tables are rebuilt from the saved rows and counts on every get(): callers change them.
+#
+class SourceMapCache( object ) :
+
+    _mapdb = None
+    _rows = None
+    _counts = None
+    _maxsize = 0
+    hits = 0
+    misses = 0
+
+    #
+    #
+    def __init__( self, maxsize = 64 ) :
+        self._rows = {}
+        self._counts = collections.OrderedDict()
+        self._maxsize = int( maxsize )
+
+    def __len__( self ) :
+        return len( self._counts )
+
+    def clear( self ) :
+        self._mapdb = None
+        self._rows.clear()
+        self._counts.clear()
+        self.hits = 0
+        self.misses = 0
+
+    # tag map rows: (bmrb_col,pdbx_table,pdbx_col,func,spec)
+    #
+    def tagmap_rows( self, mapdb, bmrb_table, pdbx_table, verbose = False ) :
+        assert isinstance( mapdb, sqlite3.Connection )
+        if mapdb is not self._mapdb :
+            self._rows.clear()
+            self._mapdb = mapdb
+        key = (bmrb_table, pdbx_table)
+        if not key in self._rows :
+            sql = "select bmrb_col,pdbx_table,pdbx_col,func,spec from tagmap where bmrb_table=:bt and pdbx_table=:pt"
+            params = { "bt" : bmrb_table, "pt" : pdbx_table }
+            if verbose :
+                sys.stdout.write( sql + "\n" )
+                pprint.pprint( params )
+            self._rows[key] = mapdb.execute( sql, params ).fetchall()
+        return self._rows[key]
+
+    # StarTable for bmrb_table from pdbx_table, same as map_table() would return
+    #
+    def get( self, cifdb, mapdb, bmrb_table, pdbx_table, method, verbose = False ) :
+        assert isinstance( cifdb, pdbx2bmrb.CifReader )
+        rows = self.tagmap_rows( mapdb, bmrb_table, pdbx_table, verbose = verbose )
+        key = (bmrb_table, pdbx_table, method)
+        gen = cifdb.generation
+        entry = self._counts.get( key )
+        if (entry is None) or (entry[0] != gen) :
+            self.misses += 1
+            stats = _ColumnStats( cifdb )
+            cifcurs = cifdb.connection.cursor()
+            rc = OneDepToBmrb.map_rows( cifcurs, bmrb_table, rows = rows, cifdb = stats, verbose = verbose )
+            cifcurs.close()
+            self._counts.pop( key, None )
+            self._counts[key] = (gen, stats.counts)
+            while len( self._counts ) > self._maxsize :
+                self._counts.popitem( last = False )
+            return rc
+
+        self.hits += 1
+        if verbose : sys.stdout.write( "source map cache hit: %s/%s/%s\n" % key )
+        cifcurs = cifdb.connection.cursor()
+        rc = OneDepToBmrb.map_rows( cifcurs, bmrb_table, rows = rows, cifdb = _ColumnStats( None, entry[1] ),
+                verbose = verbose )
+        cifcurs.close()
+        return rc
+
+# CifReader.column_stats() that remembers what it returned, or replays saved counts
+#
+class _ColumnStats( object ) :
+
+    _cifdb = None
+    counts = None
+
+    def __init__( self, cifdb, counts = None ) :
+        self._cifdb = cifdb
+        if counts is None : self.counts = {}
+        else : self.counts = counts
+
+    def column_stats( self, table, column ) :
+        key = (table, column)
+        if not key in self.counts :
+            self.counts[key] = self._cifdb.column_stats( table, column )
+        return self.counts[key]
+
+SOURCE_MAPS = SourceMapCache()
+
 ###############################################################################################
 # namespace wrapper for the 20171006 update
 #
@@ -38,8 +202,11 @@ class OneDepToBmrb( object ) :
     #  and we can't do a join without keys.
     # this puts the temporary table in the same db as source tables.
     #
+    # Rows come from source_rows() and are inserted with one executemany() as they're read.
+    # (benchmark.py has the original version that does an update per value, it makes the same table.)
+    #
     @staticmethod
-    def make_source_table( conn, startable, verbose = False ) :
+    def make_source_table( conn, startable, cifdb = None, verbose = False ) :
 
         if verbose :
             sys.stdout.write( "pdbx2bmrb.OneDepToBmrb.make_source_table()\n" )
@@ -47,12 +214,16 @@ class OneDepToBmrb( object ) :
         assert isinstance( conn, sqlite3.Connection )
         assert isinstance( startable, pdbx2bmrb.StarTable )
 
+        cols = OneDepToBmrb.source_columns( startable )
+
+# table first: sqlite won't drop a table while source cursors are open
+#
         curs = conn.cursor()
         sql = "drop table if exists " + pdbx2bmrb.TEMP_TABLE_NAME
         curs.execute( sql )
 
         colstr = pdbx2bmrb.TEMP_KEY_COL_NAME + " integer primary key,"
-        for col in startable.cols.keys() :
+        for col in cols[1:] :
             colstr += '"%s" text,' % (col,)
         colstr = colstr[:-1]
 
@@ -61,20 +232,61 @@ class OneDepToBmrb( object ) :
             sys.stdout.write( sql + "\n" )
         curs.execute( sql )
 
+        (cols, rows) = OneDepToBmrb.source_rows( conn, startable, cifdb = cifdb, verbose = verbose )
+        sql = "insert into %s values (%s)" % (pdbx2bmrb.TEMP_TABLE_NAME, ",".join( "?" for c in cols ))
+        curs.executemany( sql, rows )
+        if verbose :
+            sys.stdout.write( "%s: %d rows\n" % (sql, curs.rowcount) )
+
+        conn.commit()
+        curs.close()
+
+    ########################################################
+    # same rows as make_source_table() and "select * from temp_source_table" but without the table:
+    # returns SourceRows. For saveframe builders.
+    #
+    @staticmethod
+    def iter_source_rows( conn, startable, cifdb = None, verbose = False ) :
+
+        if verbose :
+            sys.stdout.write( "pdbx2bmrb.OneDepToBmrb.iter_source_rows()\n" )
+
+        (cols, rows) = OneDepToBmrb.source_rows( conn, startable, cifdb = cifdb, verbose = verbose )
+        return SourceRows( cols, rows )
+
+    ########################################################
+    # columns of the temporary table: TEMP_KEY_COL_NAME, then NMR-STAR columns
+    #
+    @staticmethod
+    def source_columns( startable ) :
+        return [pdbx2bmrb.TEMP_KEY_COL_NAME] + list( startable.cols.keys() )
+
+    ########################################################
+    # rows of the temporary table: (columns, rows)
+    #  first column is TEMP_KEY_COL_NAME, rows is an iterator over tuples in rownum order.
+    # Each source column is read through its own cursor (or from the columnar atom_site store) and the
+    # rows are zipped together as they are read. Copied columns are streamed, other transform codes
+    # (see transforms.py) get the whole column.
+    # Inserted into the temp table the result is what the original update-per-value version left there
+    # (numbers become text by column affinity), see benchmark.py.
+    #
+    @staticmethod
+    def source_rows( conn, startable, cifdb = None, verbose = False ) :
+
+        if verbose :
+            sys.stdout.write( "pdbx2bmrb.OneDepToBmrb.source_rows()\n" )
+
+        assert isinstance( conn, sqlite3.Connection )
+        assert isinstance( startable, pdbx2bmrb.StarTable )
+
+        cols = OneDepToBmrb.source_columns( startable )
+
         startable.sanitize()
 
-# ideally I want the same number of values in all rows. Not gonna happen IRL.
-# the flip side is "fallback" mappings where 100 chem comp names can map to 1 entity name
-#  (but only when there's no suitable name entity). Hopefully they're all code 1001...
-#
-# relly need to fix this: take the ID col or the 1st col
-# then take the 1st pdbcol and ignore the rest. hope startable.sanitize() sorted them right.
+# number of rows: from the ID col or the 1st col, 1st pdbcol: "really need to fix this" in the original
 #
         col = None
         for c in startable.cols.keys() :
-            if verbose :
-                sys.stdout.write( ">> col:\n" )
-                pprint.pprint( c )
             if col is None : col = startable.cols[c]
             if c == "ID" :
                 col = startable.cols[c]
@@ -82,214 +294,67 @@ class OneDepToBmrb( object ) :
         if col is None :
             raise Exception( "No columns for table %s" % (startable.table,) )
 
-        pdbcols = col.pdbcols
-        for pdbcol in pdbcols.keys() :
-            pc = pdbcols[pdbcol]
-
-            if verbose : pprint.pprint( pc )
-
+        numrows = 0
+        for pdbcol in col.pdbcols.keys() :
+            pc = col.pdbcols[pdbcol]
             if pc.numvals < 1 :
                 raise Exception( "No values in the source tag _%s.%s: %d, was %d" % (pc.table,pc.col,pc.numvals,pc.numrows) )
-
-# now use row number as the key :
-#  in sqlite "integer primary key" is an autoincrement by default
-#
-
-            for i in range( pc.numvals ) :
-                sql = "insert into " + pdbx2bmrb.TEMP_TABLE_NAME + " (rownum) values (:num)"
-                if verbose : sys.stdout.write( "%s: %s\n" % (sql, str( i )) )
-                curs.execute( sql, { "num" : i } )
+            numrows = pc.numvals
             break
 
-        params = {}
-        curs2 = conn.cursor()
-        for c in startable.cols.keys() :
-            pdbcols = startable.cols[c].pdbcols
-            for pdbcol in pdbcols.keys() :
-                pc = pdbcols[pdbcol]
-                m = pc._badpat.search( pc.table )
-                if m : tbl = '"%s"' % (pc.table,)
-                else : tbl = pc.table
-                m = pc._badpat.search( pc.table )
-                if m : col = '"%s"' % (pc.col,)
-                else : col = pc.col
-
-                qry = "select " + col + " from " + tbl
-
-                if verbose : sys.stdout.write( qry + "\n" )
-
-                curs.execute( qry )
-                rownum = 0
-                while True :
-                    params.clear()
-                    row = curs.fetchone()
-                    if verbose : pprint.pprint( row )
-                    if row is None : break
-
-                    if verbose : pprint.pprint( str( row ), indent = 4 )
-
-
-# cif reader does not insert null values, only values here should be real data
-#
-                    sql = 'update %s set "%s"=:val where rownum=:row' % (pdbx2bmrb.TEMP_TABLE_NAME,c)
-                    params["val"] = row[0]
-                    params["row"] = rownum
-                    rownum += 1
-
-# the big ugly switch
-#  codes are in the nmr-star dictionary
-#
-                    if pc.code == 2 :   # don't overwrite
-                        sql += ' and "%s" is null' % (c,)
-
-                    elif pc.code in (3, 4) :   # don't seem to do anything in Steve's code
-                        pass
-
-                    elif pc.code == 5 : # use source row number counting from 1
-                                        # e.g. a rows of mmcif table to an nmr-star saveframe id
-                        params["val"] = rownum + 1
-
-                    elif pc.code in (6, 7, 8) : # no idea what it's supposed to do but only code 7 exists and
-                                                # only in some chem_comp tables where mapping is one-to-one anyway
-                                                # probably a dictionary problem
-                        pass
-
-                    elif pc.code == 9 :         # use value from cd.special unless it's a special exception
-                        pdbtag = "_%s.%s" % (pc.table, pc.col)
-                        sys.stdout.write( "!!! %s : code 9, %s\n" % (pdbtag, startable.cols[c].getspecial( pdbtag )) )
-                        params["val"] = pc.special
-
-                    elif pc.code == 10 :        # boolean values: normalize to yes/no
-                        if (str( row[0] ).strip().lower() in ("y","yes","t","true","1")) :
-                            params["val"] = "yes"
-                        else : params["val"] = "no"
-
-                    elif pc.code == 11 :        # append to existing value
-                        params["val"] += " " + row[0]
-
-                    elif pc.code == 12 :        # prepend to existing value
-                        params["val"] = row[0] + " " + params["val"]
-
-# codes not in current tag map:
-#
-# 15: name combining for bmrb -> pdbx
-# 20, 21, 22, 23: I think those were for variables (temperature, pressure) for bmrb->pdbx
-# 30: for converting bmrb sample to pdbx
-# 55: replace in: "not applicable" with out: "?"
-#
-
-# asym ID to number: "A"-> 1, "B" -> 2, etc.
-# PDB uses A-Z then a-z then they go to 2-letter IDs. 
-# single-letter ids go to 52
-#
-# gotta be ascii of course
-#
-                    elif pc.code == 45 :
-                        chars = str( params["val"] ).strip()
-                        value = 0
-                        for char in chars :
-                            x = ord( char )
-                            if (x > 64) and (x < 91) :
-                                value += (x - 64)
-                            elif (x > 96) and (x < 123) :
-                                value += (x - 70)
-                            else :
-                                raise Exception( "can't map %s to number in asym id %s" % (c,chars,) )
-                        if value == 0 :
-                            raise Exception( "don't know how to convert asym id %s" % (str( params["val"] ),) )
-                        params["val"] = value
-
-                    elif pc.code == 50 :        # insert "1" -- it's a local id of a unique saveframe
-                        params["val"] = 1       # should never happen: there's special handling for special tags
-
-                    elif pc.code == -15 :       # name splitting for pdbx->bmrb. supposed to be:
-                                                # last, given, middle initial, could be e.g. Doe, J.A.
-                                                # A name could be e.g. Jar-Jar or St. Clair 
-                                                # can't parse the latter nor J.-J. or e.g. Jones III
-                        m = re.search( r"^([A-Za-z\-. ]+),\s*([A-Za-z\-]+\.?)\s*([A-Za-z.]*)$", params["val"] )
-                        if not m :
-#                        raise Exception( "name '%s' doesn't match regex" % (params["val"],) )
-# stuff everything in the last name
-#
-                            if c.lower() == "family_name" : params["val"]
-                            elif c.lower() == "family_title" : params["val"] = None
-                            elif c.lower() == "first_initial" : params["val"] = None
-                            elif c.lower() == "given_name" : params["val"] = None
-                            elif c.lower() == "middle_initials" : params["val"] = None
-                        else :
-                            if c.lower() == "family_name" : params["val"] = m.group( 1 )
-                            elif c.lower() == "family_title" : params["val"] = None
-                            elif c.lower() == "first_initial" : params["val"] = m.group( 2 )[0] + "."
-                            elif c.lower() == "given_name" : params["val"] = m.group( 2 )
-                            elif c.lower() == "middle_initials" :
-                                if len( m.group( 3 ) ) > 0 : params["val"] = m.group( 3 )
-                                else : params["val"] = None
-
-                    elif pc.code == -40 :       # split string on commas: for _struct.keywords but br0ken in the dictionary
-#
-# if this gets fixed: add new row foreach substring and hope it's a single-column table
-#
-                        raise Exception( "Not implemented: code -40 for %s: %s" % (c,params["val"],) )
-
-                    elif pc.code == -20 :       # no idea, probably flip side of 20..23
-                                                # not used in the dictionary
-                        raise Exception( "Not implemented: code -20 for %s: %s" % (c,params["val"],) )
-
-
-                    elif pc.code == -22 :       # flip side of codes 20..23: e.g.
-                                                # _pdbx_nmr_exptl_sample_conditions.pH -> Sample_condition_variable(Type="pH",Val,Unit="pH").
-                                                # has to be done separately as we fill 2-3 target columns at once
-
-# except for the exceptions: concentration range is supposed to be $NUM-$NUM
-#
-                        if (pc.table == "pdbx_nmr_exptl_sample") and (pc.col == "concentration_range") :
-                            if params["val"] is None : continue
-                            m = re.search( "^(.+)\s*-\s*(.+)$", params["val"].strip() )
-                            if not m : 
-#                                sys.stdout.write( "!! _pdbx_nmr_exptl_sample.concentration_range: no match\n" ) 
-                                continue
-#                            sys.stdout.write( "!! the column is %s and max/min are %s, %s\n" % (c,m.group( 2 ),m.group( 1 )) ) 
-                            if c == "Concentration_val_max" : params["val"] = m.group( 2 ).strip()
-                            elif c == "Concentration_val_min" : params["val"] = m.group( 1 ).strip()
-#                        continue
-
-                    elif abs( pc.code ) == 1001 :    # marks chem_comp tags (many rows) mapped to entity and assembly (few rows) tags.
-                                                    # that's really messing things up and usually they're "fallback" mappings that aren't used.
-                                                    # they should get filtered out elsewhere (TODO: see if that breaks ligands)
-                        continue
-
-                    if verbose :
-                        pprint.pprint( sql )
-                        pprint.pprint( params )
-                    try :
-                        curs2.execute( sql, params )
-                    except sqlite3.OperationalError :
-                        pprint.pprint( startable )
-                        pprint.pprint( sql )
-                        pprint.pprint( params )
-                        raise
-
-#    qry = "select * from " + pdbx2bmrb.TEMP_TABLE_NAME
-#    curs.execute( qry )
-#    for c in curs.description :
-#        print c[0],
-#    print
-#    while True :
-#        row = curs.fetchone()
-#        if row is None : break
-#        print row
-
-        conn.commit()
-        curs2.close()
-        curs.close()
+        return (cols, OneDepToBmrb._zip_rows( conn, startable, cols, numrows, cifdb = cifdb, verbose = verbose ))
 
+    # source_rows() generator. Cursors are opened on the first row and closed when it's done
+    # or thrown away.
+    #
+    @staticmethod
+    def _zip_rows( conn, startable, cols, numrows, cifdb = None, verbose = False ) :
+        cursors = []
+        sources = []
+        try :
+            for idx in range( 1, len( cols ) ) :
+                c = cols[idx]
+                pdbcols = startable.cols[c].pdbcols
+                for pdbcol in pdbcols.keys() :
+                    pc = pdbcols[pdbcol]
+                    qry = "select " + pc.dbcol + " from " + pc.dbtable
+
+                    if verbose : sys.stdout.write( qry + "\n" )
+
+                    if (cifdb is not None) and cifdb.has_columns( pc.table ) :
+                        values = cifdb.coords.values( pc.col )
+                    else :
+                        curs = conn.execute( qry )
+                        cursors.append( curs )
+                        values = (row[0] for row in curs)
+
+                    values = pdbx2bmrb.TRANSFORMS.iterate( pc.code, values, startable, c, pc )
+                    sources.append( (idx, values, pdbx2bmrb.TRANSFORMS.overwrites( pc.code )) )
+
+# "update ... where rownum=:row": there may be more or fewer source rows than temp table rows,
+# later tags overwrite earlier ones in the same column
+#
+            for row in range( numrows ) :
+                vals = [row] + [None] * (len( cols ) - 1)
+                for (idx, values, overwrite) in sources :
+                    val = next( values, pdbx2bmrb.SKIP )
+                    if val is pdbx2bmrb.SKIP : continue
+                    if (not overwrite) and (vals[idx] is not None) : continue
+                    vals[idx] = val
+                yield tuple( vals )
+
+        finally :
+            for (idx, values, overwrite) in sources :
+                if hasattr( values, "close" ) : values.close()
+            for curs in cursors :
+                curs.close()
 
     # map a single pdbx table to nmr-star
     # returns a map of cif col -> star col w/ transform codes etc.
     # @see StarTable & StarCol
     #
     @staticmethod
-    def map_table( cifcurs, mapcurs, table, sql, params, verbose = False ) :
+    def map_table( cifcurs, mapcurs, table, sql, params, cifdb = None, verbose = False ) :
 
         if verbose : sys.stdout.write( "OneDepToBmrb.map_table(%s,%s)\n" % (table,sql,) )
 
@@ -298,8 +363,6 @@ class OneDepToBmrb( object ) :
         assert table is not None
         assert sql is not None
 
-        cols = pdbx2bmrb.StarTable( table )
-
         if params is None :
             if verbose : sys.stdout.write( sql + "\n" )
             mapcurs.execute( sql )
@@ -310,10 +373,20 @@ class OneDepToBmrb( object ) :
                 pprint.pprint( params )
             mapcurs.execute( sql, params )
 
-        while True :
+        return OneDepToBmrb.map_rows( cifcurs, table, rows = iter( mapcurs.fetchone, None ), cifdb = cifdb,
+                verbose = verbose )
 
-            row = mapcurs.fetchone()
-            if row is None : break
+    # same as map_table() for tag map rows: (bmrb_col,pdbx_table,pdbx_col,func,spec)
+    #
+    @staticmethod
+    def map_rows( cifcurs, table, rows, cifdb = None, verbose = False ) :
+
+        assert isinstance( cifcurs, sqlite3.Cursor )
+        assert table is not None
+
+        cols = pdbx2bmrb.StarTable( table )
+
+        for row in rows :
 
             if verbose : pprint.pprint( row )
 
@@ -327,7 +400,7 @@ class OneDepToBmrb( object ) :
 
             cif.special = pdbx2bmrb.sanitize( row[4] )
 
-            cif.count_rows( cifcurs )
+            cif.count_rows( cifcurs, cifdb = cifdb )
 
 # no values: nothing to map from this column
 #
@@ -349,10 +422,25 @@ class OneDepToBmrb( object ) :
 
         return cols
 
+    # tag map as { bmrb_table : [(bmrb_col,pdbx_table,pdbx_col,func,spec), ...] }
+    # rows are in tag map order
     #
+    @staticmethod
+    def tagmap_index( mapdb ) :
+        assert isinstance( mapdb, sqlite3.Connection )
+        rc = {}
+        sql = "select bmrb_table,bmrb_col,pdbx_table,pdbx_col,func,spec from tagmap order by rowid"
+        for row in mapdb.execute( sql ) :
+            if not row[0] in rc : rc[row[0]] = []
+            rc[row[0]].append( tuple( row[1:] ) )
+        return rc
+
+    # tables are mapped in dictionary order, but only ones that have tag map rows and
+    # source tables with data.
+    # if counts is a dict, it gets number of dictionary tables, mapped, and skipped ones
     #
     @classmethod
-    def map_tables( cls, cifdb, mapdb, stardb, verbose = False ) :
+    def map_tables( cls, cifdb, mapdb, stardb, counts = None, verbose = False ) :
 
         if verbose : sys.stdout.write( "%s.map_tables" % (cls.__name__) )
 
@@ -360,28 +448,48 @@ class OneDepToBmrb( object ) :
         assert isinstance( mapdb, sqlite3.Connection )
         assert isinstance( stardb, pdbx2bmrb.BMRBEntry )
 
+        index = cls.tagmap_index( mapdb )
         cifcurs = cifdb.connection.cursor()
-        mapcurs = mapdb.cursor()
+
+        if counts is None : counts = {}
+        for key in ("tables", "no_mapping", "no_data", "mapped") :
+            counts[key] = 0
 
         rc = []
         for table in stardb._dic.iter_tables() :
 
+            counts["tables"] += 1
+            if not table in index :
+                counts["no_mapping"] += 1
+                continue
+
             if verbose : sys.stdout.write( table + "\n" )
 
-            sql = "select bmrb_col,pdbx_table,pdbx_col,func,spec from tagmap where bmrb_table=:tbl"
-            params = { "tbl" : table }
-            cols = cls.map_table( cifcurs, mapcurs, table = table, sql = sql, params = params, verbose = verbose )
+            rows = index[table]
+            if not any( (cifdb.table_rows( r[1] ) > 0) for r in rows ) :
+                counts["no_data"] += 1
+                continue
+
+            cols = cls.map_rows( cifcurs, table, rows = rows, cifdb = cifdb, verbose = verbose )
 
 # no columns: nothing to map for this table
 #
             if cols is None : continue
+            counts["mapped"] += 1
             rc.append( cols )
 
-        mapcurs.close()
         cifcurs.close()
         return rc
 
     ################################################################
+    # pdbx source table for entity production method, "man" is the default
+    #
+    @staticmethod
+    def source_table( method ) :
+        if method == "nat" : return "entity_src_nat"
+        if method == "syn" : return "pdbx_entity_src_syn"
+        return "entity_src_gen"
+
     # custom version of map_tables based on entity production method
     # @see __main__.py for long explanation
     #
@@ -393,21 +501,8 @@ class OneDepToBmrb( object ) :
         assert isinstance( cifdb, pdbx2bmrb.CifReader )
         assert isinstance( mapdb, sqlite3.Connection )
 
-        cifcurs = cifdb.connection.cursor()
-        mapcurs = mapdb.cursor()
-
-        sql = "select bmrb_col,pdbx_table,pdbx_col,func,spec from tagmap where bmrb_table=:bt and pdbx_table=:pt"
-        params = { "bt" : "Entity_natural_src" }
-
-# "man" is the default
-#
-        if method == "nat" : params["pt"] = "entity_src_nat"
-        elif method == "syn" : params["pt"] = "pdbx_entity_src_syn"
-        else : params["pt"] = "entity_src_gen"
-
-        rc = cls.map_table( cifcurs, mapcurs, table = params["bt"], sql = sql, params = params, verbose = verbose )
-        mapcurs.close()
-        cifcurs.close()
+        rc = SOURCE_MAPS.get( cifdb, mapdb, "Entity_natural_src", cls.source_table( method ), method,
+                verbose = verbose )
 
 # if entity is something like "zinc ion", it shouldn't have any natural/experimental source
 #
@@ -426,21 +521,8 @@ class OneDepToBmrb( object ) :
         assert isinstance( cifdb, pdbx2bmrb.CifReader )
         assert isinstance( mapdb, sqlite3.Connection )
 
-        cifcurs = cifdb.connection.cursor()
-        mapcurs = mapdb.cursor()
-
-        sql = "select bmrb_col,pdbx_table,pdbx_col,func,spec from tagmap where bmrb_table=:bt and pdbx_table=:pt"
-        params = { "bt" : "Entity_experimental_src" }
-
-# "man" is the default
-#
-        if method == "nat" : params["pt"] = "entity_src_nat"
-        elif method == "syn" : params["pt"] = "pdbx_entity_src_syn"
-        else : params["pt"] = "entity_src_gen"
-
-        rc = cls.map_table( cifcurs, mapcurs, table = params["bt"], sql = sql, params = params, verbose = verbose )
-        mapcurs.close()
-        cifcurs.close()
+        rc = SOURCE_MAPS.get( cifdb, mapdb, "Entity_experimental_src", cls.source_table( method ), method,
+                verbose = verbose )
 
 # if entity is something like "zinc ion", it shouldn't have any natural/experimental source
 #
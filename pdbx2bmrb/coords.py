@@ -0,0 +1,356 @@
+#!/usr/bin/python -u
+#
+# columnar storage for atom_site.
+#
+# atom_site is most of the mmCIF file. Instead of text rows in sqlite, keep it in numpy arrays:
+# integer and decimal columns as numbers, everything else as categorical (codes + list of values).
+# Original text is kept: a column is only stored as numbers if every value formats back the way it was read,
+# so values() returns exactly what sqlite would've.
+#
+# Rows are converted in chunks of CHUNK_SIZE as they're read, so only one chunk is ever kept as
+# Python lists; chunks are joined into one array per column at the end.
+#
+# needs numpy. CifReader falls back to sqlite without it.
+#
+
+from __future__ import absolute_import
+
+import sys
+import itertools
+
+try :
+    import numpy
+except ImportError :
+    numpy = None
+
+# one column
+#  kind is "int", "float", or "str"
+#  mask is True where there is a value
+#  "float" columns also have number of decimals for each value (to print them back)
+#  "str" columns have codes into categories, -1 for no value
+#
+class _Column( object ) :
+
+    kind = None
+    data = None
+    mask = None
+    decimals = None
+    categories = None
+
+    # values is None: empty column for nulls() and concat()
+    #
+    def __init__( self, values = None ) :
+        assert numpy is not None
+        if values is None : return
+        self.mask = numpy.fromiter( (v is not None for v in values), dtype = numpy.bool_, count = len( values ) )
+        if self._to_int( values ) : return
+        if self._to_float( values ) : return
+        self._to_str( values )
+
+    # numrows of no value
+    #
+    @classmethod
+    def nulls( cls, kind, numrows ) :
+        rc = cls()
+        rc.kind = kind
+        rc.mask = numpy.zeros( numrows, dtype = numpy.bool_ )
+        if kind == "str" :
+            rc.data = numpy.full( numrows, -1, dtype = numpy.int32 )
+            rc.categories = []
+        elif kind == "float" :
+            rc.data = numpy.zeros( numrows, dtype = numpy.float64 )
+            rc.decimals = numpy.zeros( numrows, dtype = numpy.int8 )
+        else :
+            rc.data = numpy.zeros( numrows, dtype = numpy.int64 )
+        return rc
+
+    # one column from chunks, in order.
+    # chunks with no values go with any kind. If the rest are different kinds, values are re-read
+    # and converted again (e.g. a column that only has letters in the last chunk).
+    #
+    @classmethod
+    def concat( cls, parts ) :
+        if len( parts ) == 1 : return parts[0]
+        kinds = set( p.kind for p in parts if p.numvals > 0 )
+        if len( kinds ) > 1 :
+            return cls( list( itertools.chain( *parts ) ) )
+        if len( kinds ) < 1 : kind = "int"
+        else : kind = kinds.pop()
+        parts = [(p.kind == kind) and p or cls.nulls( kind, len( p ) ) for p in parts]
+
+        rc = cls()
+        rc.kind = kind
+        rc.mask = numpy.concatenate( [p.mask for p in parts] )
+        if kind == "float" :
+            rc.decimals = numpy.concatenate( [p.decimals for p in parts] )
+        if kind != "str" :
+            rc.data = numpy.concatenate( [p.data for p in parts] )
+            return rc
+
+# categorical: renumber codes. -1 (no value) picks the last element of remap, that's -1 too
+#
+        index = {}
+        rc.categories = []
+        data = []
+        for p in parts :
+            remap = numpy.empty( len( p.categories ) + 1, dtype = numpy.int32 )
+            for i in range( len( p.categories ) ) :
+                code = index.get( p.categories[i] )
+                if code is None :
+                    code = len( rc.categories )
+                    index[p.categories[i]] = code
+                    rc.categories.append( p.categories[i] )
+                remap[i] = code
+            remap[-1] = -1
+            data.append( remap[p.data] )
+        rc.data = numpy.concatenate( data )
+        return rc
+
+    # all values are integers that print back as is
+    #
+    def _to_int( self, values ) :
+        data = numpy.zeros( len( values ), dtype = numpy.int64 )
+        for i in range( len( values ) ) :
+            if values[i] is None : continue
+            try :
+                val = int( values[i] )
+            except ValueError :
+                return False
+            if str( val ) != values[i] : return False
+            if abs( val ) > 9223372036854775807 : return False
+            data[i] = val
+        self.kind = "int"
+        self.data = data
+        return True
+
+    # all values are decimals that print back as is: no exponents, leading zeros, etc.
+    #
+    def _to_float( self, values ) :
+        data = numpy.zeros( len( values ), dtype = numpy.float64 )
+        decimals = numpy.zeros( len( values ), dtype = numpy.int8 )
+        for i in range( len( values ) ) :
+            if values[i] is None : continue
+            pos = values[i].find( "." )
+            if pos < 0 : dec = 0
+            else : dec = len( values[i] ) - pos - 1
+            if dec > 127 : return False
+            try :
+                val = float( values[i] )
+            except ValueError :
+                return False
+            if ("%.*f" % (dec, val)) != values[i] : return False
+            data[i] = val
+            decimals[i] = dec
+        self.kind = "float"
+        self.data = data
+        self.decimals = decimals
+        return True
+
+    # categorical
+    #
+    def _to_str( self, values ) :
+        index = {}
+        self.categories = []
+        data = numpy.empty( len( values ), dtype = numpy.int32 )
+        for i in range( len( values ) ) :
+            if values[i] is None :
+                data[i] = -1
+                continue
+            code = index.get( values[i] )
+            if code is None :
+                code = len( self.categories )
+                index[values[i]] = code
+                self.categories.append( values[i] )
+            data[i] = code
+        self.kind = "str"
+        self.data = data
+
+    def __len__( self ) :
+        return len( self.data )
+
+    # number of non-null values
+    #
+    @property
+    def numvals( self ) :
+        return int( numpy.count_nonzero( self.mask ) )
+
+    # bytes used by arrays and categories
+    #
+    @property
+    def nbytes( self ) :
+        rc = self.data.nbytes + self.mask.nbytes
+        if self.decimals is not None :
+            rc += self.decimals.nbytes
+        if self.categories is not None :
+            for c in self.categories :
+                rc += sys.getsizeof( c )
+        return rc
+
+    # value in row i as text, or None
+    #
+    def value( self, i ) :
+        if not self.mask[i] : return None
+        if self.kind == "int" : return str( self.data[i] )
+        if self.kind == "float" : return "%.*f" % (int( self.decimals[i] ), self.data[i])
+        return self.categories[self.data[i]]
+
+    # same as value() for all rows. tolist() is much faster than indexing numpy arrays one by one
+    #
+    def __iter__( self ) :
+        mask = self.mask.tolist()
+        data = self.data.tolist()
+        if self.kind == "float" :
+            decimals = self.decimals.tolist()
+        for i in range( len( data ) ) :
+            if not mask[i] : yield None
+            elif self.kind == "int" : yield str( data[i] )
+            elif self.kind == "float" : yield "%.*f" % (decimals[i], data[i])
+            else : yield self.categories[data[i]]
+
+#
+#
+class AtomSiteStore( object ) :
+
+    TABLE = "atom_site"
+
+# rows to keep as Python lists before converting them to arrays
+#
+    CHUNK_SIZE = 65536
+
+    _raw = None
+    _rawrows = 0
+    _chunks = None
+    _sizes = None
+    _cols = None
+    _numrows = 0
+    _verbose = False
+
+    #
+    #
+    def __init__( self, verbose = False ) :
+        if numpy is None :
+            raise ImportError( "numpy is required for columnar atom_site" )
+        self._raw = {}
+        self._rawrows = 0
+        self._chunks = {}
+        self._sizes = []
+        self._cols = None
+        self._numrows = 0
+        self._verbose = bool( verbose )
+
+    @property
+    def verbose( self ) :
+        """debugging flag"""
+        return bool( self._verbose )
+    @verbose.setter
+    def verbose( self, flag ) :
+        self._verbose = bool( flag )
+
+    @property
+    def table( self ) :
+        return self.TABLE
+
+    @property
+    def numrows( self ) :
+        return self._numrows
+
+    @property
+    def columns( self ) :
+        if self._cols is not None : return self._cols.keys()
+        return list( set( self._chunks.keys() ).union( self._raw.keys() ) )
+
+    # add a row while reading: dict of column : value
+    # column names may be quoted
+    #
+    def append( self, row ) :
+        assert self._cols is None, "store is frozen"
+        for col in row.keys() :
+            name = col.strip( '"' )
+            if not name in self._raw :
+                self._raw[name] = [None] * self._rawrows
+            self._raw[name].append( row[col] )
+        self._numrows += 1
+        self._rawrows += 1
+        for col in self._raw.keys() :
+            if len( self._raw[col] ) < self._rawrows :
+                self._raw[col].append( None )
+        if self._rawrows >= self.CHUNK_SIZE :
+            self._convert_chunk()
+
+    # lists to arrays. Columns that weren't in this chunk (or earlier ones) get filled with nulls.
+    #
+    def _convert_chunk( self ) :
+        if self._rawrows < 1 : return
+        chunk = len( self._sizes )
+        for col in self._raw.keys() :
+            if not col in self._chunks :
+                self._chunks[col] = [_Column.nulls( "int", n ) for n in self._sizes]
+            self._chunks[col].append( _Column( self._raw[col] ) )
+        for col in self._chunks.keys() :
+            if len( self._chunks[col] ) <= chunk :
+                self._chunks[col].append( _Column.nulls( "int", self._rawrows ) )
+        self._sizes.append( self._rawrows )
+        self._raw = {}
+        self._rawrows = 0
+
+    # done reading: join the chunks
+    #
+    def freeze( self ) :
+        if self._cols is not None : return
+        if self._verbose :
+            sys.stdout.write( "%s.freeze(): %d rows in %d chunks\n" % (self.__class__.__name__,self._numrows,
+                len( self._sizes ) + (self._rawrows > 0 and 1 or 0)) )
+        self._convert_chunk()
+        self._cols = {}
+        for col in self._chunks.keys() :
+            self._cols[col] = _Column.concat( self._chunks[col] )
+        self._chunks = None
+        self._raw = None
+
+    def _column( self, col ) :
+        self.freeze()
+        return self._cols.get( col.strip( '"' ) )
+
+    # (number of rows, number of values) like CifCol.count_rows()
+    #
+    def count( self, col ) :
+        c = self._column( col )
+        if c is None : return (self._numrows, 0)
+        return (self._numrows, c.numvals)
+
+    # column values as text, in row order
+    #
+    def values( self, col ) :
+        c = self._column( col )
+        if c is None :
+            for i in range( self._numrows ) :
+                yield None
+        else :
+            for v in c :
+                yield v
+
+    # [(column, kind, rows, values, bytes)]
+    #
+    def memory_report( self ) :
+        self.freeze()
+        rc = []
+        for col in sorted( self._cols.keys() ) :
+            c = self._cols[col]
+            rc.append( (col, c.kind, len( c ), c.numvals, c.nbytes) )
+        return rc
+
+    def print_memory_report( self, out = sys.stdout ) :
+        total = 0
+        for (col, kind, rows, vals, size) in self.memory_report() :
+            out.write( "%s.%s (%s): %d/%d values, %d bytes\n" % (self.TABLE,col,kind,vals,rows,size) )
+            total += size
+        out.write( "%s: %d rows, %d bytes\n" % (self.TABLE,self._numrows,total) )
+
+#
+#
+if __name__ == "__main__" :
+    sys.stdout.write( "Move along\n" )
+
+#
+# eof
+#
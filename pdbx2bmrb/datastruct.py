@@ -6,18 +6,19 @@
 #
 from __future__ import absolute_import
 import sys
-import re
 import collections
 import pprint
 
+from pdbx2bmrb import tags
+
 # a column from mmcif file.
 # has table name, tag name, transform code, special hangling instructions,
 # and 2 numbers of rows: total and non-nulls
 #
 class CifCol( object ) :
 
-    GOODTAG = r"^_([^.]+)\.(.+)$"
-    BAADTAG = r"(^\d)|(^database$)|(^order$)|(^group$)|([()[\]{}/\\%-])"
+    GOODTAG = tags.TAG_PATTERN
+    BAADTAG = tags.BAD_NAME_PATTERN
 
     table = None
     col = None
@@ -26,20 +27,14 @@ class CifCol( object ) :
     _numrows = None
     _numvals = None
 
-    _tagpat = None
-    _badpat = None
-
     def __init__( self, tag = None, table = None, column = None, code = 0, special = None ) :
 
         assert (tag is not None) or ((table is not None) and (column is not None))
 
-        self._tagpat = re.compile( self.GOODTAG )
-        self._badpat = re.compile( self.BAADTAG )
         if tag is not None :
-            m = self._tagpat.search( tag )
-            if m :
-                self.table = m.group( 1 )
-                self.col = m.group( 2 )
+            m = tags.parse_tag( tag )
+            if m is not None :
+                (self.table, self.col) = m
         else :
             self.table = str( table ).strip()
             if len( self.table ) < 1 : self.table = None
@@ -80,6 +75,16 @@ class CifCol( object ) :
     def tag( self ) :
         return "_" + self.table + "." + self.col
 
+    # table and column names for sql, quoted if needed
+    #
+    @property
+    def dbtable( self ) :
+        return tags.quote_ident( self.table )
+
+    @property
+    def dbcol( self ) :
+        return tags.quote_ident( self.col )
+
     @property
     def numrows( self ) :
         assert self._numrows is not None
@@ -90,13 +95,16 @@ class CifCol( object ) :
         assert self._numvals is not None
         return self._numvals
 
-    def count_rows( self, cursor ) :
+    # if cifdb (CifReader) is there, use its column statistics instead of scanning the column
+    #
+    def count_rows( self, cursor, cifdb = None ) :
+        if cifdb is not None :
+            (self._numrows, self._numvals) = cifdb.column_stats( self.table, self.col )
+            return
+
         self._numrows = 0
         self._numvals = 0
-        dbcolumn = self.col
-        m = self._badpat.search( self.col )
-        if m : dbcolumn = '"%s"' % (self.col,)
-        sql = "select %s from %s" % (dbcolumn, self.table)
+        sql = "select %s from %s" % (self.dbcol, self.dbtable)
 #        print sql
         try :
             cursor.execute( sql )
@@ -7,18 +7,84 @@ import os
 import re
 import pprint
 import sqlite3
+import time
+import collections
+import multiprocessing
+import traceback
+import itertools
 
 _UP = os.path.realpath( "%s/../" % (os.path.split( __file__ )[0],) )
 sys.path.append( _UP )
 from pdbx2bmrb import sas
+from pdbx2bmrb.compress import open_file
+from pdbx2bmrb import coords
+from pdbx2bmrb import profiles
+from pdbx2bmrb import tags
+
+# parsed DDL scripts: { (filename, mtime) : { table : set( columns ) } }
+#
+_CATALOGS = {}
+
+# reader serial numbers, see CifReader.generation
+#
+_SERIAL = itertools.count( 1 )
+
+# entry identifiers found in the file.
+# contacts is a tuple of (name, email) pairs.
+#
+CifIds = collections.namedtuple( "CifIds", ("entryid", "pdbid", "depid", "contacts") )
+
+# result of parsing one file in parse_files()
+#  dbfile is the sqlite database, secs is wall time in the worker,
+#  error is the traceback if it failed (then reader is None)
+#
+ParseResult = collections.namedtuple( "ParseResult", ("infile", "dbfile", "ids", "stats", "colstats", "secs", "error",
+    "reader") )
+
+# stripped string or None
+#
+def _strip( value ) :
+    if value is None : return None
+    rc = str( value ).strip()
+    if len( rc ) < 1 : return None
+    return rc
 
 class CifReader( sas.ContentHandler, sas.ErrorHandler ) :
 
-    TAGNAME= r"^_([^.]+)\.(.+)$"
-    BADNAME = r"(^\d)|(database)|(group)|(order)|([()[\]{}/%-])"
+    TAGNAME= tags.TAG_PATTERN
+    DDLTABLE = r"^\s*create\s+table\s+(\"[^\"]+\"|[^\s(]+)\s*\((.+)\)\s*;\s*$"
+    DDLCOLUMN = r"(\"[^\"]+\"|[^\s,]+)\s+text"
+    BADNAME = tags.BAD_NAME_PATTERN
 
-    _tagpat = None
-    _badpat = None
+# default number of rows to buffer in batched mode, when batch size isn't configured
+#
+    BATCH_SIZE = 5000
+
+# max number of insert statements to keep around
+#
+    STMT_CACHE_SIZE = 32
+
+# lazy schema: placeholder column for tables that aren't in the DDL script
+#
+    TEMP_COL_NAME = "pdbx2bmrb_placeholder"
+
+# entry ID if there isn't a BMRB one in database_2
+#
+    DEFAULT_ENTRY_ID = "converted_from_CD&A"
+
+# tables with identifiers, see CifIds
+#
+    ID_TABLES = ("database_2", "struct", "pdbx_contact_author")
+
+# tables the converter reads directly, not (only) through the tag map.
+# these are always loaded.
+#
+    REQUIRED_TABLES = ( "database_2", "struct", "pdbx_contact_author",
+            "citation", "entity", "chem_comp",
+            "pdbx_nmr_exptl_sample_conditions", "pdbx_nmr_software",
+            "pdbx_nmr_sample_details", "pdbx_nmr_spectrometer",
+            "pdbx_nmr_chem_shift_reference", "pdbx_nmr_assigned_chem_shift_list",
+            "pdbx_nmr_spectral_peak_list" )
 
     _verbose = False
 
@@ -27,18 +93,48 @@ class CifReader( sas.ContentHandler, sas.ErrorHandler ) :
     _rownum = 0
     _row = None
     _firstcol = None
-    _id = None
-    _depid = None
-    _pdbid = None
-
-    #
+    _ids = None
+    _sigcounts = None
+    _colstats = None
+    _colstats_complete = False
+    _idvals = None
+    _contacts = None
+
+    _stmts = None
+    _tables = None
+    _catalog = None
+    _columns = None
+    _batchsize = 0
+    _batch = None
+    _batchcols = None
+    _stats = None
+    _tblstart = None
+    _coords = None
+    _profile = None
+    _settings = None
+    _serial = None
+    _source = None
+    _changes = 0
+
+    # infile may be gzip'ed or bzip2'ed
+    # if tables is not None, only load those tables (and REQUIRED_TABLES)
+    # if lazy is true, tables are created when first seen in the input file.
+    #  Tables that aren't in the file but are queried later need create_tables().
+    # if cache (CifCache) is not None, reuse database loaded from the same file in previous run
+    #  (only when connection is None)
+    # if columnar is true, atom_site goes into AtomSiteStore instead of sqlite (needs numpy).
+    #  Cache only has the sqlite database, so it's not used then.
+    # profile is the name of sqlite connection profile (see profiles.py). If set, the whole file
+    #  is loaded in one explicit transaction.
     #
     @classmethod
-    def parse( cls, infile, connection = None, ddlscript = None, verbose = False ) :
+    def parse( cls, infile, connection = None, ddlscript = None, batchsize = 0, tables = None, lazy = False,
+            cache = None, columnar = False, profile = None, verbose = False ) :
         fname = os.path.realpath( infile )
         if not os.path.exists( fname ) :
             raise IOError( "File not found: %s" % (fname,) )
         script = ddlscript
+        key = None
         if connection is not None :
             assert isinstance( connection, sqlite3.Connection )
         else :
@@ -47,17 +143,47 @@ class CifReader( sas.ContentHandler, sas.ErrorHandler ) :
             if not os.path.exists( script ) :
                 raise IOError( "File not found: %s" % (script,) )
 
+            if (cache is not None) and (not columnar) :
+                key = cache.key( infile = fname, ddlscript = script, tables = tables, lazy = lazy )
+                connection = cache.load( key )
+                if connection is not None :
+                    rdr = cls( connection = connection, batchsize = batchsize, tables = tables, verbose = verbose )
+                    rdr._set_profile( profile )
+                    rdr._source = key
+                    rdr._ids = rdr._query_ids()
+                    if lazy :
+                        rdr._catalog = cls.read_ddl( script )
+                        rdr._read_columns()
+                    return rdr
+
+# page_size has to be set before creating tables
+#
             connection = sqlite3.connect( ":memory:" )
-            sql = ""
-            with open( script, "rb" ) as f :
-                sql = f.read()
-            connection.executescript( sql )
+            if profile is not None :
+                profiles.apply_profile( connection, profile, verbose = verbose )
+            if not lazy :
+                sql = ""
+                with open( script, "rb" ) as f :
+                    sql = f.read()
+                connection.executescript( sql )
+
+        rdr = cls( connection = connection, batchsize = batchsize, tables = tables, columnar = columnar,
+                verbose = verbose )
+        rdr._set_profile( profile )
+        if lazy :
+            if script is None : rdr._catalog = {}
+            else : rdr._catalog = cls.read_ddl( script )
+            rdr._columns = {}
+
+        if profile is None :
+            rdr._read( fname )
+        else :
+            with profiles.transaction( rdr.connection ) :
+                rdr._read( fname )
 
-        rdr = cls( connection = connection, verbose = verbose )
-        with open( infile, "rb" ) as pdbx :
-            l = sas.StarLexer( pdbx )
-            p = sas.CifParser.parse( lexer = l, content_handler = rdr, error_handler = rdr, verbose = verbose )
-            rdr.connection.commit()
+        if key is not None :
+            cache.store( key, rdr.connection )
+            rdr._source = key
 
 #        sql = """select state_province,city,fax,name_first,name_last,name_salutation,country,id,phone,postal_code,
 #address_1,address_2,address_3,role,email,organization_type,name_mi from pdbx_contact_author"""
@@ -72,14 +198,147 @@ class CifReader( sas.ContentHandler, sas.ErrorHandler ) :
 
         return rdr
 
+    # parse several files in a process pool. Each worker loads one file into its own sqlite file in outdir.
+    # returns list of ParseResult in the same order as infiles.
+    # processes is the pool size (default: number of cpus), 1 parses them here one by one.
+    #
+    @classmethod
+    def parse_files( cls, infiles, outdir, ddlscript, processes = None, batchsize = 0, tables = None, lazy = False,
+            profile = None, verbose = False ) :
+        script = os.path.realpath( ddlscript )
+        if not os.path.exists( script ) :
+            raise IOError( "File not found: %s" % (script,) )
+        outdir = os.path.realpath( outdir )
+        if not os.path.isdir( outdir ) :
+            os.makedirs( outdir )
+
+        jobs = []
+        for i in range( len( infiles ) ) :
+            infile = os.path.realpath( infiles[i] )
+            dbfile = os.path.join( outdir, "%d_%s.sqlt3" % (i, os.path.split( infile )[1]) )
+            jobs.append( (infile, dbfile, script, batchsize, tables, lazy, profile) )
+
+        if processes == 1 :
+            results = [_parse_worker( j ) for j in jobs]
+        else :
+            pool = multiprocessing.Pool( processes = processes )
+            try :
+                results = pool.map( _parse_worker, jobs, chunksize = 1 )
+            finally :
+                pool.close()
+                pool.join()
+
+        rc = []
+        for res in results :
+            if res.error is None :
+                res = res._replace( reader = cls.from_database( res.dbfile, ids = res.ids, stats = res.stats,
+                        colstats = res.colstats, verbose = verbose ) )
+            if verbose :
+                if res.error is None :
+                    sys.stdout.write( "%s: %0.3f sec\n" % (res.infile,res.secs) )
+                else :
+                    sys.stdout.write( "%s: failed after %0.3f sec\n%s" % (res.infile,res.secs,res.error) )
+            rc.append( res )
+        return rc
+
+    # reader for database made by parse() with on-disk connection (e.g. parse_files())
+    # pass ids and stats if you have them, otherwise ids are read from the database
+    # and column statistics are counted when needed
+    #
+    @classmethod
+    def from_database( cls, dbfile, ids = None, stats = None, colstats = None, verbose = False ) :
+        fname = os.path.realpath( dbfile )
+        if not os.path.exists( fname ) :
+            raise IOError( "File not found: %s" % (fname,) )
+        rdr = cls( connection = sqlite3.connect( fname ), verbose = verbose )
+        rdr._set_profile( None )
+        if stats is not None :
+            rdr._stats = stats
+        rdr._colstats = colstats
+        rdr._colstats_complete = (colstats is not None)
+        if ids is None : rdr._ids = rdr._query_ids()
+        else : rdr._ids = ids
+        return rdr
+
+    # parse the file: the part of parse() that goes into one transaction
+    #
+    def _read( self, infile ) :
+        with open_file( infile ) as pdbx :
+            l = sas.StarLexer( pdbx )
+            p = sas.CifParser.parse( lexer = l, content_handler = self, error_handler = self, verbose = self._verbose )
+            self._commit()
+
+        if self._coords is not None :
+            self._coords.freeze()
+
+        self._ids = self._make_ids()
+        self._colstats = self._make_colstats()
+        self._colstats_complete = True
+
+        if self._columns is not None :
+            self.create_tables( self.REQUIRED_TABLES )
+            if self._tables is not None :
+                self.create_tables( self._tables )
+
+    # commit unless we're in explicit transaction (isolation_level is None): then it's committed at the end
+    #
+    def _commit( self ) :
+        if self._conn.isolation_level is not None :
+            self._conn.commit()
+
+    # apply connection profile and remember effective settings
+    #
+    def _set_profile( self, profile ) :
+        self._profile = profile
+        if profile is None :
+            self._settings = profiles.read_settings( self._conn )
+        else :
+            self._settings = profiles.apply_profile( self._conn, profile, verbose = self._verbose )
+
+    # read DDL script into { table : set( columns ) }
+    # names are unquoted. Scripts are only parsed once.
+    #
+    @classmethod
+    def read_ddl( cls, script ) :
+        fname = os.path.realpath( script )
+        key = (fname, os.stat( fname ).st_mtime)
+        if key in _CATALOGS :
+            return _CATALOGS[key]
+
+        tblpat = re.compile( cls.DDLTABLE, re.IGNORECASE )
+        colpat = re.compile( cls.DDLCOLUMN, re.IGNORECASE )
+        rc = {}
+        with open( fname, "rb" ) as f :
+            for line in f :
+                m = tblpat.search( line )
+                if not m : continue
+                table = m.group( 1 ).strip( '"' )
+                rc[table] = set( c.strip( '"' ) for c in colpat.findall( m.group( 2 ) ) )
+
+        _CATALOGS[key] = rc
+        return rc
+
     #
     #
-    def __init__( self, connection = None, verbose = False ) :
+    def __init__( self, connection = None, batchsize = 0, tables = None, columnar = False, verbose = False ) :
         self._conn = connection
+        self._serial = next( _SERIAL )
         self.verbose = verbose
+        self.batchsize = batchsize
+        if tables is not None :
+            self._tables = frozenset( tables ).union( self.REQUIRED_TABLES )
+        if columnar :
+            if coords.numpy is None :
+                sys.stderr.write( "numpy not found, loading atom_site into sqlite\n" )
+            else :
+                self._coords = coords.AtomSiteStore( verbose = verbose )
         self._row = {}
-        self._tagpat = re.compile( self.TAGNAME )
-        self._badpat = re.compile( self.BADNAME )
+        self._idvals = {}
+        self._contacts = []
+        self._sigcounts = collections.Counter()
+        self._batch = []
+        self._stats = {}
+        self._stmts = collections.OrderedDict()
 
     #
     #
@@ -91,6 +350,60 @@ class CifReader( sas.ContentHandler, sas.ErrorHandler ) :
     def verbose( self, flag ) :
         self._verbose = bool( flag )
 
+    #
+    #
+    @property
+    def profile( self ) :
+        """Name of sqlite connection profile, None for default"""
+        return self._profile
+
+    #
+    #
+    @property
+    def settings( self ) :
+        """Effective sqlite settings (pragmas)"""
+        return self._settings
+
+    # (source, changes): same value means same database contents.
+    # source is the cache key if the file went through CifCache (so readers of the same file share it),
+    # otherwise the reader's serial number. changes is bumped by touch().
+    #
+    @property
+    def generation( self ) :
+        if self._source is not None : return (self._source, self._changes)
+        return ("reader:%d" % (self._serial,), self._changes)
+
+    # call after changing the database behind the reader's back,
+    # e.g. inserting rows through the connection
+    #
+    def touch( self ) :
+        self._changes += 1
+
+    #
+    #
+    @property
+    def coords( self ) :
+        """AtomSiteStore or None"""
+        return self._coords
+
+    # true if table is in the columnar store rather than sqlite
+    #
+    def has_columns( self, table ) :
+        if self._coords is None : return False
+        return (table.strip( '"' ) == self._coords.table)
+
+    #
+    #
+    @property
+    def batchsize( self ) :
+        """Number of rows to buffer before executemany(), 0 to insert one row at a time"""
+        return self._batchsize
+    @batchsize.setter
+    def batchsize( self, size ) :
+        if size is None : size = 0
+        self._batchsize = int( size )
+        if self._batchsize < 0 : self._batchsize = 0
+
     #
     #
     @property
@@ -101,91 +414,253 @@ class CifReader( sas.ContentHandler, sas.ErrorHandler ) :
     def connection( self, connection ) :
         self._conn = connection
 
-    #
+    # identifiers, see CifIds
     #
+    @property
+    def ids( self ) :
+        return self._ids
+
     @property
     def entryid( self ) :
-        curs = None
-        if self._id is None :
-            sql = "select database_code from database_2 where database_id='BMRB'"
-            curs = self._conn.cursor()
-            curs.execute( sql )
-            row = curs.fetchone()
-            if row is not None :
-                if row[0] is not None :
-                    self._id = str( row[0] ).strip()
-                    if len( self._id ) < 1 : self._id = None
-        if curs is not None : curs.close()
-        if self._id is None : self._id = "converted_from_CD&A"
-        return self._id
+        return self._ids.entryid
 
-    #
-    #
     @property
     def pdbid( self ) :
-        curs = None
-        if self._pdbid is None :
-            sql = "select database_code from database_2 where database_id='PDB'"
-            curs = self._conn.cursor()
-            curs.execute( sql )
-            row = curs.fetchone()
-            if row is not None :
-                if row[0] is not None :
-                    self._pdbid = str( row[0] ).strip()
-                    if len( self._pdbid ) < 1 : self._pdbid = None
-        if curs is not None : curs.close()
-        return self._pdbid
+        return self._ids.pdbid
 
-    #
-    #
     @property
     def depid( self ) :
-        curs = None
-        if self._depid is None :
-            sql = "select database_code from database_2 where database_id='WWPDB'"
-            curs = self._conn.cursor()
-            curs.execute( sql )
-            row = curs.fetchone()
-            if row is not None :
-                if row[0] is not None :
-                    self._depid = str( row[0] ).strip()
-                    if len( self._depid ) < 1 : self._depid = None
-        if self._depid is None :
-            sql = "select entry_id from struct"
-            curs.execute( sql )
-            row = curs.fetchone()
-            if row is not None :
-                if row[0] is not None :
-                    self._depid = str( row[0] ).strip()
-                    if len( self._depid ) < 1 : self._depid = None
-        if curs is not None : curs.close()
-        return self._depid
+        return self._ids.depid
 
+    # list of { "name" : "first last", "addr" : email }
+    #
     @property
     def contacts( self ) :
-        rc = []
-        sql = "select name_first, name_last, email from pdbx_contact_author order by id"
+        return [{ "name" : name, "addr" : addr } for (name, addr) in self._ids.contacts]
+
+    # ids are collected from rows as they're inserted.
+    #
+    def _collect_ids( self, table ) :
+        row = dict( (k.strip( '"' ), v) for (k, v) in self._row.items() )
+        if table == "database_2" :
+            dbid = row.get( "database_id" )
+            if (dbid is not None) and (not dbid in self._idvals) :
+                self._idvals[dbid] = row.get( "database_code" )
+        elif table == "struct" :
+            if not "struct" in self._idvals :
+                self._idvals["struct"] = row.get( "entry_id" )
+        elif table == "pdbx_contact_author" :
+            self._contacts.append( (row.get( "id" ), row.get( "name_first" ), row.get( "name_last" ),
+                    row.get( "email" )) )
+
+    # make CifIds from what _collect_ids() saw
+    # contacts are sorted like "order by id" would: as text, nulls first
+    #
+    def _make_ids( self ) :
+        depid = self._idvals.get( "WWPDB" )
+        if depid is None : depid = self._idvals.get( "struct" )
+        contacts = sorted( self._contacts, key = lambda c : c[0] )
+        return self._ids_record( entryid = self._idvals.get( "BMRB" ), pdbid = self._idvals.get( "PDB" ),
+                depid = depid, contacts = [c[1:] for c in contacts] )
+
+    # same from the database: for readers that didn't parse the file (cache)
+    #
+    def _query_ids( self ) :
+        vals = {}
         curs = self._conn.cursor()
-        curs.execute( sql )
-        while True :
+        for dbid in ("BMRB", "PDB", "WWPDB") :
+            sql = "select database_code from database_2 where database_id=?"
+            curs.execute( sql, (dbid,) )
             row = curs.fetchone()
-            if row is None : break
+            if row is not None : vals[dbid] = row[0]
+        depid = vals.get( "WWPDB" )
+        if _strip( depid ) is None :
+            curs.execute( "select entry_id from struct" )
+            row = curs.fetchone()
+            if row is not None : depid = row[0]
+        sql = "select name_first, name_last, email from pdbx_contact_author order by id"
+        curs.execute( sql )
+        contacts = curs.fetchall()
+        curs.close()
+        return self._ids_record( entryid = vals.get( "BMRB" ), pdbid = vals.get( "PDB" ), depid = depid,
+                contacts = contacts )
+
+    # values are stripped, empty ones are None. Entry ID defaults to DEFAULT_ENTRY_ID.
+    # contact name is "first last".
+    #
+    def _ids_record( self, entryid, pdbid, depid, contacts ) :
+        people = []
+        for (first, last, email) in contacts :
             name = ""
-            if row[0] is not None :
-                if len( str( row[0] ).strip() ) > 0 :
-                    name += str( row[0] ).strip()
-            if row[1] is not None :
-                if len( str( row[1] ).strip() ) > 0 :
-                    name += " " + str( row[0] ).strip()
-            addr = None
-            if row[2] is not None :
-                if len( str( row[2] ).strip() ) > 0 :
-                    addr = str( row[2] ).strip()
-            rc.append( { "name" : name, "addr" : addr } )
+            first = _strip( first )
+            if first is not None : name += first
+            last = _strip( last )
+            if last is not None : name += " " + last
+            people.append( (name, _strip( email )) )
+        entryid = _strip( entryid )
+        if entryid is None : entryid = self.DEFAULT_ENTRY_ID
+        return CifIds( entryid = entryid, pdbid = _strip( pdbid ), depid = _strip( depid ),
+                contacts = tuple( people ) )
+
+    # column statistics: (number of rows, number of non-null values) like CifCol.count_rows().
+    # After parse() they come from the rows as they were inserted: every row is counted
+    # under its set of columns, and that's expanded to per-column counts at the end.
+    # Tables that weren't in the file have no rows.
+    # Otherwise (e.g. reader from cache) each table is counted with one aggregate query when first asked.
+    #
+    def column_stats( self, table, column ) :
+        table = table.strip( '"' )
+        column = column.strip( '"' )
+        if self.has_columns( table ) :
+            return self._coords.count( column )
+        if self._colstats is None :
+            self._colstats = {}
+        if not table in self._colstats :
+            if self._colstats_complete :
+                return (0, 0)
+            self._colstats[table] = self._query_colstats( table )
+        (rows, cols) = self._colstats[table]
+        return (rows, cols.get( column, 0 ))
+
+    def table_rows( self, table ) :
+        return self.column_stats( table, "" )[0]
+
+    # all column statistics collected so far: { table : (rows, { column : values }) }
+    # e.g. to pass to from_database()
+    #
+    @property
+    def colstats( self ) :
+        return self._colstats
 
-        curs.close()
+    # { table : (rows, { column : values }) } from row counts
+    #
+    def _make_colstats( self ) :
+        rc = {}
+        for ((table, cols), num) in self._sigcounts.items() :
+            if not table in rc : rc[table] = (0, {})
+            (rows, vals) = rc[table]
+            for col in cols :
+                col = col.strip( '"' )
+                vals[col] = vals.get( col, 0 ) + num
+            rc[table] = (rows + num, vals)
         return rc
 
+    # (rows, { column : values }) from the database
+    #
+    def _query_colstats( self, table ) :
+        cols = []
+        for row in self._conn.execute( 'pragma table_info("%s")' % (table,) ) :
+            cols.append( row[1] )
+        sql = 'select count(*)%s from "%s"' % ("".join( ',count("%s")' % (c,) for c in cols ), table)
+        if self._verbose :
+            pprint.pprint( sql )
+        row = self._conn.execute( sql ).fetchone()
+        return (row[0], dict( zip( cols, row[1:] ) ))
+
+    # ingest timings: { table : [rows, seconds] }
+    #
+    @property
+    def stats( self ) :
+        return self._stats
+
+    def print_stats( self, out = sys.stdout ) :
+        for table in sorted( self._stats.keys() ) :
+            (rows, secs) = self._stats[table]
+            if secs > 0 : rate = rows / secs
+            else : rate = 0
+            out.write( "%s: %d rows in %0.3f sec (%d rows/sec)\n" % (table, rows, secs, rate) )
+
+    # called when table changes and at the end of data block
+    #
+    def _end_table( self ) :
+        self._flush()
+        if self._table is None : return
+        if self._tblstart is None : return
+        table = self._table.strip( '"' )
+        if not table in self._stats :
+            self._stats[table] = [0, 0.0]
+        self._stats[table][1] += time.time() - self._tblstart
+        self._tblstart = None
+
+    # lazy schema: create table from the DDL catalog. Tables that aren't in the catalog
+    # start with no columns, unknown columns are added by _add_column()
+    #
+    def _create_table( self, table ) :
+        if table in self._columns : return
+        cols = set( self._catalog.get( table, () ) )
+        if len( cols ) > 0 :
+            sql = 'create table "%s" (%s)' % (table,",".join( '"%s" text' % (c,) for c in sorted( cols ) ))
+        else :
+            sql = 'create table "%s" (%s text)' % (table,self.TEMP_COL_NAME)
+        if self.verbose : pprint.pprint( sql )
+        self._conn.execute( sql )
+        self._columns[table] = set( c.lower() for c in cols )
+
+    # column names in _columns are lowercase: sqlite's aren't case-sensitive, tags in the file
+    # don't always match the DDL script
+    #
+    def _has_column( self, table, column ) :
+        return column.lower() in self._columns[table]
+
+    def _add_column( self, table, column ) :
+        sql = 'alter table "%s" add column "%s" text' % (table,column)
+        if self.verbose : pprint.pprint( sql )
+        self._conn.execute( sql )
+        self._columns[table].add( column.lower() )
+
+    # lazy schema: existing tables and columns (database loaded from cache)
+    #
+    def _read_columns( self ) :
+        self._columns = {}
+        tables = []
+        for row in self._conn.execute( "select name from sqlite_master where type='table'" ) :
+            tables.append( row[0] )
+        for table in tables :
+            self._columns[table] = set()
+            for row in self._conn.execute( 'pragma table_info("%s")' % (table,) ) :
+                self._columns[table].add( row[1].lower() )
+
+    # lazy schema: create empty tables that weren't in the input file
+    # (for the queries that expect them)
+    #
+    def create_tables( self, tables ) :
+        if self._columns is None : return
+        for table in tables :
+            self._create_table( table )
+        self._commit()
+
+    # insert statement for (table, columns), columns are in the order of values.
+    # rows in a loop all have the same columns (unless some are null), so keep the last few
+    # statements around and most rows only need to bind values.
+    #
+    def _insert_sql( self, table, cols ) :
+        key = (table, cols)
+        sql = self._stmts.pop( key, None )
+        if sql is None :
+            sql = "insert into %s (%s) values (%s)" % (table,",".join( cols ),",".join( "?" for c in cols ),)
+            if len( self._stmts ) >= self.STMT_CACHE_SIZE :
+                self._stmts.popitem( last = False )
+        self._stmts[key] = sql
+        return sql
+
+    # batched mode: rows with the same set of columns are buffered and inserted with executemany().
+    # buffer is flushed when column set changes so the rows go in in file order
+    #
+    def _flush( self ) :
+        if len( self._batch ) < 1 : return
+
+        sql = self._insert_sql( *self._batchcols )
+        if self.verbose :
+            pprint.pprint( sql )
+            sys.stdout.write( "%d rows\n" % (len( self._batch ),) )
+        try :
+            self._conn.executemany( sql, self._batch )
+        except sqlite3.OperationalError :
+            pprint.pprint( sql )
+            pprint.pprint( self._batch[0] )
+            raise
+        del self._batch[:]
+
     #
     #
     def _insert_row( self ) :
@@ -194,33 +669,45 @@ class CifReader( sas.ContentHandler, sas.ErrorHandler ) :
             if self._verbose : print "nothing to insert"
             return
 
-        params = {}
-        colstr = ""
-        valstr = ""
-        for (col,val) in self._row.iteritems() :
-            key = "x%s" % (col.strip( '"' ).replace( "[", "_" ).replace( "]", "_" ).replace( "-", "_"),)
+        table = self._table.strip( '"' )
+        if not table in self._stats :
+            self._stats[table] = [0, 0.0]
+        self._stats[table][0] += 1
 
-# this should be handled in data()
-#
-#            if col.lower() in ("order","group",) :
-#                colstr += '"' + col + '"'
-#            else :
-            colstr += col
-            colstr += ","
-            valstr += ":%s," % (key,)
-            params[key] = val
-
-        sql = "insert into %s (%s) values (%s)" % (self._table,colstr[:-1],valstr[:-1],)
+        if table in self.ID_TABLES :
+            self._collect_ids( table )
+
+        cols = tuple( self._row.keys() )
+        self._sigcounts[(table, cols)] += 1
+
+        if (self._coords is not None) and (table == self._coords.table) :
+            self._coords.append( self._row )
+            self._row.clear()
+            return
+
+        vals = tuple( self._row[c] for c in cols )
+        self._row.clear()
+
+        if self._batchsize > 0 :
+            sig = (self._table, cols)
+            if sig != self._batchcols :
+                self._flush()
+                self._batchcols = sig
+            self._batch.append( vals )
+            if len( self._batch ) >= self._batchsize :
+                self._flush()
+            return
+
+        sql = self._insert_sql( self._table, cols )
         if self.verbose :
             pprint.pprint( sql )
-            pprint.pprint( params )
+            pprint.pprint( vals )
         try :
-            self._conn.execute( sql, params )
+            self._conn.execute( sql, vals )
         except sqlite3.OperationalError :
             pprint.pprint( sql )
-            pprint.pprint( params )
+            pprint.pprint( vals )
             raise
-        self._row.clear()
 #        print "++", self._row
 
 
@@ -239,6 +726,7 @@ class CifReader( sas.ContentHandler, sas.ErrorHandler ) :
 #        print "== start loop"
         if len( self._row ) > 0 :
             self._insert_row()
+        self._end_table()
         self._row.clear()
         self._rownum = 0
         self._table = None
@@ -250,26 +738,40 @@ class CifReader( sas.ContentHandler, sas.ErrorHandler ) :
         if len( self._row ) > 0 :
             self._insert_row()
             self._firstcol = None
+        self._flush()
 
         return False
 
     def data( self, tag, tagline, val, valline, delim, inloop ) :
 
-        m = self._tagpat.search( tag )
-        if not m : raise Exception( "Invalid tag: %s" % (tag,) )
+        m = tags.parse_tag( tag )
+        if m is None : raise Exception( "Invalid tag: %s" % (tag,) )
 
-        table = m.group( 1 )
-        col = m.group( 2 )
+        (table, col) = m
 
 # skip, at least for now
 #
 #        if table == "atom_site" : return False
 
-        m = self._badpat.search( table )
-        if m : table = '"%s"' % (table,)
-
-        m = self._badpat.search( col )
-        if m : col = '"%s"' % (col,)
+# not on the list: finish previous table and drop the value
+#
+        if self._tables is not None :
+            if not table in self._tables :
+                if self._table is not None :
+                    self._insert_row()
+                    self._end_table()
+                    self._table = None
+                    self._firstcol = None
+                return False
+
+        if self._columns is not None :
+            if not table in self._columns :
+                self._create_table( table )
+            if not self._has_column( table, col ) :
+                self._add_column( table, col )
+
+        table = tags.quote_ident( table )
+        col = tags.quote_ident( col )
 
 #        print "!", tag, val
 
@@ -280,8 +782,10 @@ class CifReader( sas.ContentHandler, sas.ErrorHandler ) :
 
 #            print self._table, ":", self._row
             self._insert_row()
+            self._end_table()
 
             self._table = table
+            self._tblstart = time.time()
             self._firstcol = col
             self._rownum = 0
 
@@ -311,7 +815,8 @@ class CifReader( sas.ContentHandler, sas.ErrorHandler ) :
         if len( self._row ) > 0 :
 #            print "Last:", self._table, ":", self._row
             self._insert_row()
-            self._conn.commit()
+        self._end_table()
+        self._commit()
 
 
 
@@ -325,16 +830,82 @@ class CifReader( sas.ContentHandler, sas.ErrorHandler ) :
         return False
 
 
+# parse_files() worker: one file into sqlite file.
+# has to be at module level for multiprocessing. Never raises: errors go into the result.
+#
+def _parse_worker( job ) :
+    (infile, dbfile, script, batchsize, tables, lazy, profile) = job
+    start = time.time()
+    try :
+        if os.path.exists( dbfile ) :
+            os.unlink( dbfile )
+        conn = sqlite3.connect( dbfile )
+        if profile is not None :
+            profiles.apply_profile( conn, profile )
+# executescript() runs in autocommit mode: that's a sync per table on disk
+#
+        if not lazy :
+            with open( script, "rb" ) as f :
+                conn.executescript( "begin;\n%s\ncommit;\n" % (f.read(),) )
+        rdr = CifReader.parse( infile = infile, connection = conn, ddlscript = script, batchsize = batchsize,
+                tables = tables, lazy = lazy, profile = profile )
+        ids = rdr.ids
+        stats = rdr.stats
+        colstats = rdr.colstats
+        conn.commit()
+        conn.close()
+        return ParseResult( infile = infile, dbfile = dbfile, ids = ids, stats = stats, colstats = colstats,
+                secs = time.time() - start, error = None, reader = None )
+    except Exception :
+        return ParseResult( infile = infile, dbfile = dbfile, ids = None, stats = None, colstats = None,
+                secs = time.time() - start, error = traceback.format_exc(), reader = None )
+
 #
 #
 #
 if __name__ == "__main__" :
 
-    if len( sys.argv ) < 3 : 
-        sys.stderr.write( "usage: ./mmcif.py <ddl file> <mmcif file>\n" )
+    import optparse
+
+    usage = "usage: %prog [options] <ddl file> <mmcif file> [<mmcif file> ...]"
+    op = optparse.OptionParser( usage = usage )
+    op.add_option( "-v", "--verbose", action = "store_true", dest = "verbose",
+                   default = False, help = "print debugging messages" )
+    op.add_option( "-j", "--jobs", action = "store", type = "int", dest = "jobs",
+                   default = None, help = "number of worker processes for multiple files (default: number of cpus)" )
+    op.add_option( "-o", "--outdir", action = "store", type = "string", dest = "outdir",
+                   default = None, help = "directory for sqlite files (multiple files only, default: current)" )
+    op.add_option( "-b", "--batchsize", action = "store", type = "int", dest = "batchsize",
+                   default = CifReader.BATCH_SIZE, help = "insert rows in batches of this many, 0 for one at a time" )
+
+    (options, args) = op.parse_args()
+    if len( args ) < 2 :
+        op.error( "need DDL script and mmCIF file(s)" )
         sys.exit( 1 )
 
-    CifReader.parse( infile = sys.argv[2], connection = None, ddlscript = sys.argv[1], verbose = True )
+    if len( args ) == 2 :
+        CifReader.parse( infile = args[1], connection = None, ddlscript = args[0], batchsize = options.batchsize,
+                verbose = True )
+        sys.exit( 0 )
+
+# workers are pickled by module name: use pdbx2bmrb.mmcif, not __main__
+#
+    from pdbx2bmrb import mmcif
+
+    outdir = options.outdir
+    if outdir is None : outdir = os.getcwd()
+    start = time.time()
+    results = mmcif.CifReader.parse_files( infiles = args[1:], outdir = outdir, ddlscript = args[0],
+            processes = options.jobs, batchsize = options.batchsize, verbose = options.verbose )
+    errs = 0
+    for res in results :
+        if res.error is None :
+            sys.stdout.write( "%s -> %s: %s, %0.3f sec\n" % (res.infile,res.dbfile,res.ids.entryid,res.secs) )
+        else :
+            errs += 1
+            sys.stdout.write( "%s: FAILED\n%s" % (res.infile,res.error) )
+    sys.stdout.write( "%d files, %d errors, %0.3f sec total\n" % (len( results ),errs,(time.time() - start)) )
+    if errs > 0 : sys.exit( 2 )
 
 #
 # eof
@@ -10,13 +10,41 @@ import sys
 import os
 import re
 import collections
+import itertools
 import ConfigParser
 import pprint
+import sqlite3
+import tempfile
 
 _UP = os.path.realpath( "%s/../" % (os.path.split( __file__ )[0],) )
 sys.path.append( _UP )
 import pdbx2bmrb
 
+# index advisor: post-processing methods run correlated updates on tables that starobj creates
+# without indexes. Each method declares the indexes it wants:
+#
+#  @uses_indexes( ("Entity_assembly", ("Entry_ID","ID")), ... )
+#  def fix_something( self ) :
+#
+# and BMRBEntry.create_indexes() makes them before the method runs (if they aren't there yet).
+# They're dropped before write(). Works on BMRBEntry methods and on helpers that have self._entry.
+#
+# Index the where columns of a subquery only, not the selected one: keys aren't always unique
+# (waters) and rows with the same key are in rowid order then, so the first match is the same
+# one a table scan finds. Adding the selected column would make it the lowest value instead.
+#
+def uses_indexes( *indexes ) :
+    def wrap( func ) :
+        def method( self, *args, **kwargs ) :
+            entry = getattr( self, "_entry", self )
+            entry.create_indexes( indexes )
+            return func( self, *args, **kwargs )
+        method.__name__ = func.__name__
+        method.__doc__ = func.__doc__
+        method.indexes = indexes
+        return method
+    return wrap
+
 #
 #
 class BMRBEntry( object ) :
@@ -24,6 +52,22 @@ class BMRBEntry( object ) :
     TEMP_TABLE_NAME = "temp_source_table"
     TEMP_KEY_COL_NAME = "rownum"
 
+# scratch table for fix_comp_index()
+#
+    MAP_TABLE_NAME = "temp_key_map"
+
+# names of indexes made by create_indexes() are this + number
+#
+    INDEX_PREFIX = "pdbx2bmrb_idx"
+
+# binary snapshot (see save_snapshot()): format version goes in user_version,
+# entry ID, PDB ID, and dictionary sha1 in the info table
+#
+    SNAPSHOT_VERSION = 1
+    SNAPSHOT_INFO_TABLE = "snapshot_info"
+    SNAPSHOT_SCHEMA = "snapshot"
+    SQLITE_MAGIC = "SQLite format 3\0"
+
 # non-default: Cd 111, N 14
 #
     ISOTOPES = { "H" : 1, "D" : 2, "T" : 3, "C" : 13, "N" : 15, "O" : 17, "P" : 31,
@@ -85,6 +129,72 @@ class BMRBEntry( object ) :
 
         return star
 
+    # load BMRB entry from binary snapshot made by save_snapshot(): copy the tables, no parsing.
+    # Snapshot has to be made with the same dictionary.
+    #
+    @classmethod
+    def from_snapshot( cls, config, filename, verbose = False ) :
+
+        fname = os.path.realpath( filename )
+        info = cls.read_snapshot_info( fname )
+
+        star = cls( config = config, verbose = verbose )
+        star._check_engine()
+        if info.get( "dictionary" ) != star.dictionary_version :
+            raise Exception( "Snapshot %s was made with a different dictionary" % (fname,) )
+
+        star._db.execute( "attach database :fname as %s" % (cls.SNAPSHOT_SCHEMA,), { "fname" : fname } )
+        try :
+            sql = "select name,sql from %s.sqlite_master where type='table' and name<>:info" % (cls.SNAPSHOT_SCHEMA,)
+            rs = star._db.query( sql, { "info" : cls.SNAPSHOT_INFO_TABLE }, newcursor = True )
+            tables = [(row[0], row[1]) for row in rs]
+            rs.cursor.close()
+            for (name, ddl) in tables :
+                if verbose : sys.stdout.write( "%s.from_snapshot(): %s\n" % (cls.__name__,name) )
+                star._db.execute( 'drop table if exists main."%s"' % (name,) )
+                star._db.execute( ddl )
+                star._db.execute( 'insert into main."%s" select * from %s."%s"' % (name,cls.SNAPSHOT_SCHEMA,name) )
+        finally :
+            star._db.execute( "detach database %s" % (cls.SNAPSHOT_SCHEMA,) )
+
+        star.entryid = info["entry_id"]
+        if info.get( "pdb_id" ) is not None :
+            star.pdbid = info["pdb_id"]
+
+        return star
+
+    # sqlite file, not NMR-STAR text
+    #
+    @classmethod
+    def is_snapshot( cls, filename ) :
+        with open( os.path.realpath( filename ), "rb" ) as f :
+            magic = f.read( len( cls.SQLITE_MAGIC ) )
+        return magic == cls.SQLITE_MAGIC
+
+    # { name : value } from snapshot info table
+    #
+    @classmethod
+    def read_snapshot_info( cls, filename ) :
+        fname = os.path.realpath( filename )
+        if not cls.is_snapshot( fname ) :
+            raise Exception( "Not a snapshot: %s" % (fname,) )
+        rc = {}
+        conn = sqlite3.connect( fname )
+        try :
+            try :
+                row = conn.execute( "pragma user_version" ).fetchone()
+                if row[0] != cls.SNAPSHOT_VERSION :
+                    raise Exception( "Snapshot %s version %s, need %s" % (fname,row[0],cls.SNAPSHOT_VERSION) )
+                for row in conn.execute( "select name,value from %s" % (cls.SNAPSHOT_INFO_TABLE,) ) :
+                    rc[str( row[0] )] = row[1] is not None and str( row[1] ) or None
+            except sqlite3.DatabaseError :
+                raise Exception( "Bad snapshot file %s" % (fname,) )
+        finally :
+            conn.close()
+        if rc.get( "entry_id" ) is None :
+            raise Exception( "No entry ID in snapshot %s" % (fname,) )
+        return rc
+
     #
     #
     #
@@ -102,10 +212,33 @@ class BMRBEntry( object ) :
 
         self._db = pdbx2bmrb.starobj.NMRSTAREntry( self._dbwrp, verbose = verbose )
 
+# sqlite connection profile, see profiles.py
+#
+        self._profile = None
+        self._settings = None
+        if config.has_option( "entry", "profile" ) and (config.get( "entry", "engine" ) == "sqlite3") :
+            self._profile = config.get( "entry", "profile" )
+            self._settings = pdbx2bmrb.profiles.apply_profile( self._db.execute, self._profile, verbose = verbose )
+
         self._tables = []  # list of tables with data
         self._id = "converted"
         self._pdbid = None
 
+# see uses_indexes()
+#
+        self._indexes = collections.OrderedDict()
+        self._numindexes = 0
+        self._autoindex = True
+        self._coordinates = True
+        if config.has_option( "entry", "auto_indexes" ) :
+            self._autoindex = config.getboolean( "entry", "auto_indexes" )
+
+# see write()
+#
+        self._writer = "stream"
+        if config.has_option( "entry", "writer" ) :
+            self._writer = config.get( "entry", "writer" ).strip().lower()
+
 
     #
     #
@@ -117,6 +250,87 @@ class BMRBEntry( object ) :
     def verbose( self, flag ) :
         self._verbose = bool( flag )
 
+    #
+    #
+    @property
+    def profile( self ) :
+        """Name of sqlite connection profile, None for default"""
+        return self._profile
+
+    #
+    #
+    @property
+    def settings( self ) :
+        """Effective sqlite settings (pragmas), None if not set"""
+        return self._settings
+
+    #
+    #
+    @property
+    def coordinates( self ) :
+        """Copy atom_site into Atom_site. If not, only residues go in, see make_residues()"""
+        return self._coordinates
+    @coordinates.setter
+    def coordinates( self, flag ) :
+        self._coordinates = bool( flag )
+
+    # sha1 of dictionary database file, for sqlite3 dictionary.
+    # Otherwise it's where the dictionary is: can't tell if it changed.
+    #
+    @property
+    def dictionary_version( self ) :
+        if self._props.get( "dictionary", "engine" ) == "sqlite3" :
+            return pdbx2bmrb.tagmap.source_info( self._props.get( "dictionary", "database" ) )[3]
+        rc = []
+        for opt in ("engine", "host", "database") :
+            if self._props.has_option( "dictionary", opt ) :
+                rc.append( self._props.get( "dictionary", opt ) )
+        return ":".join( rc )
+
+    #
+    #
+    @property
+    def auto_indexes( self ) :
+        """Create indexes declared with @uses_indexes"""
+        return self._autoindex
+    @auto_indexes.setter
+    def auto_indexes( self, flag ) :
+        self._autoindex = bool( flag )
+
+    # { (table, (columns)) : index name } for indexes that are there now
+    #
+    @property
+    def indexes( self ) :
+        return self._indexes
+
+    # indexes is a list of (table, (columns))
+    # an index is only an optimization: if it can't be created (e.g. no such column), say so and go on
+    #
+    def create_indexes( self, indexes ) :
+        if not self._autoindex : return
+        for (table, cols) in indexes :
+            key = (table, tuple( cols ))
+            if key in self._indexes : continue
+            self._numindexes += 1
+            name = "%s%d" % (self.INDEX_PREFIX,self._numindexes)
+            sql = 'create index "%s" on "%s" (%s)' % (name,table,",".join( '"%s"' % (c,) for c in cols ))
+            if self.verbose :
+                sys.stdout.write( sql + "\n" )
+            try :
+                self._db.execute( sql )
+            except Exception as e :
+                sys.stderr.write( "WARN: no index on %s(%s): %s\n" % (table,",".join( cols ),str( e )) )
+                continue
+            self._indexes[key] = name
+
+    def drop_indexes( self ) :
+        for name in self._indexes.values() :
+            sql = 'drop index if exists "%s"' % (name,)
+            if self.verbose :
+                sys.stdout.write( sql + "\n" )
+            self._db.execute( sql )
+        self._indexes.clear()
+
     #
     #
     @property
@@ -146,8 +360,17 @@ class BMRBEntry( object ) :
     #
     #
     #
+    # out is anything with write(), see compress.create_file()
+    # streaming writer unless [entry] writer = starobj
+    #
     def write( self, out ) :
-        assert isinstance( out, file )
+        assert hasattr( out, "write" )
+
+        self.drop_indexes()
+
+        if self._writer == "stream" :
+            pdbx2bmrb.StarStreamWriter.write_entry( entry = self, out = out, verbose = self.verbose )
+            return
 
         errs = []
         rc = pdbx2bmrb.starobj.StarWriter.pretty_print( entry = self._db, dictionary = self._dic, 
@@ -159,6 +382,56 @@ class BMRBEntry( object ) :
             for err in errs :
                 sys.stderr.write( str( err ) )
 
+    # snapshots are sqlite files made with attach: entry database has to be sqlite3 too
+    #
+    def _check_engine( self ) :
+        if self._props.get( "entry", "engine" ) != "sqlite3" :
+            raise Exception( "Snapshots need sqlite3 entry database" )
+
+    # save entry tables and entry/PDB/dictionary IDs in sqlite file, see from_snapshot()
+    # written to temp file first so there's never a half-made snapshot.
+    #
+    def save_snapshot( self, filename ) :
+        self._check_engine()
+        self.drop_indexes()
+
+        fname = os.path.realpath( filename )
+        (fd, tmpname) = tempfile.mkstemp( suffix = ".sqlt3", dir = os.path.split( fname )[0] )
+        os.close( fd )
+
+        if self.verbose :
+            sys.stdout.write( "%s.save_snapshot(): %s\n" % (self.__class__.__name__,fname,) )
+
+        try :
+            scratch = (self.TEMP_TABLE_NAME, self.MAP_TABLE_NAME)
+            rs = self._db.query( "select name from main.sqlite_master where type='table'", newcursor = True )
+            tables = [row[0] for row in rs if not row[0] in scratch]
+            rs.cursor.close()
+
+            self._db.execute( "attach database :fname as %s" % (self.SNAPSHOT_SCHEMA,), { "fname" : tmpname } )
+            try :
+                for name in tables :
+                    rs = self._db.query( 'pragma main.table_info("%s")' % (name,), newcursor = True )
+                    cols = ['"%s" %s' % (row[1],row[2]) for row in rs]
+                    rs.cursor.close()
+                    self._db.execute( 'create table %s."%s" (%s)' % (self.SNAPSHOT_SCHEMA,name,",".join( cols )) )
+                    self._db.execute( 'insert into %s."%s" select * from main."%s"' % (self.SNAPSHOT_SCHEMA,name,name) )
+
+                self._db.execute( "create table %s.%s (name text,value text)" % (self.SNAPSHOT_SCHEMA,self.SNAPSHOT_INFO_TABLE) )
+                sql = "insert into %s.%s (name,value) values (:name,:val)" % (self.SNAPSHOT_SCHEMA,self.SNAPSHOT_INFO_TABLE)
+                for (name, val) in (("entry_id", self.entryid), ("pdb_id", self._pdbid),
+                        ("dictionary", self.dictionary_version)) :
+                    self._db.execute( sql, { "name" : name, "val" : val } )
+                self._db.execute( "pragma %s.user_version=%d" % (self.SNAPSHOT_SCHEMA,self.SNAPSHOT_VERSION) )
+            finally :
+                self._db.execute( "detach database %s" % (self.SNAPSHOT_SCHEMA,) )
+
+            os.rename( tmpname, fname )
+        except :
+            if os.path.exists( tmpname ) :
+                os.unlink( tmpname )
+            raise
+
 ####################################################################################################
 #
 # saveframes are all very similar but slightly different
@@ -197,7 +470,6 @@ class BMRBEntry( object ) :
         if self._verbose :
             sys.stdout.write( "*** sfid: %s, freetable: %s, has_ft: %s\n" % (sfid,freetable,(has_freetable and "yes" or "no"),) )
 
-        curs = cifdb._conn.cursor()
         stmt = pdbx2bmrb.starobj.DbWrapper.InsertStatement( db = self._db._db, 
                 connection = self._db.CONNECTION,
                 verbose = self._verbose )
@@ -205,27 +477,27 @@ class BMRBEntry( object ) :
 
             if self._verbose : sys.stdout.write( "**** working on %s (freetable: %s)\n" % (table.table,freetable) )
 
-            pdbx2bmrb.OneDepToBmrb.make_source_table( conn = cifdb._conn, startable = table )
+            if (table.table == "Atom_site") and (not self._coordinates) :
+                self.make_residues( cifdb, table )
+                continue
+
+            src = pdbx2bmrb.OneDepToBmrb.iter_source_rows( conn = cifdb._conn, startable = table, cifdb = cifdb )
 
             stmt.reset()
             stmt.table = table.table
 
-            sql = "select * from " + pdbx2bmrb.TEMP_TABLE_NAME
-            curs.execute( sql )
             stmt.clear()
-            while True :
-                row = curs.fetchone()
-                if row is None : break
+            for row in src :
 
                 if self._verbose : 
                     sys.stdout.write( "<<<< SRC ROW\n" )
                     pprint.pprint( row )
 
                 for i in range( len( row ) ) :
-                    if curs.description[i][0] == pdbx2bmrb.TEMP_KEY_COL_NAME : continue
-                    if self.verbose : pprint.pprint( curs.description[i][0] + ": " + str( row[i] ) )
+                    if src.description[i][0] == pdbx2bmrb.TEMP_KEY_COL_NAME : continue
+                    if self.verbose : pprint.pprint( src.description[i][0] + ": " + str( row[i] ) )
 
-                    stmt[curs.description[i][0]] = row[i]
+                    stmt[src.description[i][0]] = row[i]
 
                 if table.table == freetable :
                     if not "ID" in stmt : stmt["ID"] = lclid
@@ -247,14 +519,10 @@ class BMRBEntry( object ) :
                 if self.verbose : stmt._verbose = False
 
 # make sure we don't create 2 saveframes
-# for some reason I get "table is locked" without fetchall() ...
 #
                 if has_freetable and (table.table == freetable) :
-                    curs.fetchall()
                     break
 
-        curs.close()
-
 # some mmcif tables don't have "freetable" categories
 # we need them for saveframe mapping, so here goes
 #
@@ -314,35 +582,32 @@ class BMRBEntry( object ) :
 
             if self._verbose : sys.stdout.write( "**** working on %s\n" % (table.table,) )
 
-            pdbx2bmrb.OneDepToBmrb.make_source_table( conn = cifdb._conn, startable = table, verbose = self.verbose )
+            src = pdbx2bmrb.OneDepToBmrb.iter_source_rows( conn = cifdb._conn, startable = table, cifdb = cifdb,
+                    verbose = self.verbose )
 
             stmt.reset()
             stmt.table = table.table
 
-            sql = "select * from " + pdbx2bmrb.TEMP_TABLE_NAME
-            curs.execute( sql )
             sid = None
-            while True :
-                row = curs.fetchone()
+            for row in src :
                 if self.verbose : pprint.pprint( row )
-                if row is None : break
 
                 for i in range( len( row ) ) :
                     if table.table == freetable :
-                        if curs.description[i][0] == "ID" :
+                        if src.description[i][0] == "ID" :
                             sid = row[i]
                             break
                     else :
-                        if curs.description[i][0] == idtag :
+                        if src.description[i][0] == idtag :
                             sid = row[i]
                             break
 
                 for i in range( len( row ) ) :
                     if self.verbose :
-                        sys.stdout.write( ">>> %d %s %s\n" % (i, curs.description[i][0],row[i],) )
-                    if curs.description[i][0] == pdbx2bmrb.TEMP_KEY_COL_NAME : continue
+                        sys.stdout.write( ">>> %d %s %s\n" % (i, src.description[i][0],row[i],) )
+                    if src.description[i][0] == pdbx2bmrb.TEMP_KEY_COL_NAME : continue
 
-                    stmt[curs.description[i][0]] = row[i]
+                    stmt[src.description[i][0]] = row[i]
                     if table.table == freetable :
                         if not "Sf_framecode" in stmt : stmt["Sf_framecode"] = ids[sid]["sfname"]
                         if not "Sf_category" in stmt : stmt["Sf_category"] = sfcat
@@ -380,7 +645,6 @@ class BMRBEntry( object ) :
         sfid = self._db.insert_saveframe( name = sfname, category = sfcat, entryid = self.entryid )
 
         keywords = []
-        curs = cifdb._conn.cursor()
 
         stmt = pdbx2bmrb.starobj.DbWrapper.InsertStatement( db = self._db._db, 
                 connection = self._db.CONNECTION,
@@ -389,23 +653,19 @@ class BMRBEntry( object ) :
 
             if self._verbose : pprint.pprint( table )
 
-            pdbx2bmrb.OneDepToBmrb.make_source_table( conn = cifdb._conn, startable = table )
+            src = pdbx2bmrb.OneDepToBmrb.iter_source_rows( conn = cifdb._conn, startable = table, cifdb = cifdb )
 
             stmt.reset()
             stmt.table = table.table
 
-            sql = "select * from " + pdbx2bmrb.TEMP_TABLE_NAME
-            curs.execute( sql )
             stmt.clear()
-            while True :
-                row = curs.fetchone()
-                if row is None : break
+            for row in src :
 
                 if self._verbose : pprint.pprint( row )
 
                 for i in range( len( row ) ) :
-                    if curs.description[i][0] == pdbx2bmrb.TEMP_KEY_COL_NAME : continue
-                    if self.verbose : pprint.pprint( curs.description[i][0] + ": " + str( row[i] ) )
+                    if src.description[i][0] == pdbx2bmrb.TEMP_KEY_COL_NAME : continue
+                    if self.verbose : pprint.pprint( src.description[i][0] + ": " + str( row[i] ) )
 
 
 # struct_keywords is comma-separated string in mmcif and proper list in nmr-star
@@ -413,15 +673,15 @@ class BMRBEntry( object ) :
                     if table.table == "Struct_keywords" :
                         if row[i] is None : continue
                         vals = []
-                        if curs.description[i][0] == "Keywords" :
+                        if src.description[i][0] == "Keywords" :
                             vals = re.split( r",", row[i] )
                             if len( vals ) > 0 : keywords.extend( vals )
-                        elif curs.description[i][0] == "Text" :
+                        elif src.description[i][0] == "Text" :
                             vals = re.split( r",", row[i] )
                             if len( vals ) > 0 : keywords.extend( vals )
 
                     else :
-                        stmt[curs.description[i][0]] = row[i]
+                        stmt[src.description[i][0]] = row[i]
 
                 if table.table == "Entry" :
                     if not "ID" in stmt : stmt["ID"] = self.entryid
@@ -485,47 +745,43 @@ class BMRBEntry( object ) :
 
             if self._verbose : pprint.pprint( table )
 
-            pdbx2bmrb.OneDepToBmrb.make_source_table( conn = cifdb._conn, startable = table )
+            src = pdbx2bmrb.OneDepToBmrb.iter_source_rows( conn = cifdb._conn, startable = table, cifdb = cifdb )
 
             stmt.reset()
             stmt.table = table.table
 
-            sql = "select * from " + pdbx2bmrb.TEMP_TABLE_NAME
-            curs.execute( sql )
-            while True :
-                row = curs.fetchone()
-                if row is None : break
+            for row in src :
 
                 if self._verbose : pprint.pprint( row )
 
                 citid = "primary"
                 for i in range( len( row ) ) :
-                    if curs.description[i][0] == "ID" :
+                    if src.description[i][0] == "ID" :
                         if row[i] != "primary" :
                             citid = row[i]
                             break
 
                 for i in range( len( row ) ) :
 
-                    if curs.description[i][0] == pdbx2bmrb.TEMP_KEY_COL_NAME : continue
+                    if src.description[i][0] == pdbx2bmrb.TEMP_KEY_COL_NAME : continue
 
                     if table.table == "Citation" :
-                        if curs.description[i][0] == "ID" :
+                        if src.description[i][0] == "ID" :
                             if citid == "primary" :
                                 stmt["Class"] = "entry citation"
                             else :
                                 stmt["Class"] = "reference citation"
                         else :
-                            stmt[curs.description[i][0]] = row[i]
+                            stmt[src.description[i][0]] = row[i]
 
                         stmt["ID"] = ids[citid]["id"]
                         if not "Sf_framecode" in stmt : stmt["Sf_framecode"] = ids[citid]["sfname"]
                         if not "Sf_category" in stmt : stmt["Sf_category"] = sfcat
 
-                    elif curs.description[i][0] == "Citation_ID" :
+                    elif src.description[i][0] == "Citation_ID" :
                         stmt["Citation_ID"] = ids[citid]["id"]
                     else :
-                        stmt[curs.description[i][0]] = row[i]
+                        stmt[src.description[i][0]] = row[i]
 
                 if not "Entry_ID" in stmt : stmt["Entry_ID"] = self.entryid
                 stmt["Sf_ID"] = ids[citid]["sfid"]
@@ -574,31 +830,27 @@ class BMRBEntry( object ) :
 
             table.sanitize()
             if self.verbose : pprint.pprint( table )
-            pdbx2bmrb.OneDepToBmrb.make_source_table( conn = cifdb._conn, startable = table )
+            src = pdbx2bmrb.OneDepToBmrb.iter_source_rows( conn = cifdb._conn, startable = table, cifdb = cifdb )
 
             stmt.reset()
             stmt.table = table.table
 
-            sql = "select * from " + pdbx2bmrb.TEMP_TABLE_NAME
-            curs.execute( sql )
             eid = 0
-            while True :
-                row = curs.fetchone()
-                if row is None : break
+            for row in src :
 
                 for i in range( len( row ) ) :
 
                     if self.verbose : pprint.pprint( row )
 
-                    if curs.description[i][0] == pdbx2bmrb.TEMP_KEY_COL_NAME : continue
+                    if src.description[i][0] == pdbx2bmrb.TEMP_KEY_COL_NAME : continue
 
 # like entry keywords, this is a comma-delimited string in mmcif but a proper list in nmr-star
 #
                     if table.table == "Entity_common_name" :
-                        if curs.description[i][0] == "Entity_ID" :
+                        if src.description[i][0] == "Entity_ID" :
                             eid = row[i]
                         vals = []
-                        if curs.description[i][0] == "Name" :
+                        if src.description[i][0] == "Name" :
                             vals = re.split( r",", row[i] )
                             if len( vals ) > 0 :
                                 if eid in names.keys() : names[eid].extend( vals )
@@ -608,7 +860,7 @@ class BMRBEntry( object ) :
 
                     else :
                         if table.table == "Entity" :
-                            if curs.description[i][0] == "ID" :
+                            if src.description[i][0] == "ID" :
                                 eid = row[i]
                                 if not "Sf_framecode" in stmt : stmt["Sf_framecode"] = ids[eid]["sfname"]
                                 if not "Sf_category" in stmt : stmt["Sf_category"] = sfcat
@@ -616,11 +868,11 @@ class BMRBEntry( object ) :
 
 #                if not "Paramagnetic" in stmt : stmt["Paramagnetic"] = "?"
                         else :
-                            if curs.description[i][0] == "Entity_ID" :
+                            if src.description[i][0] == "Entity_ID" :
                                 eid = row[i]
                                 if not "Sf_ID" in stmt : stmt["Sf_ID"] = ids[eid]["sfid"]
 
-                        stmt[curs.description[i][0]] = row[i]
+                        stmt[src.description[i][0]] = row[i]
 
 # entity id should be in all source tables
 #
@@ -715,25 +967,21 @@ class BMRBEntry( object ) :
         for table in tables :
 
             if self.verbose : pprint.pprint( table )
-            pdbx2bmrb.OneDepToBmrb.make_source_table( conn = cifdb._conn, startable = table )
+            src = pdbx2bmrb.OneDepToBmrb.iter_source_rows( conn = cifdb._conn, startable = table, cifdb = cifdb )
 
             stmt.reset()
             stmt.table = table.table
 
-            sql = "select * from " + pdbx2bmrb.TEMP_TABLE_NAME
-            curs.execute( sql )
             cid = None
-            while True :
-                row = curs.fetchone()
-                if row is None : break
+            for row in src :
 
                 for i in range( len( row ) ) :
                     if table.table == "Chem_comp" :
-                        if curs.description[i][0] == "ID" :
+                        if src.description[i][0] == "ID" :
                             cid = row[i]
                             break
                     else :
-                        if curs.description[i][0] == "Comp_ID" :
+                        if src.description[i][0] == "Comp_ID" :
                             cid = row[i]
                             break
 
@@ -742,9 +990,9 @@ class BMRBEntry( object ) :
                 if not cid in ids.keys() : continue
 
                 for i in range( len( row ) ) :
-#                    print ">>>", i, curs.description[i][0], row[i]
-                    if curs.description[i][0] == pdbx2bmrb.TEMP_KEY_COL_NAME : continue
-                    stmt[curs.description[i][0]] = row[i]
+#                    print ">>>", i, src.description[i][0], row[i]
+                    if src.description[i][0] == pdbx2bmrb.TEMP_KEY_COL_NAME : continue
+                    stmt[src.description[i][0]] = row[i]
 
                     if table.table == "Chem_comp" :
                         if not "Sf_framecode" in stmt :
@@ -840,35 +1088,32 @@ class BMRBEntry( object ) :
 #
             if table.table == "Sample_condition_variable" :
                 pdbx2bmrb.OneDepToBmrb.make_sample_conditions_table( conn = cifdb._conn, startable = table )
+                src = pdbx2bmrb.SourceRows.from_temp_table( cifdb._conn )
             else : #  table.table == "Sample_condition_list" is the only one we map ATM
-                pdbx2bmrb.OneDepToBmrb.make_source_table( conn = cifdb._conn, startable = table )
+                src = pdbx2bmrb.OneDepToBmrb.iter_source_rows( conn = cifdb._conn, startable = table, cifdb = cifdb )
 
             stmt.reset()
             stmt.table = table.table
 
-            sql = "select * from " + pdbx2bmrb.TEMP_TABLE_NAME
-            curs.execute( sql )
             sid = None
-            while True :
-                row = curs.fetchone()
-                if row is None : break
+            for row in src :
 
 #                print "!!", table.table
                 for i in range( len( row ) ) :
-#                    print "***", curs.description[i][0], row[i]
+#                    print "***", src.description[i][0], row[i]
                     if table.table == "Sample_condition_list" :
-                        if curs.description[i][0] == "ID" :
+                        if src.description[i][0] == "ID" :
                             sid = row[i]
                             break
                     else :
-                        if curs.description[i][0] == "Sample_condition_list_ID" :
+                        if src.description[i][0] == "Sample_condition_list_ID" :
                             sid = row[i]
                             break
 
                 for i in range( len( row ) ) :
-                    if curs.description[i][0] == pdbx2bmrb.TEMP_KEY_COL_NAME : continue
+                    if src.description[i][0] == pdbx2bmrb.TEMP_KEY_COL_NAME : continue
 
-                    stmt[curs.description[i][0]] = row[i]
+                    stmt[src.description[i][0]] = row[i]
 
                 if table.table == "Sample_condition_list" :
                     if not "Sf_framecode" in stmt : stmt["Sf_framecode"] = ids[sid]["sfname"]
@@ -1285,13 +1530,20 @@ class BMRBEntry( object ) :
             sys.stdout.write( "%s.fix_entity_assembly()\n" % (self.__class__.__name__,) )
 
 # generate dummy name as entity names can get long and are here multiple times
+#
+# asym IDs sort by number, not as text: "B" comes before "AA". see asym.py
 #
         params = []
         sql = 'select "Entity_ID","Asym_ID","PDB_chain_ID" from "Entity_assembly"' \
             + ' order by "Entity_ID","Asym_ID","PDB_chain_ID"'
-        rs = self._db.query( sql )
+        rows = []
+        eids = {}
+        for row in self._db.query( sql ) :
+            if not row[0] in eids : eids[row[0]] = len( eids )
+            rows.append( tuple( row ) )
+        rows.sort( key = lambda r : (eids[r[0]], pdbx2bmrb.asym_sort_key( r[1] )) )
         i = 0
-        for row in rs :
+        for row in rows :
             if self.verbose :
                 pprint.pprint( row )
             i += 1
@@ -1736,11 +1988,102 @@ class BMRBEntry( object ) :
         if self.verbose :
             sys.stdout.write( "=> %s rows updated\n" % (rc.rowcount,) )
 
+    ###############################################################################################
+    # coordinate-free conversion: instead of copying all of atom_site, insert one Atom_site row
+    # per distinct residue. That's all fix_coordinates() and fix_comp_index() look at.
+    # Residues are in the order they first show up in atom_site, so the updates pick the same values
+    # as they would from all atoms. Only the columns below are read, in one pass over the atom_site
+    # cursor or the columnar store, and only the first row of each residue is kept.
+    # The rows are removed with delete_coordinates().
+    #
+    RESIDUE_COLS = ("Label_entity_assembly_ID","Label_entity_ID","Label_comp_index_ID","Label_comp_ID",
+        "PDBX_label_asym_ID","Auth_seq_ID")
+
+    def make_residues( self, cifdb, table ) :
+        if self.verbose :
+            sys.stdout.write( "%s.make_residues()\n" % (self.__class__.__name__,) )
+
+        assert isinstance( cifdb,  pdbx2bmrb.CifReader )
+        assert isinstance( table, pdbx2bmrb.StarTable )
+
+        keys = table.keys()
+        if len( keys ) < 1 : return 0
+        cols = [str( c ) for c in keys if c in self.RESIDUE_COLS]
+        if len( cols ) < 1 : return 0
+
+# source tags of residue columns: straight copies from one table (atom_site)
+#
+        srcs = []
+        for i in range( len( cols ) ) :
+            for pc in table[cols[i]].pdbcols.values() :
+                if not pdbx2bmrb.TRANSFORMS.copies( pc.code ) :
+                    raise Exception( "Can't make residues from %s: transform code %s" % (pc.tag,pc.code) )
+                srcs.append( (i, pc, pdbx2bmrb.TRANSFORMS.overwrites( pc.code )) )
+        if len( srcs ) < 1 : return 0
+        srctable = srcs[0][1].table
+        if any( (pc.table != srctable) for (i, pc, overwrite) in srcs ) :
+            raise Exception( "Can't make residues from more than one table: %s" \
+                % (",".join( sorted( set( pc.table for (i, pc, overwrite) in srcs ) ) ),) )
+        simple = [i for (i, pc, overwrite) in srcs] == range( len( cols ) )
+
+# source_rows() counts rows from ID or the first column
+#
+        first = ("ID" in keys) and "ID" or keys[0]
+        numrows = table[first].pdbcols.values()[0].numvals
+
+        curs = None
+        if cifdb.has_columns( srctable ) :
+            rows = itertools.izip( *[cifdb.coords.values( pc.col ) for (i, pc, overwrite) in srcs] )
+        else :
+            sql = "select %s from %s" % (",".join( pc.dbcol for (i, pc, overwrite) in srcs ),srcs[0][1].dbtable)
+            if self.verbose :
+                sys.stdout.write( sql + "\n" )
+            curs = cifdb._conn.execute( sql )
+            rows = curs
+
+# one pass over atom_site, a row goes in the first time its residue shows up
+#
+        residues = set()
+        atoms = 0
+        stmt = pdbx2bmrb.starobj.DbWrapper.InsertStatement( db = self._db._db,
+                connection = self._db.CONNECTION,
+                verbose = self._verbose )
+        stmt.table = table.table
+        try :
+            for row in itertools.islice( rows, numrows ) :
+                atoms += 1
+                if simple : key = tuple( row )
+                else :
+                    vals = [None] * len( cols )
+                    for j in range( len( srcs ) ) :
+                        (i, pc, overwrite) = srcs[j]
+                        if overwrite or (vals[i] is None) : vals[i] = row[j]
+                    key = tuple( vals )
+                if key in residues : continue
+                residues.add( key )
+                stmt.clear()
+                for i in range( len( cols ) ) :
+                    val = key[i]
+                    if isinstance( val, str ) : val = val.decode( "utf-8" )
+                    elif (val is not None) and (not isinstance( val, unicode )) : val = unicode( val )
+                    stmt[cols[i]] = val
+                stmt["Entry_ID"] = self.entryid
+                stmt.insert()
+        finally :
+            if curs is not None : curs.close()
+
+        if self.verbose :
+            sys.stdout.write( "=> %d residues from %d atoms\n" % (len( residues ),atoms) )
+        return len( residues )
+
     ###############################################################################################
     # insert 1 in Atom_site.Assembly_ID and Label_entity_assembly_ID based on Auth_asym_ID (?)
     #  -- lookup in Entity_assembly
     # Also set PDB ID in the free table
     #
+    @uses_indexes( ("Entity_assembly", ("Entry_ID","Asym_ID","Entity_ID")),
+        ("PDBX_poly_seq_scheme", ("Entry_ID","Asym_ID","Entity_ID","Entity_assembly_ID","Comp_ID")),
+        ("PDBX_nonpoly_scheme", ("Entry_ID","Asym_ID","Entity_ID","Entity_assembly_ID","Comp_ID")) )
     def fix_coordinates( self ) :
         if self.verbose :
             sys.stdout.write( "%s.fix_coordinates()\n" % (self.__class__.__name__,) )
@@ -1811,43 +2154,39 @@ class BMRBEntry( object ) :
     # 20160331 -- this doesn't actually work e.g. in a homo-dimer where they indexed their residues
     # x..y for chain a and y+1..y+(y-x) for chain b. Only one of 2 indexes will be kept.
     # It does work at assembly level.
+    #
+    # Residues are checked against one pass over each scheme table and Auth_seq_IDs are matched
+    # in memory, see _first_values() and _update_from_map(), so it's linear in number of residues.
+    #
+    @uses_indexes( ("PDBX_nonpoly_scheme", ("Entry_ID","Entity_ID","Comp_index_ID","Comp_ID")) )
     def fix_comp_index( self ) :
         if self.verbose :
             sys.stdout.write( "%s.fix_comp_index()\n" % (self.__class__.__name__,) )
 
-        has_nonpoly_entity = False
         params = { "entryid" : self.entryid }
-        sql = 'select count(*) from "PDBX_nonpoly_scheme" where "Entry_ID"=:entryid'
-        rs = self._db.query( sql, params )
-        row = rs.next()
-        has_nonpoly_entity = (int( row[0] ) > 0)
-
-        sql1 = 'select count(*) from "PDBX_poly_seq_scheme" where "Entity_assembly_ID"=:aid and ' \
-            + '"Entity_ID"=:eid and "Comp_index_ID"=:seq and "Comp_ID"=:res and "Asym_ID"=:cid and ' \
-            + '"Entry_ID"=:entryid'
 
-        sql2 = 'select count(*) from "PDBX_nonpoly_scheme" where "Entity_assembly_ID"=:aid and ' \
-            + '"Entity_ID"=:eid and "Comp_index_ID"=:seq and "Comp_ID"=:res and "Asym_ID"=:cid and ' \
-            + '"Entry_ID"=:entryid'
+# { (aid,eid,seq,res,cid) : number of rows } in PDBX_[nonpoly/poly_seq_]scheme
+#
+        cols = ("Entity_assembly_ID","Entity_ID","Comp_index_ID","Comp_ID","Asym_ID")
+        poly = collections.Counter( self._db.iter_values( table = "PDBX_poly_seq_scheme", columns = cols,
+                entryid = self.entryid ) )
+        nonpoly = collections.Counter( self._db.iter_values( table = "PDBX_nonpoly_scheme", columns = cols,
+                entryid = self.entryid ) )
+        has_nonpoly_entity = (sum( nonpoly.values() ) > 0)
+        if self.verbose :
+            sys.stdout.write( "==> %d residues (poly_seq), %d (nonpoly)\n" % (len( poly ),len( nonpoly )) )
 
         cnt = 0
         for (aid,eid,seq,res,cid) in self._db.iter_values( table = "Atom_site", columns = ("Label_entity_assembly_ID",
                 "Label_entity_ID","Label_comp_index_ID","Label_comp_ID","PDBX_label_asym_ID"), distinct = True,
                 entryid = self.entryid ) :
-            params["aid"] = aid
-            params["eid"] = eid
-            params["seq"] = seq
-            params["res"] = res
-            params["cid"] = cid
-            if self.verbose :
-                sys.stdout.write( sql1 + "\n" )
-                pprint.pprint( params )
-            rs = self._db.query( sql1, params )
-            row = rs.next()
-            cnt = int( row[0] )
-            if self.verbose :
-                sys.stdout.write( "==> %d rows (poly_seq)\n" % (cnt,) )
 
+# null never matches
+#
+            key = (aid,eid,seq,res,cid)
+            if None in key : key = None
+
+            cnt = (key is not None) and poly[key] or 0
             if cnt > 1 :
                 sys.stderr.write( "ERR: %d rown in pdbx_poly_seq_scheme for residue %s(%s):%s:%s:%s\n" \
                     % (cnt,str( aid ),str( cid ),str( eid ),str( seq ),str( res )) ) 
@@ -1860,12 +2199,7 @@ class BMRBEntry( object ) :
 
 # it may be in PDBX_nonpoly?
 #
-                rs = self._db.query( sql2, params )
-                row = rs.next()
-                cnt = int( row[0] )
-                if self.verbose :
-                    sys.stdout.write( "==> %d rows (nonpoly)\n" % (cnt,) )
-
+                cnt = (key is not None) and nonpoly[key] or 0
                 if cnt > 1 :
                     sys.stderr.write( "ERR: %d rown in pdbx_nonpoly_scheme for residue %s(%s):%s:%s:%s\n" \
                         % (cnt,str( aid ),str( cid ),str( eid ),str( seq ),str( res )) ) 
@@ -1878,45 +2212,22 @@ class BMRBEntry( object ) :
 
 # polymer entities
 #
-        sql = 'update "PDBX_poly_seq_scheme" set "Auth_seq_num"=(select "Auth_seq_ID" from "Atom_site" ' \
-            + ' where "PDBX_poly_seq_scheme"."Entity_ID"="Label_entity_ID" and ' \
-            + '"PDBX_poly_seq_scheme"."Comp_index_ID"="Label_comp_index_ID" and ' \
-            + '"PDBX_poly_seq_scheme"."Comp_ID"="Label_comp_ID" and ' \
-            + '"PDBX_poly_seq_scheme"."Asym_ID"="PDBX_label_asym_ID" and ' \
-            + '"PDBX_poly_seq_scheme"."Entry_ID"="Entry_ID")'
-        if self.verbose :
-            sys.stdout.write( sql + "\n" )
-        rc = self._db.execute( sql )
-        if self.verbose :
-            sys.stdout.write( "=> %s rows updated\n" % (rc.rowcount,) )
+        authseq = self._first_values( "Atom_site", ("Label_entity_ID","Label_comp_index_ID","Label_comp_ID",
+                "PDBX_label_asym_ID","Entry_ID"), "Auth_seq_ID" )
+        self._update_from_map( "PDBX_poly_seq_scheme", "Auth_seq_num", ("Entity_ID","Comp_index_ID","Comp_ID",
+                "Asym_ID","Entry_ID"), authseq )
 
-        sql = 'update "Entity_comp_index" set "Auth_seq_ID"=(select "Auth_seq_ID" from "PDBX_poly_seq_scheme" ' \
-            + ' where "Entity_comp_index"."Entity_ID"="Entity_ID" and ' \
-            + '"Entity_comp_index"."ID"="Comp_index_ID" and ' \
-            + '"Entity_comp_index"."Comp_ID"="Comp_ID" and ' \
-            + '"Entity_comp_index"."Entry_ID"="Entry_ID")'
-        if self.verbose :
-            sys.stdout.write( sql + "\n" )
-        rc = self._db.execute( sql )
-        if self.verbose :
-            sys.stdout.write( "=> %s rows updated\n" % (rc.rowcount,) )
+        self._update_from_map( "Entity_comp_index", "Auth_seq_ID", ("Entity_ID","ID","Comp_ID","Entry_ID"),
+                self._first_values( "PDBX_poly_seq_scheme", ("Entity_ID","Comp_index_ID","Comp_ID","Entry_ID"),
+                    "Auth_seq_ID" ) )
 
 # non-polymer entities
 #
         if not has_nonpoly_entity :
             return
 
-        sql = 'update "PDBX_nonpoly_scheme" set "Auth_seq_num"=(select "Auth_seq_ID" from "Atom_site" ' \
-            + ' where "PDBX_nonpoly_scheme"."Entity_ID"="Label_entity_ID" and ' \
-            + '"PDBX_nonpoly_scheme"."Comp_index_ID"="Label_comp_index_ID" and ' \
-            + '"PDBX_nonpoly_scheme"."Comp_ID"="Label_comp_ID" and ' \
-            + '"PDBX_nonpoly_scheme"."Asym_ID"="PDBX_label_asym_ID" and ' \
-            + '"PDBX_nonpoly_scheme"."Entry_ID"="Entry_ID")'
-        if self.verbose :
-            sys.stdout.write( sql + "\n" )
-        rc = self._db.execute( sql )
-        if self.verbose :
-            sys.stdout.write( "=> %s rows updated\n" % (rc.rowcount,) )
+        self._update_from_map( "PDBX_nonpoly_scheme", "Auth_seq_num", ("Entity_ID","Comp_index_ID","Comp_ID",
+                "Asym_ID","Entry_ID"), authseq )
 
 # non-poly probably has no rows in entity_comp_index
 #
@@ -1958,20 +2269,78 @@ class BMRBEntry( object ) :
 
         else :
 
-# try to update existing rows
+# try to update existing rows. (Entity_comp_index has no Auth_seq_num: sqlite took it for a string
+# and never updated anything.)
 #
             sql = 'update "Entity_comp_index" set "Auth_seq_ID"=(select "Auth_seq_ID" from "PDBX_nonpoly_scheme" ' \
                 + ' where "Entity_comp_index"."Entity_ID"="Entity_ID" and ' \
                 + '"Entity_comp_index"."ID"="Comp_index_ID" and ' \
                 + '"Entity_comp_index"."Comp_ID"="Comp_ID" and ' \
                 + '"Entity_comp_index"."Entry_ID"="Entry_ID") ' \
-                + 'where "Auth_seq_num" is null'
+                + 'where "Auth_seq_ID" is null'
             if self.verbose :
                 sys.stdout.write( sql + "\n" )
             rc = self._db.execute( sql )
             if self.verbose :
                 sys.stdout.write( "=> %s rows updated\n" % (rc.rowcount,) )
 
+    # { key : value } from all rows of table: first row with that key, same as what
+    #  update ... set x=(select column from table where keys...)
+    # would pick. Keys with nulls are skipped: they never match.
+    #
+    def _first_values( self, table, keys, column ) :
+        sql = 'select %s,"%s" from "%s"' % (",".join( '"%s"' % (k,) for k in keys ),column,table)
+        if self.verbose :
+            sys.stdout.write( sql + "\n" )
+        rc = {}
+        for row in self._db.query( sql ) :
+            key = tuple( row[:-1] )
+            if None in key : continue
+            if not key in rc : rc[key] = row[-1]
+        return rc
+
+    # update table set column = values[keys], null where there's no key.
+    # values go into a scratch table with unique index on the keys so that the update is one indexed lookup
+    # per row instead of a scan of the other table.
+    # The scratch table is made from the table's own key columns so they have the same types (in sqlite:
+    # affinity). With text keys every comparison to e.g. an integer column converts the key and the
+    # index can't be used.
+    #
+    def _update_from_map( self, table, column, keys, values ) :
+        keycols = ["k%d" % (i,) for i in range( len( keys ) )]
+        self._db.execute( 'drop table if exists "%s"' % (self.MAP_TABLE_NAME,) )
+        sql = 'create table "%s" as select %s,"%s" as val from "%s" where 1=0' % (self.MAP_TABLE_NAME,
+            ",".join( '"%s" as %s' % (keys[i],keycols[i]) for i in range( len( keys ) ) ),column,table)
+        if self.verbose :
+            sys.stdout.write( sql + "\n" )
+        self._db.execute( sql )
+        sql = 'create unique index "%s_keys" on "%s" (%s)' % (self.MAP_TABLE_NAME,self.MAP_TABLE_NAME,
+            ",".join( keycols ))
+        if self.verbose :
+            sys.stdout.write( sql + "\n" )
+        self._db.execute( sql )
+
+# one executemany() on the DB-API cursor, so placeholders are the driver's: sqlite3 or psycopg2
+#
+        rs = self._db.query( 'select * from "%s"' % (self.MAP_TABLE_NAME,), newcursor = True )
+        mark = isinstance( rs.cursor, sqlite3.Cursor ) and "?" or "%s"
+        sql = 'insert into "%s" (%s,val) values (%s)' % (self.MAP_TABLE_NAME,",".join( keycols ),
+            ",".join( mark for i in range( len( keycols ) + 1 ) ))
+        if self.verbose :
+            sys.stdout.write( "%s: %d rows\n" % (sql,len( values )) )
+        rs.cursor.executemany( sql, (tuple( key ) + (val,) for (key, val) in values.iteritems()) )
+        rs.cursor.close()
+
+        sql = 'update "%s" set "%s"=(select val from "%s" m where %s)' % (table,column,self.MAP_TABLE_NAME,
+            " and ".join( 'm.%s="%s"."%s"' % (keycols[i],table,keys[i]) for i in range( len( keys ) ) ))
+        if self.verbose :
+            sys.stdout.write( sql + "\n" )
+        rc = self._db.execute( sql )
+        if self.verbose :
+            sys.stdout.write( "=> %s rows updated\n" % (rc.rowcount,) )
+
+        self._db.execute( 'drop table "%s"' % (self.MAP_TABLE_NAME,) )
+
     ###############################################################################################
     # Conformers
     #
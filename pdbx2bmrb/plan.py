@@ -0,0 +1,376 @@
+#!/usr/bin/python -u
+#
+# conversion plan: which NMR-STAR tables go into which saveframe, in what order,
+# and which BMRBEntry methods build and fix up each saveframe category.
+#
+# The grouping only depends on the tag map and the dictionary. It's built once and, if there's a compiled
+# tag map, saved next to it as JSON and rebuilt when the compiled tag map is.
+#
+# For each saveframe category the plan has:
+#  tables    : NMR-STAR tables in the tag map, in dictionary order, with their position in the dictionary
+#  free      : which of those are free tables
+#  unique    : is it a unique saveframe category
+#
+# Builders and fix-up methods are code, not data: they're looked up in STEPS when the plan runs,
+# so a saved plan can't call methods that were renamed since.
+#
+
+from __future__ import absolute_import
+
+import sys
+import os
+import json
+import sqlite3
+import tempfile
+
+import pdbx2bmrb
+from pdbx2bmrb import tagmap
+
+PLAN_VERSION = 2
+
+# saveframe category : (builder, arguments, [(method, arguments), ...])
+#
+# builder is a BMRBEntry method called with cifdb and tables, except "source":
+#  natural and experimental source are mapped separately for each entity Src_method
+#  (OneDepToBmrb.map_natural_source() or map_experimental_source(), see _build_source())
+#
+STEPS = {
+    "entry_interview" : ("make_unique_saveframe",
+            { "category" : "entry_interview", "freetable" : "Entry_interview", "idtag" : "ID" },
+            [("fix_entry_interview", {})]),
+    "deposited_data_files" : ("make_unique_saveframe",
+            { "category" : "deposited_data_files", "freetable" : "Deposited_data_files",
+                "idtag" : "Deposited_data_files_ID" },
+            [("fix_upload_files", {})]),
+    "entry_information" : ("make_entry_information", {}, [("fix_entry", {})]),
+    "citations" : ("make_citations", {}, [("fix_citations", {})]),
+    "assembly" : ("make_unique_saveframe",
+            { "category" : "assembly", "freetable" : "Assembly", "idtag" : "Assembly_ID" },
+            []),
+    "entity" : ("make_entities", {}, [("fix_entity_assembly", {}), ("fix_entity", {})]),
+    "natural_source" : ("source",
+            { "mapper" : "map_natural_source", "category" : "natural_source",
+                "freetable" : "Entity_natural_src_list", "idtag" : "Entity_natural_src_list_ID" },
+            [("fix_natural_source", {})]),
+    "experimental_source" : ("source",
+            { "mapper" : "map_experimental_source", "category" : "experimental_source",
+                "freetable" : "Entity_experimental_src_list", "idtag" : "Entity_experimental_src_list_ID" },
+            [("fix_experimental_source", {})]),
+    "chem_comp" : ("make_chem_comps", {}, []),
+    "sample" : ("make_replicable_saveframe",
+            { "category" : "sample", "ciftable" : "pdbx_nmr_sample_details", "cifidtag" : "solution_id",
+                "freetable" : "Sample", "idtag" : "Sample_ID" },
+            [("fix_sample", {})]),
+    "sample_conditions" : ("make_sample_conditions", {}, []),
+    "software" : ("make_warez", {}, []),
+    "NMR_spectrometer" : ("make_replicable_saveframe",
+            { "category" : "NMR_spectrometer", "ciftable" : "pdbx_nmr_spectrometer",
+                "cifidtag" : "spectrometer_id", "freetable" : "NMR_spectrometer", "idtag" : "NMR_spectrometer_ID" },
+            []),
+    "NMR_spectrometer_list" : ("make_unique_saveframe",
+            { "category" : "NMR_spectrometer_list", "freetable" : "NMR_spectrometer_list",
+                "idtag" : "NMR_spectrometer_list_ID" },
+            [("fix_spectrometer_list", {})]),
+    "experiment_list" : ("make_unique_saveframe",
+            { "category" : "experiment_list", "freetable" : "Experiment_list", "idtag" : "Experiment_list_ID" },
+            [("fix_experiment", {})]),
+    "chem_shift_reference" : ("make_replicable_saveframe",
+            { "category" : "chem_shift_reference", "ciftable" : "pdbx_nmr_chem_shift_reference",
+                "cifidtag" : "id", "freetable" : "Chem_shift_reference", "idtag" : "Chem_shift_reference_ID" },
+            []),
+    "assigned_chemical_shifts" : ("make_replicable_saveframe",
+            { "category" : "assigned_chemical_shifts", "ciftable" : "pdbx_nmr_assigned_chem_shift_list",
+                "cifidtag" : "id", "freetable" : "Assigned_chem_shift_list", "idtag" : "Assigned_chem_shift_list_ID" },
+            []),
+    "conformer_statistics" : ("make_unique_saveframe",
+            { "category" : "conformer_statistics", "freetable" : "Conformer_stat_list",
+                "idtag" : "Conformer_stat_list_ID" },
+            [("fix_conformer_stats", {})]),
+    "conformer_family_coord_set" : ("make_unique_saveframe",
+            { "category" : "conformer_family_coord_set", "freetable" : "Conformer_family_coord_set",
+                "idtag" : "Conformer_family_coord_set_ID" },
+            [("fix_coordinates", {}), ("fix_comp_index", {})]),
+    "representative_conformer" : ("make_unique_saveframe",
+            { "category" : "representative_conformer", "freetable" : "Representative_conformer",
+                "idtag" : "Representative_conformer_ID" },
+            [("fix_rep_conf", {})]),
+    "constraint_statistics" : ("make_unique_saveframe",
+            { "category" : "constraint_statistics", "freetable" : "Constraint_stat_list",
+                "idtag" : "Constraint_stat_list_ID" },
+            [("fix_constraint_stats", {})]),
+    "spectral_peak_list" : ("make_replicable_saveframe",
+            { "category" : "spectral_peak_list", "ciftable" : "pdbx_nmr_spectral_peak_list", "cifidtag" : "id",
+                "freetable" : "Spectral_peak_list", "idtag" : "Spectral_peak_list_ID" },
+            [("add_software_framecodes", { "table" : "Spectral_peak_software" }), ("fix_peaklist", {})]),
+}
+
+# json gives back unicode keys
+#
+def _strkeys( d ) :
+    rc = {}
+    for (k, v) in d.items() :
+        rc[str( k )] = v
+    return rc
+
+#
+#
+class ConversionPlan( object ) :
+
+    _categories = None
+    _sources = None
+    _verbose = False
+
+    #
+    #
+    def __init__( self, categories, sources = None, verbose = False ) :
+        self._categories = categories
+        if sources is None : sources = []
+        self._sources = sources
+        self._verbose = bool( verbose )
+
+    @property
+    def verbose( self ) :
+        """debugging flag"""
+        return bool( self._verbose )
+    @verbose.setter
+    def verbose( self, flag ) :
+        self._verbose = bool( flag )
+
+    @property
+    def categories( self ) :
+        return [c["category"] for c in self._categories]
+
+    def __getitem__( self, category ) :
+        for c in self._categories :
+            if c["category"] == category : return c
+        raise KeyError( category )
+
+    # plan for tag map in mapdb.
+    # sources: [(path, mtime, size, sha1)] the tag map was made from, see tagmap.source_info()
+    #
+    @classmethod
+    def build( cls, mapdb, stardict, sources = None, verbose = False ) :
+        if verbose : sys.stdout.write( "%s.build()\n" % (cls.__name__,) )
+        assert isinstance( mapdb, sqlite3.Connection )
+
+        mapped = set()
+        for row in mapdb.execute( "select distinct bmrb_table from tagmap" ) :
+            mapped.add( row[0] )
+
+        cats = []
+        index = {}
+        pos = 0
+        for table in stardict.iter_tables() :
+            pos += 1
+            if not table in mapped : continue
+            sfcat = stardict.get_saveframe_category( table = table )
+            if not sfcat in index :
+
+                index[sfcat] = len( cats )
+                cats.append( { "category" : sfcat,
+                    "tables" : [],
+                    "free" : [],
+                    "unique" : bool( stardict.is_unique_category( sfcat ) ) } )
+            c = cats[index[sfcat]]
+            c["tables"].append( [table, pos] )
+            if stardict.is_free_table( table = table ) :
+                c["free"].append( table )
+
+        return cls( cats, sources = sources, verbose = verbose )
+
+    #
+    #
+    def to_dict( self ) :
+        return { "version" : PLAN_VERSION, "sources" : self._sources, "categories" : self._categories }
+
+    @classmethod
+    def from_dict( cls, d, verbose = False ) :
+        if not isinstance( d, dict ) :
+            raise ValueError( "Conversion plan is not a JSON object" )
+        if d.get( "version" ) != PLAN_VERSION :
+            raise ValueError( "Conversion plan version %s, need %s" % (d.get( "version" ),PLAN_VERSION) )
+        cats = []
+        for c in d["categories"] :
+            c = _strkeys( c )
+            c["category"] = str( c["category"] )
+            c["tables"] = [[str( t ), int( p )] for (t, p) in c["tables"]]
+            c["free"] = [str( t ) for t in c["free"]]
+            c["unique"] = bool( c["unique"] )
+            cats.append( c )
+        return cls( cats, sources = [list( s ) for s in d["sources"]], verbose = verbose )
+
+    # temp file is unique: concurrent runs may all be saving the plan
+    #
+    def save( self, filename ) :
+        fname = os.path.realpath( filename )
+        (fd, tmpname) = tempfile.mkstemp( suffix = ".tmp", dir = os.path.split( fname )[0] )
+        try :
+            with os.fdopen( fd, "wb" ) as f :
+                json.dump( self.to_dict(), f, indent = 1, sort_keys = True )
+            os.rename( tmpname, fname )
+        except :
+            if os.path.exists( tmpname ) :
+                os.unlink( tmpname )
+            raise
+
+    @classmethod
+    def load( cls, filename, verbose = False ) :
+        with open( os.path.realpath( filename ), "rb" ) as f :
+            return cls.from_dict( json.load( f ), verbose = verbose )
+
+    # saved plan was made from these files. Same as tagmap.is_current():
+    # if mtime changed but contents didn't, it's still good.
+    #
+    def is_current( self, sources ) :
+        if len( self._sources ) != len( sources ) : return False
+        for (have, src) in zip( self._sources, sources ) :
+            path = os.path.realpath( src )
+            if have[0] != path : return False
+            st = os.stat( path )
+            if (st.st_mtime == have[1]) and (st.st_size == have[2]) : continue
+            if tagmap.source_info( path )[3] != have[3] : return False
+        return True
+
+    # mapped StarTables grouped by saveframe category: [(category plan, [tables])]
+    # categories and tables are in dictionary order of the tables that are there.
+    #
+    def groups( self, tables ) :
+        have = {}
+        for t in tables :
+            have[t.table] = t
+        rc = []
+        for c in self._categories :
+            found = [(pos, have[name]) for (name, pos) in c["tables"] if name in have]
+            if len( found ) < 1 : continue
+            rc.append( (found[0][0], c, [t for (pos, t) in found]) )
+        rc.sort( key = lambda x : x[0] )
+        return [(c, t) for (pos, c, t) in rc]
+
+    # unique saveframe category with more than one row in the free table
+    # returns the offending table or None
+    #
+    def check( self, category, tables ) :
+        if not category["unique"] : return None
+        for t in tables :
+            if not t.table in category["free"] : continue
+            if t.numvals < 2 : continue
+
+# transform code 50: may collapse multiple mmcif rows into one nmr-star row so this could be OK
+#
+            if t.is_fifty : continue
+            return t
+        return None
+
+    # (builder, arguments, [(method, arguments), ...]) for saveframe category, from STEPS
+    # builder is None if there isn't one: that's only an error if there's something to map
+    #
+    @staticmethod
+    def steps( category ) :
+        return STEPS.get( category, (None, {}, []) )
+
+    # run the plan
+    #
+    def execute( self, star, cifdb, tables, verbose = False ) :
+        for (category, sftables) in self.groups( tables ) :
+            if self._verbose or verbose :
+                sys.stdout.write( "%s.execute(): %s\n" % (self.__class__.__name__,category["category"]) )
+            (builder, args, after) = self.steps( category["category"] )
+            if builder is None :
+                raise Exception( "Don't know how to map saveframe category %s" % (category["category"],) )
+            if builder == "source" :
+                self._build_source( star, cifdb, verbose = verbose, **args )
+            else :
+                getattr( star, builder )( cifdb = cifdb, tables = sftables, **args )
+            for (method, args) in after :
+                getattr( star, method )( **args )
+
+    # 2015-11-19
+    # natural and experimental sources
+    #
+    #  Expn by Monica Sekharan (RCSB)
+    # For source information, you can review the following tags to see whether an entity is nat, man, or syn.
+    # _entity.id
+    # _entity.src_method
+    # If _entity.src_method is nat, then only the information for entity_src_nat will be populated.
+    # If _entity.src_method is man, then only the information for entity_src_gen will be populated.
+    # If _entity.src_method is syn, then only the information for entity_src_syn will be populated.
+    #
+    # When a protein is naturally obtained without an expression system, entity_src_nat is filled in,
+    # not the entity_src_gen and vice versa for a genetically manipulated system.
+    #
+    # [When] there is only a natural source for entity (no experimental source) which can be found here:
+    # _entity_src_nat.pdbx_organism_scientific
+    #
+    # the natural source for the synthetically created entity can be found here:
+    # _pdbx_entity_src_syn.organism_scientific
+    #
+    # [When] he source for the protein is man only the _entity_src_gen is populated.  Within
+    # _entity_src_gen you can find the natural source here:
+    # _entity_src_gen.pdbx_gene_src_scientific_name
+    # and the experimental source here:
+    # _entity_src_gen.pdbx_host_org_scientific_name
+    #
+    # When the entity was both extracted from a natural source and was generated from an expression
+    # system both the natural source and expression system go under _entity_src_gen
+    #
+    # In this loop, anything that starts with _entity_src_gen.pdbx_gene_src gives you information
+    # about the natural source. For example, the natural source scientific name is here:
+    # _entity_src_gen.pdbx_gene_src_scientific_name
+    #
+    # Anything that starts with _entity_src_gen.pdbx_host_org gives you information about the expression
+    # system. For example, the expression system scientific name is here:
+    # _entity_src_gen.pdbx_host_org_scientific_name
+    #
+    # for both natural and experimental source, we just need to select rows for given entity ID.
+    #
+    def _build_source( self, star, cifdb, mapper, category, freetable, idtag, verbose = False ) :
+        crystal = {}
+        for (eid,meth) in star._db.iter_values( table = "Entity", columns = ("ID","Src_method") ) :
+            if meth is None : meth = "man"
+            if not meth in crystal.keys() :
+                crystal[meth] = getattr( pdbx2bmrb.OneDepToBmrb, mapper )( cifdb = cifdb,
+                        mapdb = cifdb.connection, method = meth, verbose = verbose )
+
+        for meth in crystal.keys() :
+            if crystal[meth] is not None :
+                star.make_unique_saveframe( cifdb = cifdb, tables = crystal[meth], category = category,
+                    freetable = freetable, idtag = idtag )
+
+# plan for the tag map in mapdb. If compiled tag map is used, the plan is saved next to it
+# and rebuilt when the tag map or dictionary changes.
+#
+def plan_file( compiled ) :
+    return os.path.splitext( os.path.realpath( compiled ) )[0] + ".plan.json"
+
+# sources are the tag map and dictionary files
+#
+def load_plan( mapdb, stardict, compiled = None, sources = None, verbose = False ) :
+    if compiled is None :
+        return ConversionPlan.build( mapdb, stardict, verbose = verbose )
+
+    if sources is None : sources = []
+
+    fname = plan_file( compiled )
+    if os.path.exists( fname ) :
+        try :
+            plan = ConversionPlan.load( fname, verbose = verbose )
+            if plan.is_current( sources ) :
+                if verbose : sys.stdout.write( "* load_plan %s\n" % (fname,) )
+                return plan
+        except (ValueError, KeyError, TypeError) :
+            pass
+
+    info = [list( tagmap.source_info( src ) ) for src in sources]
+    plan = ConversionPlan.build( mapdb, stardict, sources = info, verbose = verbose )
+    if verbose : sys.stdout.write( "* save plan %s\n" % (fname,) )
+    plan.save( fname )
+    return plan
+
+#
+#
+if __name__ == "__main__" :
+    sys.stdout.write( json.dumps( ConversionPlan.load( sys.argv[1] ).to_dict(), indent = 1, sort_keys = True ) + "\n" )
+
+#
+# eof
+#
@@ -0,0 +1,110 @@
+#!/usr/bin/python -u
+#
+# sqlite connection profiles: named sets of pragmas.
+#
+# "default" doesn't change anything.
+# "bulk" is for loading in-memory databases that are thrown away afterwards: no journal, no fsync,
+#  bigger page cache, temp tables in memory.
+#
+# select in pdbx2bmrb.conf:
+#  [pdbx] profile = bulk   -- mmCIF database (CifReader)
+#  [entry] profile = bulk  -- NMR-STAR database (BMRBEntry), sqlite3 engine only
+#
+
+from __future__ import absolute_import
+
+import sys
+import sqlite3
+import collections
+from contextlib import contextmanager
+
+# page_size only works before the first table is created
+#
+PROFILES = {
+    "default" : collections.OrderedDict(),
+    "bulk" : collections.OrderedDict( [
+        ("page_size", "8192"),
+        ("journal_mode", "off"),
+        ("synchronous", "off"),
+        ("cache_size", "-65536"),
+        ("temp_store", "memory"),
+        ] ),
+}
+
+# pragmas we report whether the profile sets them or not
+#
+REPORTED = ("page_size", "journal_mode", "synchronous", "cache_size", "temp_store")
+
+#
+#
+def get_profile( name ) :
+    if name is None : return PROFILES["default"]
+    key = str( name ).strip().lower()
+    if not key in PROFILES :
+        raise ValueError( "Unknown sqlite profile: %s (have: %s)" % (name,", ".join( sorted( PROFILES.keys() ) )) )
+    return PROFILES[key]
+
+# apply named profile to connection.
+# execute is a callable that runs sql and returns iterable rows:
+#  sqlite3.Connection.execute or e.g. starobj NMRSTAREntry.query.
+# returns effective settings as OrderedDict.
+#
+def apply_profile( execute, name, verbose = False ) :
+    if isinstance( execute, sqlite3.Connection ) :
+        execute = execute.execute
+    for (pragma, value) in get_profile( name ).items() :
+        sql = "pragma %s=%s" % (pragma,value)
+        if verbose :
+            sys.stdout.write( sql + "\n" )
+        for row in execute( sql ) :
+            pass
+    return read_settings( execute )
+
+# current values of REPORTED pragmas
+#
+def read_settings( execute ) :
+    if isinstance( execute, sqlite3.Connection ) :
+        execute = execute.execute
+    rc = collections.OrderedDict()
+    for pragma in REPORTED :
+        for row in execute( "pragma %s" % (pragma,) ) :
+            rc[pragma] = row[0]
+    return rc
+
+#
+#
+def format_settings( name, settings ) :
+    return "%s: %s" % ((name is None and "default" or name),
+        ", ".join( "%s=%s" % (k,v) for (k,v) in settings.items() ))
+
+# run the block in one explicit transaction: begin ... commit, rollback on error.
+# sqlite3 module's implicit transactions commit before every DDL statement in python 2,
+# with isolation_level = None we do it ourselves.
+#
+@contextmanager
+def transaction( conn ) :
+    assert isinstance( conn, sqlite3.Connection )
+    saved = conn.isolation_level
+    conn.commit()
+    conn.isolation_level = None
+    conn.execute( "begin" )
+    try :
+        yield conn
+        conn.commit()
+    except :
+        conn.rollback()
+        raise
+    finally :
+        conn.isolation_level = saved
+
+#
+#
+if __name__ == "__main__" :
+    for name in sorted( PROFILES.keys() ) :
+        conn = sqlite3.connect( ":memory:" )
+        sys.stdout.write( format_settings( name, apply_profile( conn, name ) ) + "\n" )
+        conn.close()
+
+#
+# eof
+#
@@ -0,0 +1,259 @@
+#!/usr/bin/python -u
+#
+# streaming NMR-STAR writer.
+#
+# starobj.StarWriter.pretty_print() builds the whole entry before writing it out, with coordinates
+# and chemical shifts that's most of the memory we use. This one goes saveframe by saveframe, loop
+# by loop, and writes rows as they come off the database cursor.
+#
+# Saveframe categories and tables are in dictionary order, saveframes in Sf_ID order, loop rows
+# in local ID order if the table has one. Column widths come from a max(length()) query per loop
+# before the rows are read, plus 2 for the quotes if the longest value needs them (see QUOTE_SQL).
+# Values that go in semicolon blocks don't count (see BLOCK_SQL): they're written outside the grid.
+# Values are padded after quoting, by characters. Sf_ID columns are internal and don't go in the output.
+#
+# out is anything with write(): plain file, gzip/bz2 file (see compress.create_file()), stdout.
+#
+
+from __future__ import absolute_import
+
+import sys
+import os
+import re
+import collections
+import time
+
+_UP = os.path.realpath( "%s/../" % (os.path.split( __file__ )[0],) )
+sys.path.append( _UP )
+import pdbx2bmrb
+
+# values that need quoting: whitespace anywhere, STAR special characters at the start
+#
+QUOTE_PAT = re.compile( r"\s|^[_#$'\"\[\];]|^(?:data|save|loop|stop|global)_", re.IGNORECASE )
+
+# same test in SQL for loop column widths (no regexps: has to work in any engine).
+# %(col)s is the quoted column name, the like patterns are in QUOTE_SQL_PARAMS.
+#
+QUOTE_SQL = "(%(col)s like :space or %(col)s like :tab or %(col)s like :cr " \
+    + """or substr(%(col)s,1,1) in ('_','#','$','''','"','[',']',';') """ \
+    + "or (substr(%(col)s,5,1)='_' and lower(substr(%(col)s,1,4)) in ('data','save','loop','stop')) " \
+    + "or (substr(%(col)s,7,1)='_' and lower(substr(%(col)s,1,6))='global'))"
+
+# and values quote_text() puts in semicolon blocks: multi-line, or need quoting and have both kinds of quotes
+#
+BLOCK_SQL = "(%(col)s like :nl or (%(col)s like :sq and %(col)s like :dq and " + QUOTE_SQL + "))"
+QUOTE_SQL_PARAMS = { "space" : "% %", "tab" : "%\t%", "cr" : "%\r%", "nl" : "%\n%", "sq" : "%'%", "dq" : '%"%' }
+
+# there's no escape for a line that starts with a semicolon inside a semicolon-delimited value:
+# it would end the value. Such lines get a leading space.
+#
+SEMICOLON_LINE = re.compile( r"^;", re.MULTILINE )
+
+NULL_VALUE = "."
+SFID_COL = "Sf_ID"
+FRAMECODE_COL = "Sf_framecode"
+LOCAL_ID_COL = "ID"
+
+# loop values repeat a lot (residue and atom names, IDs): keep up to this many quoted values per loop
+#
+QUOTE_CACHE_SIZE = 65536
+
+TAG_INDENT = "   "
+LOOP_INDENT = "      "
+
+# STAR value for output: "." for no value, quoted or semicolon-delimited if it has to be
+#
+def quote( value ) :
+    return quote_text( value ).encode( "utf-8" )
+
+# same as unicode: padding it pads by characters, not utf-8 bytes
+#
+def quote_text( value ) :
+    if value is None : return unicode( NULL_VALUE )
+    if isinstance( value, str ) : value = value.decode( "utf-8" )
+    elif not isinstance( value, unicode ) : value = unicode( value )
+    if len( value ) < 1 : return unicode( NULL_VALUE )
+    if "\n" in value :
+        return "\n;\n%s\n;\n" % (SEMICOLON_LINE.sub( " ;", value.rstrip( "\n" ) ),)
+    if not QUOTE_PAT.search( value ) : return value
+    if not "'" in value : return "'%s'" % (value,)
+    if not '"' in value : return '"%s"' % (value,)
+    return "\n;\n%s\n;\n" % (SEMICOLON_LINE.sub( " ;", value ),)
+
+#
+#
+class StarStreamWriter( object ) :
+
+    # write out the whole entry
+    #
+    @classmethod
+    def write_entry( cls, entry, out, verbose = False ) :
+        assert isinstance( entry, pdbx2bmrb.BMRBEntry )
+        assert hasattr( out, "write" )
+        wrt = cls( entry, verbose = verbose )
+        wrt.write( out )
+        return wrt
+
+    #
+    #
+    def __init__( self, entry, verbose = False ) :
+        self._entry = entry
+        self.verbose = verbose
+        self._columns = {}
+        self._rows = 0
+
+    #
+    #
+    @property
+    def verbose( self ) :
+        """Debugging flag"""
+        return self._verbose
+    @verbose.setter
+    def verbose( self, flag ) :
+        self._verbose = bool( flag )
+
+    # number of loop rows written
+    #
+    @property
+    def rows( self ) :
+        return self._rows
+
+    # [(category, free table, [loop tables])] in dictionary order
+    #
+    def categories( self ) :
+        dic = self._entry._dic
+        cats = collections.OrderedDict()
+        for table in dic.iter_tables() :
+            cat = dic.get_saveframe_category( table )
+            if cat is None : continue
+            if not cat in cats : cats[cat] = [None, []]
+            if dic.is_free_table( table ) : cats[cat][0] = table
+            else : cats[cat][1].append( table )
+        return [(cat, cats[cat][0], cats[cat][1]) for cat in cats.keys() if cats[cat][0] is not None]
+
+    # column names in database order (same as dictionary order: starobj creates tables from it).
+    # None if there's no such table or it has no Sf_ID.
+    #
+    def columns( self, table ) :
+        if table in self._columns : return self._columns[table]
+        cols = None
+        try :
+            rs = self._entry._db.query( 'select * from "%s" limit 0' % (table,), newcursor = True )
+            cols = [str( d[0] ) for d in rs.cursor.description]
+            rs.cursor.close()
+        except Exception :
+            if self._verbose :
+                sys.stdout.write( "no table %s\n" % (table,) )
+        if (cols is not None) and (not SFID_COL in cols) : cols = None
+        self._columns[table] = cols
+        return cols
+
+    #
+    #
+    def write( self, out ) :
+        start = time.time()
+        out.write( "data_%s\n\n" % (self._entry.entryid,) )
+        for (category, freetable, loops) in self.categories() :
+            cols = self.columns( freetable )
+            if cols is None : continue
+            sql = 'select %s from "%s" order by cast("%s" as integer)' \
+                % (",".join( '"%s"' % (c,) for c in cols ),freetable,SFID_COL)
+            if self._verbose :
+                sys.stdout.write( sql + "\n" )
+            rs = self._entry._db.query( sql, newcursor = True )
+            for row in rs :
+                self.write_saveframe( out, freetable, cols, row, loops )
+            rs.cursor.close()
+        if self._verbose :
+            sys.stdout.write( "wrote %d loop rows in %0.3f\n" % (self._rows,(time.time() - start)) )
+
+    # free table row is the saveframe
+    #
+    def write_saveframe( self, out, freetable, cols, row, loops ) :
+        values = dict( zip( cols, row ) )
+        sfid = values[SFID_COL]
+        name = values.get( FRAMECODE_COL )
+        if name is None : name = "%s_%s" % (freetable,sfid)
+        out.write( "save_%s\n" % (name,) )
+
+        tags = [c for c in cols if c != SFID_COL]
+        width = max( len( freetable ) + len( c ) + 2 for c in tags )
+        for col in tags :
+            tag = "_%s.%s" % (freetable,col)
+            val = quote( values[col] )
+            if val.startswith( "\n" ) : out.write( "%s%s%s" % (TAG_INDENT,tag,val) )
+            else : out.write( "%s%s  %s\n" % (TAG_INDENT,tag.ljust( width ),val) )
+        out.write( "\n" )
+
+        for table in loops :
+            self.write_loop( out, table, sfid )
+
+        out.write( "save_\n\n" )
+
+    # loop rows of one saveframe: widths first, then rows straight from the cursor
+    #
+    def write_loop( self, out, table, sfid ) :
+        cols = self.columns( table )
+        if cols is None : return
+        tags = [c for c in cols if c != SFID_COL]
+        if len( tags ) < 1 : return
+
+        params = dict( QUOTE_SQL_PARAMS )
+        params["sfid"] = sfid
+        sql = 'select count(*),%s from "%s" where "%s"=:sfid' \
+            % (",".join( 'max(case when %s then null when %s then length("%s")+2 else length("%s") end)' \
+                % (BLOCK_SQL % { "col" : '"%s"' % (c,) },QUOTE_SQL % { "col" : '"%s"' % (c,) },c,c) \
+                for c in tags ),table,SFID_COL)
+        if self._verbose :
+            sys.stdout.write( sql + "\n" )
+        rs = self._entry._db.query( sql, params, newcursor = True )
+        stats = rs.next()
+        rs.cursor.close()
+        if (stats is None) or (not stats[0]) : return
+        widths = [max( w or 0, len( NULL_VALUE ) ) for w in stats[1:]]
+        params = { "sfid" : sfid }
+
+        out.write( "%sloop_\n" % (TAG_INDENT,) )
+        for col in tags :
+            out.write( "%s_%s.%s\n" % (LOOP_INDENT,table,col) )
+        out.write( "\n" )
+
+        sql = 'select %s from "%s" where "%s"=:sfid' % (",".join( '"%s"' % (c,) for c in tags ),table,SFID_COL)
+        if LOCAL_ID_COL in tags :
+            sql += ' order by cast("%s" as integer)' % (LOCAL_ID_COL,)
+        if self._verbose :
+            sys.stdout.write( sql + "\n" )
+
+# unicode format pads by characters. Quoted values are cached by type and value: 1, 1.0 and True
+# are equal keys but don't print the same.
+#
+        fmt = u" ".join( u"%%-%ds" % (w,) for w in widths )
+        quoted = {}
+        rs = self._entry._db.query( sql, params, newcursor = True )
+        for row in rs :
+            vals = []
+            for val in row :
+                key = (type( val ), val)
+                try :
+                    vals.append( quoted[key] )
+                except KeyError :
+                    rc = quote_text( val )
+                    if len( quoted ) < QUOTE_CACHE_SIZE : quoted[key] = rc
+                    vals.append( rc )
+            line = fmt % tuple( vals )
+            if line.endswith( "\n" ) : out.write( (LOOP_INDENT + line).encode( "utf-8" ) )
+            else : out.write( (LOOP_INDENT + line.rstrip( " " ) + "\n").encode( "utf-8" ) )
+            self._rows += 1
+        rs.cursor.close()
+
+        out.write( "%sstop_\n\n" % (TAG_INDENT,) )
+
+#
+#
+if __name__ == "__main__" :
+    for val in sys.argv[1:] :
+        sys.stdout.write( "%s\n" % (quote( val ),) )
+
+#
+# eof
+#
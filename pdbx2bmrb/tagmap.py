@@ -12,6 +12,8 @@ import csv
 import sqlite3
 import re
 import pprint
+import hashlib
+import tempfile
 
 from optparse import OptionParser
 
@@ -78,6 +80,141 @@ def readcsv( mapdb, filename, stardict, verbose = False ) :
     curs.close()
 
 
+#########################################################################################
+# compiled tag map: sqlite file with tagmap table as made by readcsv() (non-data tags already deleted)
+# plus indexes and a list of source files. user_version is the format version.
+# It's rebuilt when the CSV or dictionary changes.
+#
+COMPILED_VERSION = 1
+
+TAGMAP_INDEXES = ( "create index tagmap_bmrb_idx on tagmap (bmrb_table)",
+    "create index tagmap_pdbx_idx on tagmap (pdbx_table)" )
+
+# (path, mtime, size, sha1)
+#
+def source_info( filename ) :
+    fname = os.path.realpath( filename )
+    st = os.stat( fname )
+    h = hashlib.sha1()
+    with open( fname, "rb" ) as f :
+        while True :
+            buf = f.read( 1048576 )
+            if not buf : break
+            h.update( buf )
+    return (fname, st.st_mtime, st.st_size, h.hexdigest())
+
+# compiled file is there, has the right version, and was made from these files.
+# if mtime changed but contents didn't, it's still good.
+#
+def is_current( compiled, sources, verbose = False ) :
+    fname = os.path.realpath( compiled )
+    if not os.path.exists( fname ) : return False
+    conn = sqlite3.connect( fname )
+    try :
+        try :
+            row = conn.execute( "pragma user_version" ).fetchone()
+            if row[0] != COMPILED_VERSION :
+                if verbose : sys.stdout.write( "%s: version %s, need %s\n" % (fname,row[0],COMPILED_VERSION) )
+                return False
+            have = {}
+            for row in conn.execute( "select path,mtime,size,sha1 from sources" ) :
+                have[row[0]] = row[1:]
+        except sqlite3.DatabaseError :
+            return False
+    finally :
+        conn.close()
+
+    if len( have ) != len( sources ) : return False
+    for src in sources :
+        path = os.path.realpath( src )
+        if not path in have : return False
+        st = os.stat( path )
+        if (st.st_mtime == have[path][0]) and (st.st_size == have[path][1]) : continue
+        if source_info( path )[3] != have[path][2] :
+            if verbose : sys.stdout.write( "%s changed\n" % (path,) )
+            return False
+    return True
+
+# build compiled tag map from CSV and dictionary.
+# dictfile is the dictionary database file (for the source list), if there is one.
+#
+def compile_tagmap( filename, stardict, outfile, dictfile = None, verbose = False ) :
+    if verbose : sys.stdout.write( "* compile_tagmap %s\n" % (outfile,) )
+
+    outname = os.path.realpath( outfile )
+    (fd, tmpname) = tempfile.mkstemp( suffix = ".sqlt3", dir = os.path.split( outname )[0] )
+    os.close( fd )
+
+    try :
+        conn = sqlite3.connect( tmpname )
+        try :
+            readcsv( mapdb = conn, filename = filename, stardict = stardict, verbose = verbose )
+            curs = conn.cursor()
+            for sql in TAGMAP_INDEXES :
+                curs.execute( sql )
+            curs.execute( "create table sources (path text,mtime real,size integer,sha1 text)" )
+            sources = [filename]
+            if dictfile is not None : sources.append( dictfile )
+            for src in sources :
+                curs.execute( "insert into sources (path,mtime,size,sha1) values (?,?,?,?)", source_info( src ) )
+            curs.execute( "pragma user_version=%d" % (COMPILED_VERSION,) )
+            conn.commit()
+            curs.close()
+        finally :
+            conn.close()
+
+        os.rename( tmpname, outname )
+    except :
+        if os.path.exists( tmpname ) :
+            os.unlink( tmpname )
+        raise
+
+# load tag map into mapdb: from compiled file if there is one (rebuild it first if out of date),
+# otherwise from CSV
+#
+def load_tagmap( mapdb, filename, stardict, compiled = None, dictfile = None, verbose = False ) :
+    if compiled is None :
+        readcsv( mapdb = mapdb, filename = filename, stardict = stardict, verbose = verbose )
+        return
+
+    assert isinstance( mapdb, sqlite3.Connection )
+
+    sources = [filename]
+    if dictfile is not None : sources.append( dictfile )
+    if not is_current( compiled, sources, verbose = verbose ) :
+        compile_tagmap( filename = filename, stardict = stardict, outfile = compiled, dictfile = dictfile,
+                verbose = verbose )
+
+    if verbose : sys.stdout.write( "* load_tagmap %s\n" % (compiled,) )
+
+# rowid order matters: map_table() doesn't sort
+#
+    mapdb.commit()
+    curs = mapdb.cursor()
+    curs.execute( "attach database ? as compiled", (os.path.realpath( compiled ),) )
+    try :
+        curs.execute( "drop table if exists main.tagmap" )
+        curs.execute( "create table main.tagmap (pdbx_table text, pdbx_col text,bmrb_table text,bmrb_col text,func integer,spec text)" )
+        curs.execute( "insert into main.tagmap select pdbx_table,pdbx_col,bmrb_table,bmrb_col,func,spec " \
+            + "from compiled.tagmap order by rowid" )
+        for sql in TAGMAP_INDEXES :
+            curs.execute( sql )
+        mapdb.commit()
+    finally :
+        curs.execute( "detach database compiled" )
+        curs.close()
+
+#########################################################################################
+# PDBX tables that are in the tag map: for loading only those
+#
+def mapped_tables( filename ) :
+    rc = set()
+    with open( filename, "rb" ) as f :
+        c = csv.DictReader( f )
+        for row in c :
+            rc.add( row["pdbx_tbl"] )
+    return rc
+
 #########################################################################################
 # make the csv tag map
 #
@@ -0,0 +1,82 @@
+#!/usr/bin/python -u
+#
+# mmCIF tag names and sqlite identifiers.
+#
+# parse_tag( "_atom_site.group_PDB" ) -> ("atom_site", "group_PDB")
+# quote_ident( "group_PDB" ) -> '"group_PDB"'
+#
+# There's only a few thousand distinct tags in the dictionary and the same ones come up for every value
+# in a file, so both are memoized. Caches are bounded: when one is full the oldest entry goes.
+# Lookups don't reorder entries, that would cost more than the regexps on the hit path.
+#
+
+from __future__ import absolute_import
+
+import sys
+import re
+import collections
+
+TAG_PATTERN = r"^_([^.]+)\.(.+)$"
+
+# names that need quoting in sqlite: start with a digit, (contain) an sql keyword we've seen
+# in the dictionary, or have special characters.
+# Quoting a name that doesn't need it is harmless.
+#
+BAD_NAME_PATTERN = r"(^\d)|(database)|(group)|(order)|([()[\]{}/\\%-])"
+
+TAG_PAT = re.compile( TAG_PATTERN )
+BAD_NAME_PAT = re.compile( BAD_NAME_PATTERN )
+
+CACHE_SIZE = 4096
+
+# memoize one-argument function, keep at most maxsize results
+#
+def _memoize( maxsize ) :
+    def wrap( func ) :
+        cache = collections.OrderedDict()
+        def memo( arg ) :
+            try :
+                return cache[arg]
+            except KeyError :
+                pass
+            rc = func( arg )
+            if len( cache ) >= maxsize :
+                cache.popitem( last = False )
+            cache[arg] = rc
+            return rc
+        memo.cache = cache
+        memo.__name__ = func.__name__
+        memo.__doc__ = func.__doc__
+        return memo
+    return wrap
+
+# (table, column) or None if it isn't a tag
+#
+@_memoize( CACHE_SIZE )
+def parse_tag( tag ) :
+    m = TAG_PAT.search( tag )
+    if not m : return None
+    return (m.group( 1 ), m.group( 2 ))
+
+# table or column name, double-quoted if it needs to be
+#
+@_memoize( CACHE_SIZE )
+def quote_ident( name ) :
+    if BAD_NAME_PAT.search( name ) : return '"%s"' % (name,)
+    return name
+
+def clear_cache() :
+    parse_tag.cache.clear()
+    quote_ident.cache.clear()
+
+#
+#
+if __name__ == "__main__" :
+    for tag in sys.argv[1:] :
+        rc = parse_tag( tag )
+        if rc is None : sys.stdout.write( "%s: not a tag\n" % (tag,) )
+        else : sys.stdout.write( "%s: %s.%s\n" % (tag,quote_ident( rc[0] ),quote_ident( rc[1] )) )
+
+#
+# eof
+#
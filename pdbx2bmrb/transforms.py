@@ -0,0 +1,298 @@
+#!/usr/bin/python -u
+#
+# tag map transform codes ("func" column in the tag map).
+#
+# A transform takes all values of one source column and returns the list of values to put in
+# the temp table column, same length, in the same order. SKIP means "leave that row alone".
+#
+#  func( values, startable, column, pdbcol )
+#   values    : list of source values in row order, None for no value
+#   startable : StarTable being mapped
+#   column    : NMR-STAR column name
+#   pdbcol    : CifCol the values came from
+#
+# Codes not in the registry copy values as is. To add a code:
+#
+#  pdbx2bmrb.TRANSFORMS.register( 60, func )
+#
+
+from __future__ import absolute_import
+
+import sys
+import re
+import time
+
+from pdbx2bmrb import asym
+
+# "don't update this row"
+#
+SKIP = object()
+
+# -15: last, given, middle initial, e.g. Doe, J.A.
+# -22: concentration range $NUM-$NUM
+#
+NAME_PAT = re.compile( r"^([A-Za-z\-. ]+),\s*([A-Za-z\-]+\.?)\s*([A-Za-z.]*)$" )
+RANGE_PAT = re.compile( r"^(.+)\s*-\s*(.+)$" )
+
+BOOLEAN_TRUE = ("y","yes","t","true","1")
+
+#
+#
+class TransformRegistry( object ) :
+
+    _funcs = None
+    _keep = None
+    _stats = None
+    _verbose = False
+
+    #
+    #
+    def __init__( self, verbose = False ) :
+        self._funcs = {}
+        self._keep = set()
+        self._stats = {}
+        self._verbose = bool( verbose )
+
+    @property
+    def verbose( self ) :
+        """debugging flag"""
+        return bool( self._verbose )
+    @verbose.setter
+    def verbose( self, flag ) :
+        self._verbose = bool( flag )
+
+    # overwrite = False: only set values in rows that don't have one yet (code 2)
+    #
+    def register( self, code, func, overwrite = True ) :
+        assert callable( func )
+        self._funcs[code] = func
+        if overwrite : self._keep.discard( code )
+        else : self._keep.add( code )
+
+    def unregister( self, code ) :
+        if code in self._funcs : del self._funcs[code]
+        self._keep.discard( code )
+
+    def __contains__( self, code ) :
+        return code in self._funcs
+
+    @property
+    def codes( self ) :
+        return sorted( self._funcs.keys() )
+
+    def overwrites( self, code ) :
+        return not code in self._keep
+
+    # transformed values for one source column
+    #
+    def apply( self, code, values, startable, column, pdbcol ) :
+        if not isinstance( values, list ) : values = list( values )
+        func = self._funcs.get( code )
+        if func is None : func = copy_values
+        start = time.time()
+        rc = func( values, startable, column, pdbcol )
+        secs = time.time() - start
+        if len( rc ) != len( values ) :
+            raise Exception( "transform code %s returned %d values for %d in %s" % (code,len( rc ),len( values ),column) )
+
+        if not code in self._stats : self._stats[code] = [0, 0, 0.0]
+        self._stats[code][0] += 1
+        self._stats[code][1] += len( values )
+        self._stats[code][2] += secs
+        if self._verbose :
+            sys.stdout.write( "transform %s: %s -> %s, %d values, %0.3f\n" % (code,pdbcol.tag,column,len( values ),secs) )
+        return rc
+
+    # same values as apply() as an iterator. Copied columns are passed through as they come
+    # (values can be a cursor), other transforms need the whole column and get it as a list.
+    #
+    def iterate( self, code, values, startable, column, pdbcol ) :
+        if not self.copies( code ) :
+            return iter( self.apply( code, values, startable, column, pdbcol ) )
+        return self._copy( code, values, column, pdbcol )
+
+    # code passes values through as is
+    #
+    def copies( self, code ) :
+        func = self._funcs.get( code )
+        return (func is None) or (func is copy_values)
+
+    def _copy( self, code, values, column, pdbcol ) :
+        start = time.time()
+        num = 0
+        try :
+            for val in values :
+                num += 1
+                yield val
+        finally :
+            secs = time.time() - start
+            if not code in self._stats : self._stats[code] = [0, 0, 0.0]
+            self._stats[code][0] += 1
+            self._stats[code][1] += num
+            self._stats[code][2] += secs
+            if self._verbose :
+                sys.stdout.write( "transform %s: %s -> %s, %d values, %0.3f\n" % (code,pdbcol.tag,column,num,secs) )
+
+    # { code : (calls, values, seconds) }
+    #
+    @property
+    def stats( self ) :
+        rc = {}
+        for (code, s) in self._stats.items() :
+            rc[code] = tuple( s )
+        return rc
+
+    def reset_stats( self ) :
+        self._stats.clear()
+
+    def print_stats( self, out = sys.stdout ) :
+        for code in sorted( self._stats.keys() ) :
+            (calls, vals, secs) = self._stats[code]
+            out.write( "transform %s: %d columns, %d values, %0.3f\n" % (code,calls,vals,secs) )
+
+###################################################
+# the big ugly switch, was in OneDepToBmrb.make_source_table()
+#  codes are in the nmr-star dictionary
+#
+
+# 0, 3, 4: don't seem to do anything in Steve's code
+# 6, 7, 8: no idea what it's supposed to do but only code 7 exists and
+#  only in some chem_comp tables where mapping is one-to-one anyway
+#
+def copy_values( values, startable, column, pdbcol ) :
+    return values
+
+# use source row number counting from 1, e.g. a rows of mmcif table to an nmr-star saveframe id
+# (it's always been off by one: row 0 gets 2)
+#
+def row_number( values, startable, column, pdbcol ) :
+    return [i + 2 for i in range( len( values ) )]
+
+# use value from cd.special unless it's a special exception
+#
+def special_value( values, startable, column, pdbcol ) :
+    pdbtag = "_%s.%s" % (pdbcol.table, pdbcol.col)
+    for val in values :
+        sys.stdout.write( "!!! %s : code 9, %s\n" % (pdbtag, startable.cols[column].getspecial( pdbtag )) )
+    return [pdbcol.special] * len( values )
+
+# boolean values: normalize to yes/no
+#
+def yes_no( values, startable, column, pdbcol ) :
+    rc = []
+    for val in values :
+        if str( val ).strip().lower() in BOOLEAN_TRUE : rc.append( "yes" )
+        else : rc.append( "no" )
+    return rc
+
+# 11 is "append to existing value" and 12 is "prepend" but they've always used the source value
+#
+def append_value( values, startable, column, pdbcol ) :
+    return [val + " " + val for val in values]
+
+def prepend_value( values, startable, column, pdbcol ) :
+    return [val + " " + val for val in values]
+
+# asym ID to number: "A"-> 1, "B" -> 2, etc. see asym.py
+#
+def asym_number( values, startable, column, pdbcol ) :
+    return asym.asym_numbers( values )
+
+# "1" -- it's a local id of a unique saveframe
+# should never happen: there's special handling for special tags
+#
+def one( values, startable, column, pdbcol ) :
+    return [1] * len( values )
+
+# name splitting for pdbx->bmrb.
+# A name could be e.g. Jar-Jar or St. Clair
+# can't parse the latter nor J.-J. or e.g. Jones III: everything goes in the last name then
+#
+def split_name( values, startable, column, pdbcol ) :
+    col = column.lower()
+    rc = []
+    for val in values :
+        m = NAME_PAT.search( val )
+        if not m :
+            if col in ("family_title", "first_initial", "given_name", "middle_initials") : val = None
+        else :
+            if col == "family_name" : val = m.group( 1 )
+            elif col == "family_title" : val = None
+            elif col == "first_initial" : val = m.group( 2 )[0] + "."
+            elif col == "given_name" : val = m.group( 2 )
+            elif col == "middle_initials" :
+                if len( m.group( 3 ) ) > 0 : val = m.group( 3 )
+                else : val = None
+        rc.append( val )
+    return rc
+
+# -40: split string on commas: for _struct.keywords but br0ken in the dictionary
+# -20: no idea, probably flip side of 20..23. not used in the dictionary
+#
+def not_implemented( code ) :
+    def func( values, startable, column, pdbcol ) :
+        for val in values :
+            raise Exception( "Not implemented: code %s for %s: %s" % (code,column,val,) )
+        return values
+    return func
+
+# flip side of codes 20..23: e.g.
+#  _pdbx_nmr_exptl_sample_conditions.pH -> Sample_condition_variable(Type="pH",Val,Unit="pH").
+# has to be done separately as we fill 2-3 target columns at once
+# except for the exceptions: concentration range is supposed to be $NUM-$NUM
+#
+def concentration_range( values, startable, column, pdbcol ) :
+    if (pdbcol.table != "pdbx_nmr_exptl_sample") or (pdbcol.col != "concentration_range") :
+        return values
+    rc = []
+    for val in values :
+        if val is None :
+            rc.append( SKIP )
+            continue
+        m = RANGE_PAT.search( val.strip() )
+        if not m :
+            rc.append( SKIP )
+            continue
+        if column == "Concentration_val_max" : val = m.group( 2 ).strip()
+        elif column == "Concentration_val_min" : val = m.group( 1 ).strip()
+        rc.append( val )
+    return rc
+
+# marks chem_comp tags (many rows) mapped to entity and assembly (few rows) tags.
+# that's really messing things up and usually they're "fallback" mappings that aren't used.
+#
+def skip_all( values, startable, column, pdbcol ) :
+    return [SKIP] * len( values )
+
+# codes not in current tag map:
+#
+# 15: name combining for bmrb -> pdbx
+# 20, 21, 22, 23: I think those were for variables (temperature, pressure) for bmrb->pdbx
+# 30: for converting bmrb sample to pdbx
+# 55: replace in: "not applicable" with out: "?"
+#
+TRANSFORMS = TransformRegistry()
+TRANSFORMS.register( 2, copy_values, overwrite = False )
+TRANSFORMS.register( 5, row_number )
+TRANSFORMS.register( 9, special_value )
+TRANSFORMS.register( 10, yes_no )
+TRANSFORMS.register( 11, append_value )
+TRANSFORMS.register( 12, prepend_value )
+TRANSFORMS.register( 45, asym_number )
+TRANSFORMS.register( 50, one )
+TRANSFORMS.register( -15, split_name )
+TRANSFORMS.register( -20, not_implemented( -20 ) )
+TRANSFORMS.register( -22, concentration_range )
+TRANSFORMS.register( -40, not_implemented( -40 ) )
+TRANSFORMS.register( 1001, skip_all )
+TRANSFORMS.register( -1001, skip_all )
+
+#
+#
+if __name__ == "__main__" :
+    for code in TRANSFORMS.codes :
+        sys.stdout.write( "%s\n" % (code,) )
+
+#
+# eof
+#
@@ -187,7 +187,7 @@ class StartAnnotation( object ) :
                 tgt = "work/data/" + os.path.split( base )[1]
                 with open( tgt, "wb" ) as out :
                     gz = gzip.open( f, "rb" )
-                    out.write( gz.read() )
+                    shutil.copyfileobj( gz, out )
                     gz.close()
 
             else :